@@ -0,0 +1,408 @@
+import os
+import io
+import sys
+import json
+import time
+import random
+import platform
+import argparse
+import datetime
+import tempfile
+import subprocess
+import tracemalloc
+import networkx as nx
+import numpy as np
+import haversine
+from PIL import Image
+import igo
+
+# a synthetic city starts at this corner (longitude, latitude), close to Barcelona so
+# the maps and the speed limits look like the real ones
+ORIGIN = (2.10, 41.37)
+SPACING = 0.0015  # degrees between the intersections of the grid
+STREET_TYPES = ['residential'] * 6 + ['tertiary'] * 2 + ['secondary', 'primary', 'trunk']
+MAXSPEEDS = ['30', '50', ['30', '50']]
+HIGHWAY_NODES = 5  # intersections of each synthetic highway
+STAGES = ('parse', 'load_graph', 'highway_edges', 'propagate', 'build_igraph', 'build_lean_igraph',
+          'route_dijkstra', 'route_cch', 'plot_path')
+
+
+def grid_graph(size, seed=0):
+    """ This function returns a synthetic city as osmnx would download it: a
+        MultiDiGraph with a grid of size x size intersections (slightly moved) joined by
+        two-way streets, with the length, highway, maxspeed (some of them) and osmid
+        attributes.
+
+                    Time complexity: O(size^2) """
+
+    rand = random.Random(seed)
+    positions = dict()
+    for i in range(size):
+        for j in range(size):
+            positions[i * size + j + 1] = (ORIGIN[0] + SPACING * j + rand.uniform(-0.2, 0.2) * SPACING,
+                                           ORIGIN[1] + SPACING * i + rand.uniform(-0.2, 0.2) * SPACING)
+    streets = list()
+    for i in range(size):
+        for j in range(size):
+            if j + 1 < size:
+                streets.append((i * size + j + 1, i * size + j + 2))
+            if i + 1 < size:
+                streets.append((i * size + j + 1, (i + 1) * size + j + 1))
+    return street_graph(positions, streets, rand)
+
+
+def planar_graph(size, seed=0):
+    """ This function returns a synthetic city with size^2 intersections at random
+        positions in the area of grid_graph, joined by the two-way streets of their
+        Delaunay triangulation (a random planar graph).
+
+                    Time complexity: O(size^2*log(size)) """
+
+    from scipy.spatial import Delaunay
+
+    rand = random.Random(seed)
+    points = [(ORIGIN[0] + rand.uniform(0, SPACING * (size - 1)), ORIGIN[1] + rand.uniform(0, SPACING * (size - 1)))
+              for _ in range(size * size)]
+    positions = {node + 1: point for node, point in enumerate(points)}
+    streets = set()
+    for triangle in Delaunay(np.array(points)).simplices.tolist():
+        for a, b in ((0, 1), (1, 2), (0, 2)):
+            node1, node2 = sorted((triangle[a] + 1, triangle[b] + 1))
+            streets.add((node1, node2))
+    return street_graph(positions, sorted(streets), rand)
+
+
+def street_graph(positions, streets, rand):
+    """ Returns the MultiDiGraph of the intersections (dictionary from node to (x, y))
+        and the two-way streets (pairs of nodes) of a synthetic city. """
+
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    for node, (x, y) in positions.items():
+        graph.add_node(node, x=x, y=y)
+    for osmid, (node1, node2) in enumerate(streets, 1):
+        (x1, y1), (x2, y2) = positions[node1], positions[node2]
+        data = {'osmid': osmid, 'highway': rand.choice(STREET_TYPES), 'oneway': False,
+                'length': haversine.haversine((y1, x1), (y2, x2), unit='m')}
+        if rand.random() < 0.3:
+            data['maxspeed'] = rand.choice(MAXSPEEDS)
+        graph.add_edge(node1, node2, **data)
+        graph.add_edge(node2, node1, **dict(data))
+    return graph
+
+
+def synthetic_highways(graph, count, seed=0):
+    """ This function returns count highways (igo.Highway) of a synthetic city, each one
+        a walk along HIGHWAY_NODES intersections.
+
+                    Time complexity: O(count) """
+
+    rand = random.Random(seed)
+    nodes = list(graph.nodes)
+    highways = list()
+    for way_id in range(1, count + 1):
+        walk = [rand.choice(nodes)]
+        while len(walk) < HIGHWAY_NODES:
+            neighbours = [node for node in graph.adj[walk[-1]] if node not in walk]
+            if not neighbours:
+                break
+            walk.append(rand.choice(neighbours))
+        coordinates = list()
+        for node in walk:
+            coordinates += [graph.nodes[node]['x'], graph.nodes[node]['y']]
+        highways.append(igo.Highway(way_id, 'Tram ' + str(way_id), coordinates))
+    return highways
+
+
+def dead_end(graph, way_id):
+    """ This function adds a dead end to a synthetic city: a new intersection south of
+        the southernmost one, joined only to it by a two-way street. It returns the two
+        highways (igo.Highway) of the street, one per direction, numbered from way_id,
+        and the routes (as check_routes takes them) between the two ends of the street.
+
+                    Time complexity: O(edges) """
+
+    base = min(graph.nodes, key=lambda node: graph.nodes[node]['y'])
+    x, y = graph.nodes[base]['x'], graph.nodes[base]['y']
+    node = max(graph.nodes) + 1
+    graph.add_node(node, x=x, y=y - SPACING)
+    data = {'osmid': max(osmid for _, _, osmid in graph.edges(data='osmid')) + 1, 'highway': 'residential',
+            'oneway': False, 'length': haversine.haversine((y, x), (y - SPACING, x), unit='m')}
+    graph.add_edge(base, node, **data)
+    graph.add_edge(node, base, **dict(data))
+    highways = [igo.Highway(way_id, 'Tram ' + str(way_id), [x, y, x, y - SPACING]),
+                igo.Highway(way_id + 1, 'Tram ' + str(way_id + 1), [x, y - SPACING, x, y])]
+    return highways, [(y, x, y - SPACING, x), (y - SPACING, x, y, x)]
+
+
+def synthetic_congestions(highways, seed=0, data=20210601120000, closed=()):
+    """ This function returns a congestion (igo.Congestion) with random statuses for
+        each highway, except the ones whose way_id is in closed, which are closed now
+        and in the prediction (status 6).
+
+                    Time complexity: O(highways) """
+
+    rand = random.Random(seed)
+    return [igo.Congestion(highway.way_id, data, 6, 6) if highway.way_id in closed else
+            igo.Congestion(highway.way_id, data, rand.randint(0, 6), rand.randint(0, 6)) for highway in highways]
+
+
+def write_highways(highways, filename):
+    """ Writes the highways in the format of the highways file of the city. """
+
+    with open(filename, 'w') as file:
+        file.write('Tram,Descripció,Coordenades\n')
+        for highway in highways:
+            file.write('{},"{}","{}"\n'.format(highway.way_id, highway.description,
+                                               ','.join(map(repr, highway.coordinates))))
+
+
+def write_congestions(congestions, filename):
+    """ Writes the congestions in the format of the congestions file of the city. """
+
+    with open(filename, 'w') as file:
+        file.write('Tram#Data#Estat Actual#Estat Previst\n')
+        for congestion in congestions:
+            file.write('{}#{}#{}#{}\n'.format(*congestion))
+
+
+class BlankLayer:
+    """ This class is a base layer (see tiles.CachedStaticMap) of blank tiles, so the
+        maps are rendered without downloading anything. """
+
+    def __init__(self):
+        image = io.BytesIO()
+        Image.new('RGB', (256, 256), (240, 240, 240)).save(image, format='PNG')
+        self.content = image.getvalue()
+
+    def tile(self, zoom, x, y):
+        return self.content
+
+
+def summary(samples, unit='calls/s'):
+    """ This function returns the statistics of the latencies (seconds) of some calls:
+        mean, min, max and percentiles (p50, p90, p99), and the throughput (calls per
+        second of the total time).
+
+                    Time complexity: O(samples*log(samples)) """
+
+    samples = np.array(samples)
+    p50, p90, p99 = np.percentile(samples, [50, 90, 99]).tolist()
+    return {'samples': len(samples), 'mean': float(samples.mean()), 'min': float(samples.min()),
+            'max': float(samples.max()), 'p50': p50, 'p90': p90, 'p99': p99,
+            'throughput': len(samples) / float(samples.sum()), 'unit': unit}
+
+
+def measure(calls, warmup=1, repeat=5, unit='calls/s'):
+    """ This function times a batch of calls (functions without arguments, one latency
+        sample each): the batch runs warmup times without being timed, then repeat
+        times timed, and one more time with tracemalloc to get the peak memory (bytes
+        allocated by Python during the batch). It returns the summary of the samples
+        with the peak memory.
+
+                    Time complexity: O((warmup + repeat + 1)*calls) """
+
+    for _ in range(warmup):
+        for call in calls:
+            call()
+    samples = list()
+    for _ in range(repeat):
+        for call in calls:
+            begin = time.perf_counter()
+            call()
+            samples.append(time.perf_counter() - begin)
+    tracemalloc.start()
+    try:
+        for call in calls:
+            call()
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    result = summary(samples, unit)
+    result['peak_memory'] = peak
+    return result
+
+
+def commit():
+    """ Returns the git commit of the code, None if it is not known. """
+
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def path_cost(igraph, path):
+    """ Returns the itime of a path (list of node ids) of an iGraph, None if it is not a
+        path (get_shortest_path_between_coords found none). """
+
+    if type(path) != list:
+        return None
+    routing_graph = igraph.graph['routing']
+    return sum(float(routing_graph.itime[routing_graph.edge_position(node1, node2)])
+               for node1, node2 in zip(path[:-1], path[1:]))
+
+
+def check_routes(igraph, points, unreachable=(), tolerance=1e-6):
+    """ This function checks that the routes of the contraction hierarchy cost the same
+        as the ones of Dijkstra between the points (the paths can differ if there are
+        ties), so the benchmark never compares methods that do not agree, and that
+        neither method finds a route between the unreachable points.
+
+                    Time complexity: O(points*edges*log(nodes)) """
+
+    for point in unreachable:
+        for method in ('dijkstra', 'cch'):
+            path = igo.get_shortest_path_between_coords(igraph, *point, method=method)
+            assert path_cost(igraph, path) is None, \
+                'route_{} goes through a closed street between {}: {}'.format(method, point, path)
+    for point in points:
+        expected = path_cost(igraph, igo.get_shortest_path_between_coords(igraph, *point, method='dijkstra'))
+        cost = path_cost(igraph, igo.get_shortest_path_between_coords(igraph, *point, method='cch'))
+        assert (cost is None) == (expected is None) and \
+            (cost is None or abs(cost - expected) <= tolerance * max(1.0, expected)), \
+            'route_cch and route_dijkstra disagree between {}: {} and {}'.format(point, cost, expected)
+
+
+def run(kind='grid', size=40, highways=200, routes=200, renders=20, warmup=1, repeat=5, seed=0,
+        stages=STAGES, SIZE=400):
+    """ This function runs the benchmark on a synthetic city (kind 'grid' or 'planar',
+        see grid_graph and planar_graph) with its highways and congestions files, all
+        in a temporary directory, and returns the results as a dictionary: 'meta' with
+        the configuration, the graph size and the commit, and 'stages' with the result
+        of measure for each stage:
+            parse: download (file://) and parse the highways and congestions files.
+            load_graph: load the saved graph, building its contraction hierarchy and
+                spatial index (not repeated, they are cached on disk afterwards).
+            highway_edges: find the edges of the highways (igo.build_highway_edges).
+            propagate: igo.propagate_congestion_for_all_edges, searching the paths.
+            build_igraph, build_lean_igraph: build the iGraph of the congestions.
+            route_dijkstra, route_cch: igo.get_shortest_path_between_coords between
+                random points, a sample per route (after checking the two methods find
+                routes of the same cost, and none to the dead end of the city whose
+                only street is closed, see check_routes).
+            plot_path: render a route (SIZE x SIZE) on blank tiles, a sample per map.
+        The same seed gives the same city, highways, congestions and routes. """
+
+    results = dict()
+    with tempfile.TemporaryDirectory() as directory:
+        graph = (planar_graph if kind == 'planar' else grid_graph)(size, seed)
+        street_highways = synthetic_highways(graph, highways, seed)
+        # a dead end whose only street is closed, so no route can reach it
+        closed_highways, closed_routes = dead_end(graph, highways + 1)
+        street_highways += closed_highways
+        highways_filename = os.path.join(directory, 'highways.csv')
+        congestions_filename = os.path.join(directory, 'congestions.csv')
+        write_highways(street_highways, highways_filename)
+        closed = {highway.way_id for highway in closed_highways}
+        write_congestions(synthetic_congestions(street_highways, seed, closed=closed), congestions_filename)
+        graph_filename = os.path.join(directory, 'city.graph')
+        igo.save_graph(graph, graph_filename)
+
+        def parse():
+            return (igo.download_highways('file://' + highways_filename),
+                    igo.download_congestions('file://' + congestions_filename))
+
+        def load_graph():
+            for extension in ('.cch', '.index'):
+                if os.path.exists(graph_filename + extension):
+                    os.remove(graph_filename + extension)
+            return igo.load_graph(graph_filename)
+
+        if 'parse' in stages:
+            results['parse'] = measure([parse], warmup, repeat)
+        if 'load_graph' in stages:
+            results['load_graph'] = measure([load_graph], 0, 1)
+        street_highways, congestions = parse()
+        graph = igo.load_graph(graph_filename)
+        digraph = igo.ox.utils_graph.get_digraph(graph, weight='length')
+        if 'highway_edges' in stages:
+            results['highway_edges'] = measure([lambda: igo.build_highway_edges(digraph, street_highways)],
+                                               warmup, repeat)
+        highway_edges = igo.build_highway_edges(digraph, street_highways)
+        if 'propagate' in stages:
+            results['propagate'] = measure(
+                [lambda: igo.propagate_congestion_for_all_edges(digraph, street_highways, congestions)],
+                warmup, repeat)
+        if 'build_igraph' in stages:
+            results['build_igraph'] = measure(
+                [lambda: igo.build_igraph(graph, street_highways, congestions, highway_edges)], warmup, repeat)
+        if 'build_lean_igraph' in stages:
+            results['build_lean_igraph'] = measure(
+                [lambda: igo.build_lean_igraph(graph, street_highways, congestions, highway_edges)],
+                warmup, repeat)
+
+        igraph = igo.build_igraph(graph, street_highways, congestions, highway_edges)
+        rand = random.Random(seed)
+        xs, ys = [graph.nodes[node]['x'] for node in graph], [graph.nodes[node]['y'] for node in graph]
+        # (latitude, longitude) of the origin and the destination, as geocode returns them
+        points = [(rand.uniform(min(ys), max(ys)), rand.uniform(min(xs), max(xs)),
+                   rand.uniform(min(ys), max(ys)), rand.uniform(min(xs), max(xs))) for _ in range(routes)]
+        if 'route_dijkstra' in stages or 'route_cch' in stages:
+            check_routes(igraph, points + closed_routes, closed_routes)
+        for method in ('dijkstra', 'cch'):
+            if 'route_' + method in stages:
+                results['route_' + method] = measure(
+                    [lambda point=point: igo.get_shortest_path_between_coords(igraph, *point, method=method)
+                     for point in points], warmup, repeat, 'routes/s')
+        if 'plot_path' in stages and renders > 0:
+            layer = BlankLayer()
+            paths = [igo.get_shortest_path_between_coords(igraph, *point, method='cch') for point in points]
+            paths = [path for path in paths if type(path) == list and len(path) > 1][:renders]
+            results['plot_path'] = measure([lambda path=path: igo.plot_path(igraph, path, SIZE, layer)
+                                            for path in paths], warmup, repeat, 'maps/s')
+
+        meta = {'kind': kind, 'size': size, 'highways': len(street_highways), 'routes': routes,
+                'renders': renders, 'warmup': warmup, 'repeat': repeat, 'seed': seed,
+                'nodes': graph.number_of_nodes(), 'edges': graph.number_of_edges(),
+                'commit': commit(), 'python': platform.python_version(), 'platform': platform.platform(),
+                'date': datetime.datetime.now().isoformat(timespec='seconds')}
+    return {'meta': meta, 'stages': results}
+
+
+def compare(baseline, results):
+    """ This function returns a text table with the p50 latency and the throughput of
+        each stage in two results of run, and the ratio of the new p50 to the old one
+        (over 1 means slower). """
+
+    rows = ['{:<20}{:>12}{:>12}{:>8}{:>14}{:>14}'.format('stage', 'old p50', 'new p50', 'ratio',
+                                                         'old thr.', 'new thr.')]
+    for stage, new in results['stages'].items():
+        old = baseline['stages'].get(stage)
+        if old is None:
+            continue
+        rows.append('{:<20}{:>12.6f}{:>12.6f}{:>8.2f}{:>14.1f}{:>14.1f}'.format(
+            stage, old['p50'], new['p50'], new['p50'] / old['p50'], old['throughput'], new['throughput']))
+    return '\n'.join(rows)
+
+
+def main(arguments=None):
+    parser = argparse.ArgumentParser(description='Offline benchmark of the iGo pipeline on a synthetic city.')
+    parser.add_argument('--kind', choices=('grid', 'planar'), default='grid')
+    parser.add_argument('--size', type=int, default=40, help='intersections per side of the city')
+    parser.add_argument('--highways', type=int, default=200)
+    parser.add_argument('--routes', type=int, default=200)
+    parser.add_argument('--renders', type=int, default=20)
+    parser.add_argument('--warmup', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES)
+    parser.add_argument('--output', help='JSON file for the results (standard output by default)')
+    parser.add_argument('--compare', help='JSON file of a previous run to compare with')
+    arguments = parser.parse_args(arguments)
+
+    results = run(arguments.kind, arguments.size, arguments.highways, arguments.routes, arguments.renders,
+                  arguments.warmup, arguments.repeat, arguments.seed, arguments.stages)
+    if arguments.output is not None:
+        with open(arguments.output, 'w') as file:
+            json.dump(results, file, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+    if arguments.compare is not None:
+        with open(arguments.compare) as file:
+            print(compare(json.load(file), results), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
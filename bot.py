@@ -1,31 +1,62 @@
-import networkx as nx
-import osmnx as ox
-import random
 import igo
 import os
-import datetime
-from staticmap import StaticMap, CircleMarker
+import registry
+import metrics
+import tiles
+import threading
+import io
+from staticmap import CircleMarker
 from telegram.ext import Updater, CommandHandler, MessageHandler, Filters
-import datetime
 
-PLACE = 'Barcelona, Catalonia'
-GRAPH_FILENAME = 'barcelona.graph'
+CITIES_DIRECTORY = 'cities'  # the graphs (shared by place) and the files of each city
+MEMORY_BUDGET = 4 * 1024 ** 3  # estimated bytes of the loaded cities, see registry.CityRegistry
+DEFAULT_CITY = 'barcelona'
 SIZE = 800
+ISOCHRONE_MINUTES = 10  # default minutes of /isochrona
+WORKERS = 8
+TILES_DIRECTORY = 'tiles'
+TILES_MAX_BYTES = 500 * 1024 * 1024
+SEED_TILES = False  # download the tiles of Barcelona at startup, to render offline
+BARCELONA_BBOX = (2.05, 41.32, 2.23, 41.47)  # min_lon, min_lat, max_lon, max_lat
+SEED_ZOOMS = range(11, 17)
+METRICS = True  # time the stages of the requests and the refreshes
+METRICS_PORT = 9100  # Prometheus endpoint, http://127.0.0.1:9100/metrics
+ADMINS_FILENAME = 'admins.txt'  # chat ids (one per line) that can use /stats
 HIGHWAYS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/1090983a-1c40-4609-8620-14ad49aae3ab/resource/1d6c814c-70ef-4147-aa16-a49ddb952f72/download/transit_relacio_trams.csv'
 CONGESTIONS_URL = 'https://opendata-ajuntament.barcelona.cat/data/dataset/8319c2b1-4c21-4962-9acd-6db4c5ff1148/resource/2d456eb5-4ea6-4f68-9794-2f3f1a58a933/download'
+# the cities the bot serves: only Barcelona publishes its congestions, the routes of
+# the other ones take only the speed limits into account
+CITIES = [registry.City('barcelona', 'Barcelona, Catalonia', HIGHWAYS_URL, CONGESTIONS_URL),
+          registry.City('badalona', 'Badalona, Catalonia', None, None),
+          registry.City('hospitalet', "L'Hospitalet de Llobregat, Catalonia", None, None)]
+
+metrics.enable(METRICS)
+if METRICS:
+    metrics.serve(METRICS_PORT)
+admins = set()
+if os.path.exists(ADMINS_FILENAME):
+    admins = {int(line) for line in open(ADMINS_FILENAME).read().split()}
+
+# every map is drawn from the tiles on disk, downloading only the missing ones
+tiles.set_default_cache(tiles.TileCache(TILES_DIRECTORY, TILES_MAX_BYTES))
+if SEED_TILES:
+    threading.Thread(target=tiles.seed, args=(BARCELONA_BBOX, SEED_ZOOMS), daemon=True).start()
 
-if not igo.exists_graph(GRAPH_FILENAME):
-    graph = igo.download_graph(PLACE)
-    igo.save_graph(graph, GRAPH_FILENAME)
-else:
-    graph = igo.load_graph(GRAPH_FILENAME)
+TOKEN = open('token.txt').read().strip()
+
+# the /go and /where requests run on this many worker threads
+updater = Updater(token=TOKEN, use_context=True, workers=WORKERS)
+dispatcher = updater.dispatcher
 
-highways = igo.download_highways(HIGHWAYS_URL)
+# each city is loaded on its first request, and its congestions refreshed in the job queue
+cities = registry.CityRegistry(CITIES, CITIES_DIRECTORY, MEMORY_BUDGET, updater.job_queue)
 
-update_time = datetime.datetime.now()
-congestions = igo.download_congestions(CONGESTIONS_URL)
 
-igraph = igo.build_igraph(graph, highways, congestions)
+def user_city(context):
+    """ This function returns the LoadedCity of the user (see /ciutat), loading it if
+        it is the first request of the city. """
+
+    return cities.get(context.user_data.get('city', DEFAULT_CITY))
 
 
 def start(update, context):
@@ -48,7 +79,7 @@ def help(update, context):
 
     context.bot.send_message(
         chat_id=update.effective_chat.id,
-        text="Sóc un bot amb comandes /start, /help, /authors, /go, /where i /pos.\n T'ajudaré a arribar on vulguis de Barcelona.")
+        text="Sóc un bot amb comandes /start, /help, /authors, /go, /where, /pos, /isochrona i /ciutat.\n T'ajudaré a arribar on vulguis de Barcelona i rodalies.")
 
 
 def where(update, context):
@@ -57,18 +88,13 @@ def where(update, context):
 
     try:
         lat, lon = update.message.location.latitude, update.message.location.longitude
-        position = [lat, lon]
-        context.user_data['origin'] = ox.geocoder.geocode(position)
-        fitxer = "%d.png" % random.randint(1000000, 9999999)
-        mapa = StaticMap(500, 500)
+        context.user_data['origin'] = (lat, lon)  # as igo.geocode returns the positions
+        mapa = tiles.CachedStaticMap(500, 500)
         mapa.add_marker(CircleMarker((lon, lat), 'blue', 10))
-        imatge = mapa.render()
-        imatge.save(fitxer)
         context.bot.send_message(chat_id=update.effective_chat.id, text="Ets aquí.")
-        context.bot.send_photo(
-            chat_id=update.effective_chat.id,
-            photo=open(fitxer, 'rb'))
-        os.remove(fitxer)
+        photo = igo.render_png(mapa)
+        with metrics.timer('upload'):
+            context.bot.send_photo(chat_id=update.effective_chat.id, photo=photo)
     except Exception as e:
         print(e)
         context.bot.send_message(
@@ -76,30 +102,13 @@ def where(update, context):
             text='💣')
 
 
-def update(context):
-    """ This is an auxiliar function for the /go method. It updates the congestions on the map. """
-
-    now = datetime.datetime.now()
-    update_time = now
-    congestions = igo.download_congestions(CONGESTIONS_URL)
-    igraph = build_igraph(graph, highways, congestions)
-    return igraph
-
-
-def igraph_must_update(context):
-    """ This function is used to know whether the congestions must be updated or not.
-        The congestions update if 5 minuts have passed until last update. """
-
-    now = datetime.datetime.now()
-    return now > update_time + datetime.timedelta(minutes=5)
-
-
 def destination_position(update, context):
     """ This auxiliar function gets the position of the user destination. """
 
     try:
         dst = update.message.text[4:]
-        context.user_data['destination'] = ox.geocoder.geocode(dst + ', Barcelona')
+        city = user_city(context)
+        context.user_data['destination'] = igo.geocode(dst, city.geocoder, city.city.place)
     except:
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="No has enviat el destí! \n Afegeix-lo a continuació de la comanda /go.")
@@ -111,7 +120,8 @@ def pos(update, context):
 
     try:
         pos = update.message.text[5:]
-        context.user_data['origin'] = ox.geocoder.geocode(pos + ', Barcelona')
+        city = user_city(context)
+        context.user_data['origin'] = igo.geocode(pos, city.geocoder, city.city.place)
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="Ets a " + str(pos))
 
@@ -124,6 +134,7 @@ def pos(update, context):
                                  text="No has enviat l'origen! \n Afegeix-lo a continuació de la comanda /pos.")
 
 
+@metrics.timed('go')
 def go(update, context):
     """ This is the bot main function. It returns a picture of the shortest path between
         the user location (real or defined with the /pos command). It uses iGo functions
@@ -138,26 +149,95 @@ def go(update, context):
     except:
         context.bot.send_message(chat_id=update.effective_chat.id,
                                  text="No has dit on ets!\n Utilitza les comandes /where o /pos i defineix la teva posició.")
-    global igraph
-    if igraph_must_update(context):
-        igraph = update(context)
-    ipath = igo.get_shortest_path_between_coords(
-        igraph, orig_long, orig_lat, dst_long, dst_lat)
-    igo.plot_path(igraph, ipath, SIZE)
-    context.bot.send_photo(chat_id=update.effective_chat.id, photo=open('shortest_path.png', 'rb'))
+        return
+    city = user_city(context)
+    snapshot = city.current()
+    ipath, image = igo.get_route(snapshot.igraph, snapshot.version, city.route_cache,
+                                 orig_long, orig_lat, dst_long, dst_lat, SIZE, method='cch',
+                                 base_layer=city.base_layer(snapshot))
+    if image is None:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="No he trobat cap camí.")
+    else:
+        with metrics.timer('upload'):
+            context.bot.send_photo(chat_id=update.effective_chat.id, photo=io.BytesIO(image))
+
+
+@metrics.timed('isochrona')
+def isochrone(update, context):
+    """ This function sends a map with the area the user can reach from its position
+        (real or defined with the /pos command) in the given minutes (/isochrona 15)
+        with the current congestions. """
 
+    try:
+        origin = context.user_data['origin']
+    except KeyError:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="No has dit on ets!\n Utilitza les comandes /where o /pos i defineix la teva posició.")
+        return
+    try:
+        minutes = float(context.args[0]) if context.args else ISOCHRONE_MINUTES
+    except ValueError:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Indica els minuts amb un número, per exemple /isochrona 15.")
+        return
+    city = user_city(context)
+    snapshot = city.current()
+    reached, area, image = igo.get_isochrone(snapshot.igraph, snapshot.version, city.isochrone_cache,
+                                             origin, minutes, SIZE, city.base_layer(snapshot))
+    context.bot.send_message(chat_id=update.effective_chat.id,
+                             text="En " + str(minutes) + " minuts pots arribar a aquesta zona.")
+    with metrics.timer('upload'):
+        context.bot.send_photo(chat_id=update.effective_chat.id, photo=io.BytesIO(image))
 
-TOKEN = open('token.txt').read().strip()
 
-updater = Updater(token=TOKEN, use_context=True)
-dispatcher = updater.dispatcher
+def choose_city(update, context):
+    """ This function changes the city of the user (/ciutat badalona), or lists the
+        cities if none is given. The positions of the previous city are forgotten. """
+
+    if not context.args:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="Ciutats: " + ', '.join(cities.names()) + ".\n Tria-la amb /ciutat nom.")
+        return
+    name = ' '.join(context.args).lower()
+    if name not in cities.cities:
+        context.bot.send_message(chat_id=update.effective_chat.id,
+                                 text="No conec aquesta ciutat. Ciutats: " + ', '.join(cities.names()) + ".")
+        return
+    context.user_data['city'] = name
+    context.user_data.pop('origin', None)
+    context.user_data.pop('destination', None)
+    context.bot.send_message(chat_id=update.effective_chat.id, text="Ara et porto per " + name + ".")
+
+
+def stats(update, context):
+    """ This function sends the metrics of the bot (the latency of each stage and the
+        counters, see metrics.report) and of the refreshes of each loaded city, only to
+        the admins. """
+
+    if update.effective_chat.id not in admins:
+        context.bot.send_message(chat_id=update.effective_chat.id, text="Aquesta comanda és només per als administradors.")
+        return
+    lines = [metrics.report(), '', "Ciutats carregades: {} MB estimats de {} MB".format(
+        cities.memory() // 2 ** 20, cities.memory_budget // 2 ** 20)]
+    for name, loaded in list(cities.loaded.items()):
+        if loaded.refresher is None:
+            lines.append(name + ": sense dades de trànsit")
+            continue
+        refresh_stats = loaded.refresher.stats
+        lines.append("{}: actualitzacions: {} · sense canvis: {} · errors: {} · última: {} s".format(
+            name, refresh_stats['refreshes'], refresh_stats['skipped'], refresh_stats['failures'],
+            None if refresh_stats['last_duration'] is None else round(refresh_stats['last_duration'], 2)))
+    context.bot.send_message(chat_id=update.effective_chat.id, text='\n'.join(lines))
 
 
 dispatcher.add_handler(CommandHandler('start', start))
 dispatcher.add_handler(CommandHandler('help', help))
 dispatcher.add_handler(CommandHandler('authors', authors))
-dispatcher.add_handler(MessageHandler(Filters.location, where))
-dispatcher.add_handler(CommandHandler('pos', pos))
-dispatcher.add_handler(CommandHandler('go', go))
+dispatcher.add_handler(MessageHandler(Filters.location, where, run_async=True))
+dispatcher.add_handler(CommandHandler('pos', pos, run_async=True))
+dispatcher.add_handler(CommandHandler('go', go, run_async=True))
+dispatcher.add_handler(CommandHandler('isochrona', isochrone, run_async=True))
+dispatcher.add_handler(CommandHandler('ciutat', choose_city))
+dispatcher.add_handler(CommandHandler('stats', stats))
 
 updater.start_polling()
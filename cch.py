@@ -0,0 +1,461 @@
+import numpy as np
+
+
+class Topology:
+    """ This class is the metric independent part of a customizable contraction hierarchy.
+        It only depends on the graph topology, so it is computed once per graph and it
+        can be customized with any weights (for example the itime of every refresh).
+        The nodes are numbered as in the RoutingGraph (sorted original ids).
+
+        Attributes:
+            node_ids: the original id of each node (sorted).
+            rank: position of each node in the contraction order.
+            edge_low, edge_high: the two nodes of each hierarchy edge (edge_low has lower rank).
+            up_offsets, up_targets, up_edges: CSR arrays of the edges from each node to its
+                neighbours with higher rank (sorted by rank), and the id of those edges.
+            parent: the parent of each node in the elimination tree (-1 for the roots).
+            parents: the parent array as a list, to walk the ancestors of a node.
+            depth: the number of ancestors of each node in the elimination tree.
+            tri_bottom, tri_low, tri_high, tri_top: the lower triangles (x, y, z) of every
+                edge {y, z}, given by the ids of the edges {x, y}, {x, z} and {y, z}.
+            level_offsets: the triangles are sorted by the elimination tree level of x,
+                the ones of level l are the positions level_offsets[l]..level_offsets[l+1]-1.
+            sorted_keys, sorted_edges: the keys edge_low*nodes + edge_high sorted, and the
+                edge of each one, to find edges by their nodes. """
+
+    def __init__(self, node_ids, rank, edge_low, edge_high, up_offsets, up_targets, up_edges,
+                 parent, tri_bottom, tri_low, tri_high, tri_top, level_offsets):
+        self.node_ids = node_ids
+        self.rank = rank
+        self.edge_low = edge_low
+        self.edge_high = edge_high
+        self.up_offsets = up_offsets
+        self.up_targets = up_targets
+        self.up_edges = up_edges
+        self.parent = parent
+        self.parents = parent.tolist()
+        self.depth = elimination_depth(self.parents, rank)
+        self.tri_bottom = tri_bottom
+        self.tri_low = tri_low
+        self.tri_high = tri_high
+        self.tri_top = tri_top
+        self.level_offsets = level_offsets
+        keys = edge_low.astype(np.int64) * len(node_ids) + edge_high
+        self.sorted_edges = np.argsort(keys).astype(np.int32)
+        self.sorted_keys = keys[self.sorted_edges]
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['parents'], state['depth']  # they are rebuilt from parent
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.parents = self.parent.tolist()
+        self.depth = elimination_depth(self.parents, self.rank)
+
+    def number_of_edges(self):
+        return len(self.edge_low)
+
+
+def elimination_depth(parents, rank):
+    """ Returns an array with the number of ancestors of each node in the elimination
+        tree, given the parent of each node and their ranks (a parent has a higher rank).
+
+                    Time complexity: O(nodes*log(nodes)) """
+
+    depth = [0] * len(parents)
+    for node in np.argsort(rank)[::-1].tolist():
+        if parents[node] != -1:
+            depth[node] = depth[parents[node]] + 1
+    return np.array(depth, dtype=np.int64)
+
+
+class Hierarchy:
+    """ This class is a customized contraction hierarchy: a Topology with the weights
+        of its edges in both directions.
+
+        Attributes:
+            topology: the Topology.
+            up, down: the weight of each edge from edge_low to edge_high and backwards.
+            up_middle, down_middle: the node x of the lower triangle that gives the weight
+                of each edge, -1 if it is the weight of an edge of the original graph.
+            forward, backward: the up and down weights in the order of up_targets. """
+
+    def __init__(self, topology, up, down, up_middle, down_middle):
+        self.topology = topology
+        self.up = up
+        self.down = down
+        self.up_middle = up_middle
+        self.down_middle = down_middle
+        self.forward = up[topology.up_edges]
+        self.backward = down[topology.up_edges]
+
+
+def nested_dissection_order(x, y, neighbours, leaf_size=8):
+    """ This function returns a contraction order (list of node numbers, first the ones
+        contracted first) of a road network. The nodes are recursively split in two halves
+        by the median of the longest side of their bounding box, and the nodes of one half
+        adjacent to the other half (the separator) are put after both halves.
+
+        Precondition:
+            1- neighbours[i] must be the set of neighbours of the node i (undirected).
+
+                    Time complexity: O(nodes*log(nodes)^2) """
+
+    order = list()
+
+    def dissect(nodes):
+        if len(nodes) <= leaf_size:
+            order.extend(nodes.tolist())
+            return
+        xs, ys = x[nodes], y[nodes]
+        coordinates = xs if xs.max() - xs.min() >= ys.max() - ys.min() else ys
+        sorted_nodes = nodes[np.argsort(coordinates, kind='stable')]
+        half = len(nodes) // 2
+        left, right = sorted_nodes[:half], sorted_nodes[half:]
+        left_set, right_set = set(left.tolist()), set(right.tolist())
+        left_boundary = [u for u in left.tolist() if not neighbours[u].isdisjoint(right_set)]
+        right_boundary = [u for u in right.tolist() if not neighbours[u].isdisjoint(left_set)]
+        separator = left_boundary if len(left_boundary) <= len(right_boundary) else right_boundary
+        separator_set = set(separator)
+        dissect(np.array([u for u in left.tolist() if u not in separator_set], dtype=np.int64))
+        dissect(np.array([u for u in right.tolist() if u not in separator_set], dtype=np.int64))
+        order.extend(separator)
+
+    dissect(np.arange(len(x), dtype=np.int64))
+    return order
+
+
+def build_topology(graph):
+    """ This function returns the Topology of a graph (see contract).
+
+        Precondition:
+            1- graph must be a networkx graph with the x and y node attributes.
+
+                    Time complexity: O(nodes*log(nodes)^2 + triangles) """
+
+    node_ids = np.array(sorted(graph.nodes), dtype=np.int64)
+    index = {node: i for i, node in enumerate(node_ids.tolist())}
+    x = np.array([graph.nodes[node]['x'] for node in node_ids.tolist()], dtype=np.float64)
+    y = np.array([graph.nodes[node]['y'] for node in node_ids.tolist()], dtype=np.float64)
+    sources, targets = list(), list()
+    for node1, node2 in graph.edges():
+        sources.append(index[node1])
+        targets.append(index[node2])
+    return contract(node_ids, x, y, sources, targets)
+
+
+def compact_topology(compact):
+    """ This function returns the Topology of a storage.CompactGraph, the same one
+        build_topology returns for its MultiDiGraph, computed on its arrays.
+
+                    Time complexity: O(nodes*log(nodes)^2 + triangles) """
+
+    node_ids, numbers = compact.sorted_nodes()
+    order = np.argsort(numbers)
+    return contract(node_ids, np.asarray(compact.x)[order], np.asarray(compact.y)[order],
+                    numbers[np.asarray(compact.edge_u)], numbers[np.asarray(compact.edge_v)])
+
+
+def contract(node_ids, x, y, sources, targets):
+    """ This function returns the Topology of the graph of the nodes (sorted ids and
+        coordinates) and the edges from sources to targets (node numbers): the nodes
+        are ordered with nested_dissection_order and contracted in that order, adding
+        an edge between every two higher neighbours of each contracted node (no
+        witness search, so the result does not depend on the weights).
+
+                    Time complexity: O(nodes*log(nodes)^2 + triangles) """
+
+    n = len(node_ids)
+    neighbours = [set() for _ in range(n)]
+    for node1, node2 in zip(np.asarray(sources).tolist(), np.asarray(targets).tolist()):
+        if node1 != node2:
+            neighbours[node1].add(node2)
+            neighbours[node2].add(node1)
+
+    order = nested_dissection_order(x, y, neighbours)
+    rank = np.empty(n, dtype=np.int32)
+    rank[np.array(order, dtype=np.int64)] = np.arange(n, dtype=np.int32)
+    rank_list = rank.tolist()
+
+    # contraction: the higher neighbours of each node become a clique
+    upper = [{v for v in neighbours[u] if rank_list[v] > rank_list[u]} for u in range(n)]
+    for u in order:
+        higher = sorted(upper[u], key=rank_list.__getitem__)
+        for i, v in enumerate(higher):
+            upper[v].update(higher[i+1:])
+
+    edge_id = dict()
+    edge_low, edge_high = list(), list()
+    up_offsets = np.zeros(n + 1, dtype=np.int32)
+    up_targets, up_edges = list(), list()
+    parent = np.full(n, -1, dtype=np.int32)
+    higher_of = [None] * n
+    for u in range(n):
+        higher = sorted(upper[u], key=rank_list.__getitem__)
+        higher_of[u] = higher
+        if higher:
+            parent[u] = higher[0]
+        for v in higher:
+            edge_id[(u, v)] = len(edge_low)
+            up_targets.append(v)
+            up_edges.append(len(edge_low))
+            edge_low.append(u)
+            edge_high.append(v)
+        up_offsets[u+1] = len(up_targets)
+
+    level = [0] * n
+    for u in order:
+        if parent[u] != -1:
+            level[parent[u]] = max(level[parent[u]], level[u] + 1)
+
+    triangles = [list() for _ in range(max(level) + 1)]
+    for u in order:
+        higher = higher_of[u]
+        for i, v in enumerate(higher):
+            for w in higher[i+1:]:
+                triangles[level[u]].append((u, edge_id[(u, v)], edge_id[(u, w)], edge_id[(v, w)]))
+    level_offsets = np.zeros(len(triangles) + 1, dtype=np.int64)
+    level_offsets[1:] = np.cumsum([len(t) for t in triangles])
+    flat = np.array([t for level_triangles in triangles for t in level_triangles],
+                    dtype=np.int32).reshape(-1, 4)
+
+    return Topology(node_ids, rank,
+                    np.array(edge_low, dtype=np.int32), np.array(edge_high, dtype=np.int32),
+                    up_offsets, np.array(up_targets, dtype=np.int32),
+                    np.array(up_edges, dtype=np.int32), parent,
+                    flat[:, 0].copy(), flat[:, 1].copy(), flat[:, 2].copy(), flat[:, 3].copy(),
+                    level_offsets)
+
+
+def customize(topology, routing, weight='itime'):
+    """ This function returns the Hierarchy of a Topology with the given edge column of
+        a RoutingGraph as weights. The lower triangles are processed level by level of
+        the elimination tree, all the triangles of a level at once, so it is fast enough
+        to be run after every congestion refresh.
+
+        Precondition:
+            1- routing must have the same nodes as the graph the topology was built from.
+
+                    Time complexity: O(edges*log(edges) + triangles) """
+
+    if not np.array_equal(topology.node_ids, routing.node_ids):
+        raise ValueError('The routing graph does not have the nodes of the hierarchy')
+    m = topology.number_of_edges()
+    n = len(topology.node_ids)
+    rank = topology.rank
+    sources = np.repeat(np.arange(n, dtype=np.int64), np.diff(routing.offsets))
+    targets = routing.targets.astype(np.int64)
+    weights = getattr(routing, weight).astype(np.float64)
+    keep = sources != targets
+    sources, targets, weights = sources[keep], targets[keep], weights[keep]
+
+    going_up = rank[sources] < rank[targets]
+    low = np.where(going_up, sources, targets)
+    high = np.where(going_up, targets, sources)
+    edges = topology.sorted_edges[np.searchsorted(topology.sorted_keys, low * n + high)]
+
+    up = np.full(m, np.inf)
+    down = np.full(m, np.inf)
+    np.minimum.at(up, edges[going_up], weights[going_up])
+    np.minimum.at(down, edges[~going_up], weights[~going_up])
+    up_middle = np.full(m, -1, dtype=np.int32)
+    down_middle = np.full(m, -1, dtype=np.int32)
+
+    for level in range(len(topology.level_offsets) - 1):
+        begin, end = topology.level_offsets[level], topology.level_offsets[level+1]
+        bottom = topology.tri_bottom[begin:end]
+        xy, xz, yz = topology.tri_low[begin:end], topology.tri_high[begin:end], topology.tri_top[begin:end]
+        # y -> x -> z, and z -> x -> y
+        for candidates, column, middle in ((down[xy] + up[xz], up, up_middle),
+                                           (down[xz] + up[xy], down, down_middle)):
+            np.minimum.at(column, yz, candidates)
+            best = (candidates == column[yz]) & np.isfinite(candidates)
+            middle[yz[best]] = bottom[best]
+
+    return Hierarchy(topology, up, down, up_middle, down_middle)
+
+
+def unpack(hierarchy, path):
+    """ This function returns the path of the original graph (list of node numbers)
+        represented by a path of the hierarchy, with all its shortcuts unpacked. Each
+        round replaces every shortcut by its two edges at once, so there are as many
+        rounds as levels of nested shortcuts.
+
+                    Time complexity: O(path.size*log(edges)) """
+
+    topology = hierarchy.topology
+    n = len(topology.node_ids)
+    sources, targets = np.array(path[:-1], dtype=np.int64), np.array(path[1:], dtype=np.int64)
+    while len(sources):
+        going_up = topology.rank[sources] < topology.rank[targets]
+        low, high = np.where(going_up, sources, targets), np.where(going_up, targets, sources)
+        edges = topology.sorted_edges[np.searchsorted(topology.sorted_keys, low * n + high)]
+        middle = np.where(going_up, hierarchy.up_middle[edges], hierarchy.down_middle[edges])
+        shortcuts = middle != -1
+        if not shortcuts.any():
+            break
+        # each shortcut (source, target) becomes (source, middle), (middle, target)
+        copies = 1 + shortcuts
+        first = (np.cumsum(copies) - copies)[shortcuts]
+        sources, targets = np.repeat(sources, copies), np.repeat(targets, copies)
+        targets[first] = middle[shortcuts]
+        sources[first + 1] = middle[shortcuts]
+    return [int(path[0])] + targets.tolist()
+
+
+def ancestors(topology, node):
+    """ Returns the list of the ancestors of a node in the elimination tree (the node
+        included), from the node to the root, so in increasing rank.
+
+                    Time complexity: O(ancestors) """
+
+    chain = list()
+    parents = topology.parents
+    while node != -1:
+        chain.append(node)
+        node = parents[node]
+    return chain
+
+
+def upward_search(hierarchy, source, weights):
+    """ This function returns the search from source going up the hierarchy: the array
+        of the nodes it can reach (the ancestors of source in the elimination tree, as
+        the higher neighbours of a node are ancestors of it), and two arrays with the
+        distance and the predecessor (its position in the nodes array, -1 if there is
+        none) of each one. Only the ancestors are touched: their edges form a small
+        dense matrix, and each round relaxes at once the rows of the nodes whose distance
+        improved in the previous one, until none improves.
+
+                    Time complexity: O(ancestors*degree + relaxed rows*ancestors) """
+
+    topology = hierarchy.topology
+    nodes = np.array(ancestors(topology, int(source)), dtype=np.int64)
+    begin = topology.up_offsets[nodes].astype(np.int64)
+    degrees = topology.up_offsets[nodes + 1] - begin
+    positions = np.repeat(begin - np.cumsum(degrees) + degrees, degrees) + np.arange(degrees.sum())
+    rows = np.repeat(np.arange(len(nodes)), degrees)
+    # the position of an ancestor in nodes is the difference of depths
+    columns = topology.depth[source] - topology.depth[topology.up_targets[positions]]
+    edge_weights = weights[positions]
+    matrix = np.full((len(nodes), len(nodes)), np.inf)
+    matrix[rows, columns] = edge_weights
+
+    distance = np.full(len(nodes), np.inf)
+    distance[0] = 0.0
+    changed = np.zeros(1, dtype=np.int64)
+    while len(changed):  # only the rows of the nodes whose distance improved
+        candidates = (distance[changed, None] + matrix[changed]).min(axis=0)
+        changed = np.flatnonzero(candidates < distance)
+        distance[changed] = candidates[changed]
+    # the predecessor of a node is the first one with an edge that gives its distance
+    reached = distance[columns]
+    tight = np.flatnonzero((distance[rows] + edge_weights == reached) & np.isfinite(reached))[::-1]
+    previous = np.full(len(nodes), -1, dtype=np.int64)
+    previous[columns[tight]] = rows[tight]
+    return nodes, distance, previous
+
+
+def search_path(search, node):
+    """ Returns the path (list of node numbers) of an upward search from a node it
+        reached back to its source.
+
+                    Time complexity: O(path.size*log(ancestors)) """
+
+    nodes, _, previous = search
+    position = int(np.flatnonzero(nodes == node)[0])
+    path = list()
+    while position != -1:
+        path.append(int(nodes[position]))
+        position = int(previous[position])
+    return path
+
+
+def query(hierarchy, source, target):
+    """ This function returns the shortest path (list of node numbers) between two nodes
+        using the hierarchy, and the number of nodes visited. The path is None if there
+        is no path.
+
+                    Time complexity: O(ancestors*degree + relaxed rows*ancestors
+                                       + path.size*log(edges)) """
+
+    if source == target:
+        return [source], 1
+    forward = upward_search(hierarchy, source, hierarchy.forward)
+    backward = upward_search(hierarchy, target, hierarchy.backward)
+    visited = int(np.isfinite(forward[1]).sum() + np.isfinite(backward[1]).sum())
+    common, in_forward, in_backward = np.intersect1d(forward[0], backward[0], return_indices=True)
+    total = forward[1][in_forward] + backward[1][in_backward]
+    if len(total) == 0 or total.min() == np.inf:
+        return None, visited
+    meeting = int(common[np.argmin(total)])
+    return join_searches(hierarchy, meeting, forward, backward), visited
+
+
+def join_searches(hierarchy, meeting, forward, backward):
+    """ This function returns the path (list of node numbers) from the source of a
+        forward search to the source of a backward search through their meeting node,
+        with the shortcuts unpacked.
+
+                    Time complexity: O(path.size*log(edges)) """
+
+    up_path = search_path(forward, meeting)
+    up_path.reverse()
+    down_path = search_path(backward, meeting)
+    return unpack(hierarchy, up_path + down_path[1:])
+
+
+def many_to_many(hierarchy, sources, targets, paths=False):
+    """ This function returns the matrix (sources x targets) of the shortest path costs
+        between some nodes (given by their numbers), inf where there is no path, and if
+        paths is True also the list of lists of paths (None where there is no path). It
+        runs a single upward search from each source and from each target: the cost of
+        a pair is the minimum over the nodes reached by the backward searches (the
+        buckets) of the forward plus the backward distance.
+
+                    Time complexity: O((sources + targets)*(ancestors*degree + relaxed rows*ancestors)
+                                       + sources*targets*buckets) """
+
+    forward = [upward_search(hierarchy, source, hierarchy.forward) for source in sources]
+    backward = [upward_search(hierarchy, target, hierarchy.backward) for target in targets]
+    matrix = np.full((len(sources), len(targets)), np.inf)
+    meetings = np.zeros((len(sources), len(targets)), dtype=np.int64)
+    if len(sources) and len(targets):
+        buckets = np.unique(np.concatenate([nodes[np.isfinite(distance)] for nodes, distance, _ in backward]))
+        backward_distance = np.full((len(targets), len(buckets)), np.inf)
+        for j, (nodes, distance, _) in enumerate(backward):
+            reached = np.isfinite(distance)
+            backward_distance[j, np.searchsorted(buckets, nodes[reached])] = distance[reached]
+        for i, (nodes, distance, _) in enumerate(forward):
+            reached = np.isfinite(distance) & np.isin(nodes, buckets)
+            forward_distance = np.full(len(buckets), np.inf)
+            forward_distance[np.searchsorted(buckets, nodes[reached])] = distance[reached]
+            total = forward_distance + backward_distance
+            best = np.argmin(total, axis=1)
+            matrix[i] = total[np.arange(len(targets)), best]
+            meetings[i] = buckets[best]
+    if not paths:
+        return matrix
+    result = [[None if matrix[i, j] == np.inf else
+               join_searches(hierarchy, int(meetings[i, j]), forward[i], backward[j])
+               for j in range(len(targets))] for i in range(len(sources))]
+    return matrix, result
+
+
+def shortest_path(hierarchy, node_orig, node_dst, stats=None):
+    """ This function returns the shortest path (list of original node ids) between two
+        nodes (given by their original ids), None if there is no path. If stats is a
+        dictionary, the number of nodes visited is stored in stats['settled'].
+
+                    Time complexity: O(ancestors*degree + path.size*degree) """
+
+    topology = hierarchy.topology
+    source = int(np.searchsorted(topology.node_ids, node_orig))
+    target = int(np.searchsorted(topology.node_ids, node_dst))
+    path, visited = query(hierarchy, source, target)
+    if stats is not None:
+        stats['settled'] = visited
+    if path is None:
+        return None
+    return [int(topology.node_ids[i]) for i in path]
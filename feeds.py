@@ -0,0 +1,138 @@
+import os
+import json
+import codecs
+import hashlib
+import urllib.parse
+import urllib.request
+import urllib.error
+
+CHUNK_SIZE = 64 * 1024
+
+
+class Feed:
+    """ This class is a file that is downloaded again only when it has changed. It
+        sends conditional requests (ETag / If-Modified-Since; for file:// urls the size
+        and modification time of the file are compared) and it keeps a local copy of
+        the content in filename, if one is given, so a restart does not download it
+        again. The content is streamed in chunks while it arrives, and it is hashed
+        so a new download with the same content can be detected.
+
+        Attributes:
+            url: the url of the file (http(s):// or file://).
+            filename: the local copy (None to keep nothing on disk).
+            etag, last_modified: the validators of the last download.
+            digest: sha1 of the content of the last complete download.
+            changed: if the last complete download had a different content than the
+                previous one. """
+
+    def __init__(self, url, filename=None):
+        self.url = url
+        self.filename = filename
+        self.etag = None
+        self.last_modified = None
+        self.digest = None
+        self.changed = True
+        if filename is not None and os.path.exists(filename):
+            try:
+                with open(filename + '.meta') as file:
+                    meta = json.load(file)
+                self.etag, self.last_modified, self.digest = meta['etag'], meta['last_modified'], meta['digest']
+            except (OSError, ValueError, KeyError):
+                pass
+
+    def open(self, conditional=True):
+        """ Returns a generator of the chunks (bytes) of the content, None if it has not
+            changed since the last download (only when conditional). The validators,
+            the digest and the local copy are updated when the generator is exhausted.
+
+                    Time complexity: O(1) (plus the request) """
+
+        if urllib.parse.urlparse(self.url).scheme == 'file':
+            path = urllib.request.url2pathname(urllib.parse.urlparse(self.url).path)
+            stat = os.stat(path)
+            etag = '{}-{}'.format(stat.st_size, stat.st_mtime_ns)
+            if conditional and self.digest is not None and etag == self.etag:
+                return None
+            return self.stream(open(path, 'rb'), etag, None)
+
+        request = urllib.request.Request(self.url)
+        if conditional and self.digest is not None:
+            if self.etag is not None:
+                request.add_header('If-None-Match', self.etag)
+            if self.last_modified is not None:
+                request.add_header('If-Modified-Since', self.last_modified)
+        try:
+            response = urllib.request.urlopen(request)
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return None
+            raise
+        return self.stream(response, response.headers.get('ETag'), response.headers.get('Last-Modified'))
+
+    def stream(self, response, etag, last_modified):
+        digest = hashlib.sha1()
+        copy = open(self.filename + '.tmp', 'wb') if self.filename is not None else None
+        try:
+            with response:
+                while True:
+                    chunk = response.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    if copy is not None:
+                        copy.write(chunk)
+                    yield chunk
+        except BaseException:
+            if copy is not None:
+                copy.close()
+                os.remove(self.filename + '.tmp')
+            raise
+        # the whole content has been read: it becomes the current version
+        self.changed = digest.hexdigest() != self.digest
+        self.etag, self.last_modified, self.digest = etag, last_modified, digest.hexdigest()
+        if copy is not None:
+            copy.close()
+            os.replace(self.filename + '.tmp', self.filename)
+            with open(self.filename + '.meta.tmp', 'w') as file:
+                json.dump({'etag': etag, 'last_modified': last_modified, 'digest': self.digest}, file)
+            os.replace(self.filename + '.meta.tmp', self.filename + '.meta')
+
+    def local(self):
+        """ Returns a generator of the chunks of the local copy.
+
+            Precondition:
+                1- There must be a local copy (filename).
+
+                    Time complexity: O(1) """
+
+        with open(self.filename, 'rb') as file:
+            while True:
+                chunk = file.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+
+def as_feed(source):
+    """ Returns the source if it is a Feed, a Feed of it if it is a url. """
+
+    return source if isinstance(source, Feed) else Feed(source)
+
+
+def lines(chunks):
+    """ This function returns a generator of the text lines (with their end of line)
+        of a stream of utf-8 chunks, each line as soon as it has arrived.
+
+                    Time complexity: O(content size) """
+
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    pending = ''
+    for chunk in chunks:
+        pending += decoder.decode(chunk)
+        parts = pending.split('\n')
+        pending = parts.pop()
+        for part in parts:
+            yield part + '\n'
+    pending += decoder.decode(b'', final=True)
+    if pending:
+        yield pending
@@ -0,0 +1,234 @@
+import bisect
+import collections
+import csv
+import re
+import unicodedata
+import numpy as np
+
+# words that do not identify a street, so 'Sagrada Família' finds 'Carrer de la Sagrada Família'
+STOP_WORDS = {'carrer', 'c', 'avinguda', 'av', 'avda', 'passeig', 'pg', 'placa', 'pl',
+              'rambla', 'ronda', 'via', 'travessera', 'passatge', 'ptge', 'baixada', 'cami',
+              'gran', 'de', 'del', 'dels', 'la', 'les', 'el', 'els', 'l', 'd', 'i',
+              'calle', 'avenida', 'paseo', 'plaza', 'barcelona', 'catalonia', 'spain'}
+
+MIN_LENGTH = 4  # characters of a query for a prefix or fuzzy match, shorter ones only match exactly
+FUZZY_THRESHOLD = 0.6  # trigram similarity of a fuzzy match
+
+Place = collections.namedtuple('Place', 'name lat lon')
+
+
+def normalize(text):
+    """ This function returns the text in lower case, without accents, punctuation or
+        repeated spaces, so different spellings of a name are equal. The numbers are
+        kept, as they are part of an address.
+
+                    Time complexity: O(text.size) """
+
+    text = unicodedata.normalize('NFKD', text)
+    text = ''.join(c for c in text if not unicodedata.combining(c)).lower()
+    text = re.sub(r'[^a-z0-9 ]+', ' ', text)
+    return ' '.join(text.split())
+
+
+def core(text):
+    """ This function returns the normalized text without the words that do not identify
+        a street (street types, articles and the city).
+
+                    Time complexity: O(text.size) """
+
+    return ' '.join(word for word in normalize(text).split() if word not in STOP_WORDS)
+
+
+def trigrams(text):
+    """ Returns the set of trigrams of a text (with spaces around it).
+
+                    Time complexity: O(text.size) """
+
+    text = ' ' + text + ' '
+    return {text[i:i+3] for i in range(len(text) - 2)}
+
+
+def unique(places):
+    """ Returns the first of some places if all of them have the same name, None if
+        there are none or they have different names (the text is ambiguous). """
+
+    if len({place.name for place in places}) != 1:
+        return None
+    return places[0]
+
+
+class Geocoder:
+    """ This class is a local geocoder of the street names of a graph and of a list of
+        addresses. The names are normalized (accent insensitive) and indexed three ways:
+        a dictionary for the exact names, a sorted list for the prefixes and a trigram
+        index for the fuzzy matches.
+
+        Attributes:
+            places: list of Place.
+            exact: dictionary from a normalized name to the positions of its places.
+            keys: sorted list of (normalized name, position) for the prefix search.
+            grams: dictionary from a trigram to the set of keys that contain it. """
+
+    def __init__(self, places=()):
+        self.places = list()
+        self.exact = dict()
+        self.keys = list()
+        self.grams = collections.defaultdict(set)
+        self.add(places)
+
+    def add(self, places):
+        """ Adds places (list of Place) to the index.
+
+                    Time complexity: O(places*log(places)) """
+
+        for place in places:
+            position = len(self.places)
+            self.places.append(place)
+            for key in {normalize(place.name), core(place.name)}:
+                if key:
+                    self.exact.setdefault(key, list()).append(position)
+                    self.keys.append((key, position))
+                    for gram in trigrams(key):
+                        self.grams[gram].add(key)
+        self.keys.sort()
+
+    def prefix(self, text, limit=10):
+        """ Returns the places whose normalized name starts with the normalized text.
+
+                    Time complexity: O(log(places) + limit) """
+
+        text = normalize(text)
+        begin = bisect.bisect_left(self.keys, (text, -1))
+        result = list()
+        for key, position in self.keys[begin:]:
+            if not key.startswith(text) or len(result) == limit:
+                break
+            result.append(self.places[position])
+        return result
+
+    def fuzzy(self, text, threshold=FUZZY_THRESHOLD):
+        """ Returns the place whose name is most similar to the text (trigram Jaccard
+            similarity), None if none of them reaches the threshold or if places with
+            different names tie.
+
+                    Time complexity: O(names sharing a trigram with the text) """
+
+        text = core(text) or normalize(text)
+        text_grams = trigrams(text)
+        shared = collections.Counter()
+        for gram in text_grams:
+            shared.update(self.grams.get(gram, ()))
+        best, best_keys = threshold, list()
+        for key, count in shared.items():
+            similarity = count / (len(text_grams) + len(trigrams(key)) - count)
+            if similarity > best:
+                best, best_keys = similarity, [key]
+            elif similarity == best:
+                best_keys.append(key)
+        return unique([self.places[position] for key in best_keys for position in self.exact[key]])
+
+    def lookup(self, text):
+        """ Returns the place of a text: an exact match of its full name, else an exact
+            match without the street type, else the prefix match, else the best fuzzy
+            match, else None. The prefix and fuzzy matches need MIN_LENGTH characters and
+            a single candidate name, so a short or ambiguous text is a miss, and a text
+            with a number (a house number) only matches exactly, as the street names
+            have none.
+
+                    Time complexity: O(text.size) for an exact match. """
+
+        name, key = normalize(text), core(text)
+        for position in self.exact.get(name, ()):
+            if normalize(self.places[position].name) == name:
+                return self.places[position]
+        if key in self.exact:
+            return unique([self.places[position] for position in self.exact[key]])
+        if re.search('[0-9]', name) or len(key or name) < MIN_LENGTH:
+            return None
+        for prefix in (name, key):
+            if len(prefix) >= MIN_LENGTH:
+                places = self.prefix(prefix)
+                if places:
+                    return unique(places)
+        return self.fuzzy(text)
+
+    def geocode(self, text):
+        """ Returns the (latitude, longitude) of a text, as osmnx.geocoder.geocode,
+            None if it is not found.
+
+                    Time complexity: O(text.size) for an exact match. """
+
+        place = self.lookup(text)
+        if place is None:
+            return None
+        return (place.lat, place.lon)
+
+
+def street_places(graph):
+    """ This function returns a Place for each street name of the graph, placed on the
+        node of the street nearest to the center of all its nodes.
+
+        Precondition:
+            1- graph must be an osmnx graph (with the name attribute in some edges).
+
+                    Time complexity: O(edges) """
+
+    nodes = collections.defaultdict(set)
+    for node1, node2, data in graph.edges(data=True):
+        names = data.get('name')
+        if names is None:
+            continue
+        for name in names if type(names) == list else [names]:
+            nodes[name].update((node1, node2))
+    places = list()
+    for name, street_nodes in nodes.items():
+        coordinates = [(graph.nodes[node]['y'], graph.nodes[node]['x']) for node in street_nodes]
+        lat = sum(c[0] for c in coordinates) / len(coordinates)
+        lon = sum(c[1] for c in coordinates) / len(coordinates)
+        nearest = min(coordinates, key=lambda c: (c[0] - lat) ** 2 + (c[1] - lon) ** 2)
+        places.append(Place(name, nearest[0], nearest[1]))
+    return places
+
+
+def compact_street_places(compact):
+    """ This function returns the places of street_places for a graph in the binary
+        format (a storage.CompactGraph), reading its arrays instead of the edges of its
+        osmnx graph.
+
+                    Time complexity: O(edges) """
+
+    names = compact.tables['name']
+    codes = compact.name.tolist()
+    edge_u, edge_v = compact.edge_u.tolist(), compact.edge_v.tolist()
+    nodes = collections.defaultdict(set)
+    streets = dict()  # name value -> its street names
+    for code, node1, node2 in zip(codes, edge_u, edge_v):
+        if code == -1:
+            continue
+        if code not in streets:
+            streets[code] = names[code] if type(names[code]) == list else [names[code]]
+        for name in streets[code]:
+            nodes[name].update((node1, node2))
+    x, y = compact.x, compact.y
+    places = list()
+    for name, street_nodes in nodes.items():
+        street_nodes = list(street_nodes)
+        lat, lon = y[street_nodes], x[street_nodes]
+        nearest = int(np.argmin((lat - lat.mean()) ** 2 + (lon - lon.mean()) ** 2))
+        places.append(Place(name, float(lat[nearest]), float(lon[nearest])))
+    return places
+
+
+def read_addresses(ADDRESSES_FILENAME):
+    """ This function reads a list of addresses from a csv file with the columns
+        name, lat and lon (and a first line with the description).
+
+        Precondition:
+            1- The file must be a proper csv file.
+
+                    Time complexity: O(lines) """
+
+    with open(ADDRESSES_FILENAME, encoding='utf-8') as file:
+        reader = csv.reader(file)
+        next(reader)  # ignore first line with description
+        return [Place(name, float(lat), float(lon)) for name, lat, lon in reader]
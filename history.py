@@ -0,0 +1,137 @@
+import os
+import calendar
+import threading
+import numpy as np
+
+COLUMNS = {'time': np.int64, 'way_id': np.int64, 'current_status': np.int8, 'predicted_status': np.int8}
+
+
+def local_seconds(timestamp):
+    """ Returns the seconds since 1970-01-01 00:00 of a (naive, local) datetime, so the
+        hour of the day is (seconds // 3600) % 24.
+
+                    Time complexity: O(1) """
+
+    return calendar.timegm(timestamp.timetuple())
+
+
+class HistoryStore:
+    """ This class stores every congestion snapshot, one row per highway, so the history
+        of the congestions can be analysed. It is append-only and columnar: each day is
+        a directory (YYYY-MM-DD) with a file per column (see COLUMNS) of raw values, so
+        a day can be memory-mapped and scanned without reading the rest of the history.
+        The rows of a day are sorted by time, as they are only appended.
+
+        Attributes:
+            directory: the directory with a subdirectory for each day. """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def append(self, congestions, timestamp=None):
+        """ Appends a row for each highway of a CongestionSnapshot (the first congestion
+            of each way_id), at timestamp (by default the one of the snapshot).
+
+                    Time complexity: O(congestions) """
+
+        timestamp = timestamp if timestamp is not None else congestions.timestamp
+        rows = congestions.sorted_rows
+        columns = {'time': np.full(len(rows), local_seconds(timestamp), dtype=np.int64),
+                   'way_id': congestions.sorted_ids,
+                   'current_status': congestions.current_status[rows],
+                   'predicted_status': congestions.predicted_status[rows]}
+        dirname = os.path.join(self.directory, timestamp.strftime('%Y-%m-%d'))
+        with self.lock:
+            os.makedirs(dirname, exist_ok=True)
+            # a row is complete when it is in every column (see chunk): the rest of an
+            # append interrupted by a crash is removed before appending again
+            rows = self.rows(dirname)
+            for name, dtype in COLUMNS.items():
+                filename = os.path.join(dirname, name + '.bin')
+                if os.path.exists(filename) and os.path.getsize(filename) > rows * np.dtype(dtype).itemsize:
+                    os.truncate(filename, rows * np.dtype(dtype).itemsize)
+            for name, dtype in COLUMNS.items():
+                with open(os.path.join(dirname, name + '.bin'), 'ab') as file:
+                    file.write(np.ascontiguousarray(columns[name], dtype=dtype).tobytes())
+
+    def rows(self, dirname):
+        """ Returns the number of complete rows of the day in dirname. """
+
+        sizes = list()
+        for name, dtype in COLUMNS.items():
+            filename = os.path.join(dirname, name + '.bin')
+            sizes.append(os.path.getsize(filename) // np.dtype(dtype).itemsize if os.path.exists(filename) else 0)
+        return min(sizes)
+
+    def days(self):
+        """ Returns the sorted list of the days (YYYY-MM-DD) with history. """
+
+        return sorted(name for name in os.listdir(self.directory)
+                      if os.path.isdir(os.path.join(self.directory, name)))
+
+    def chunk(self, day):
+        """ Returns a dictionary with the columns of a day, memory-mapped (only the parts
+            that are used are read from disk).
+
+                    Time complexity: O(1) """
+
+        dirname = os.path.join(self.directory, day)
+        rows = self.rows(dirname)
+        if rows == 0:
+            return {name: np.zeros(0, dtype=dtype) for name, dtype in COLUMNS.items()}
+        return {name: np.memmap(os.path.join(dirname, name + '.bin'), dtype=dtype, mode='r', shape=(rows,))
+                for name, dtype in COLUMNS.items()}
+
+    def scan(self, begin=None, end=None, way_ids=None):
+        """ This function returns a generator of the rows with time in [begin, end) (two
+            datetimes, None for no limit) of the given highways (all if None), a dictionary
+            of columns for each day. Only the days in the range are opened and, inside a
+            day, the rows of the range are found with a binary search.
+
+                    Time complexity: O(days*log(rows of a day) + rows in the range) """
+
+        for day in self.days():
+            if begin is not None and day < begin.strftime('%Y-%m-%d'):
+                continue
+            if end is not None and day > end.strftime('%Y-%m-%d'):
+                break
+            columns = self.chunk(day)
+            first = 0 if begin is None else np.searchsorted(columns['time'], local_seconds(begin), 'left')
+            last = len(columns['time']) if end is None else np.searchsorted(columns['time'], local_seconds(end), 'left')
+            if first >= last:
+                continue
+            columns = {name: column[first:last] for name, column in columns.items()}
+            if way_ids is not None:
+                selected = np.isin(columns['way_id'], way_ids)
+                columns = {name: column[selected] for name, column in columns.items()}
+            yield columns
+
+    def hour_averages(self, way_ids, begin=None, end=None):
+        """ This function returns an array (way_ids x 24) with the average current status
+            of each highway at each hour of the day in [begin, end), not counting the rows
+            without information (status 0); NaN if there is no row.
+
+                    Time complexity: O(days*log(rows of a day) + rows in the range) """
+
+        way_ids = np.asarray(way_ids, dtype=np.int64)
+        sums = np.zeros((len(way_ids), 24))
+        counts = np.zeros((len(way_ids), 24))
+        if len(way_ids) == 0:
+            return sums
+        order = np.argsort(way_ids)
+        sorted_ids = way_ids[order]
+        for columns in self.scan(begin, end):
+            status = np.asarray(columns['current_status'])
+            ids = np.asarray(columns['way_id'])
+            positions = np.searchsorted(sorted_ids, ids)
+            positions[positions == len(way_ids)] = 0
+            known = (sorted_ids[positions] == ids) & (status != 0)
+            rows = order[positions[known]]
+            hours = (np.asarray(columns['time'])[known] // 3600) % 24
+            cells = rows * 24 + hours
+            sums += np.bincount(cells, weights=status[known], minlength=sums.size).reshape(sums.shape)
+            counts += np.bincount(cells, minlength=counts.size).reshape(counts.shape)
+        with np.errstate(invalid='ignore'):
+            return np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
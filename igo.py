@@ -1,29 +1,151 @@
 import osmnx as ox
-import networkx as nx
-from staticmap import StaticMap, Line
+from staticmap import Line, Polygon, CircleMarker
+from shapely.geometry import LineString, Point
+from shapely.ops import unary_union
 import pickle
+import hashlib
+import os
+import io
 import csv
-import urllib
+import tempfile
 import haversine
 import collections
+import datetime
+import time
+import threading
+import multiprocessing
 import sklearn
+import numpy as np
+import routing
+import cch
+import spatial
+import storage
+import geocoding
+import tiles
+import feeds
+import overlay
+import metrics
 
 Highway = collections.namedtuple('Highway', 'way_id description coordinates')  # Tram
 Congestion = collections.namedtuple(
     'Congestion', 'congestion_id data current_status predicted_status')
+# The edges of a graph as columns: the position of each edge (node1, node2) is its
+# row. highway holds positions in highway_types, and data the attribute dictionaries
+# of the edges, to write the results back.
+EdgeTable = collections.namedtuple(
+    'EdgeTable', 'edges index data highway highway_types maxspeed length congestion')
+
+# speed limit (km/h) of the streets without maxspeed, by type of street
+SPEED_LIMITS = {'motorway': 120, 'motorway_link': 120, 'trunk': 90, 'trunk_link': 90,
+                'primary': 50, 'primary_link': 50, 'secondary': 40, 'secondary_link': 40,
+                'tertiary': 30, 'tertiary_link': 30, 'residential': 30, 'residential_link': 30,
+                'unclassified': 30, 'living_street': 20, 'living_street_link': 20}
+DEFAULT_SPEED_LIMIT = 30
+
+
+class CongestionSnapshot:
+    """ This class stores the congestions downloaded at a certain moment. The congestions
+        are indexed by their id and their fields are stored in arrays (columns), so the
+        status of a highway, or of many highways at once, can be found without scanning
+        the whole list. It can still be used as the list of congestions it comes from.
+
+        Attributes:
+            ids, data, current_status, predicted_status: the columns of the congestions.
+            index: dictionary from congestion_id to its position in the columns.
+            timestamp: the moment the snapshot was taken.
+            version: a hash of the content, equal snapshots have equal versions. """
+
+    def __init__(self, congestions, timestamp=None):
+        """ Builds the snapshot from an iterable of Congestion.
+
+                    Time complexity: O(congestions*log(congestions)) """
+
+        congestions = list(congestions)
+        self.ids = np.array([c.congestion_id for c in congestions], dtype=np.int64)
+        self.data = np.array([c.data for c in congestions], dtype=np.int64)
+        self.current_status = np.array([c.current_status for c in congestions], dtype=np.int8)
+        self.predicted_status = np.array([c.predicted_status for c in congestions], dtype=np.int8)
+        self.index = dict()
+        for row, congestion_id in enumerate(self.ids.tolist()):
+            self.index.setdefault(congestion_id, row)  # the first one wins, as in a list
+        # sorted ids (first occurrence of each one) for the vectorized lookups
+        self.sorted_ids, self.sorted_rows = np.unique(self.ids, return_index=True)
+        self.timestamp = timestamp if timestamp is not None else datetime.datetime.now()
+        digest = hashlib.sha1()
+        for column in (self.ids, self.data, self.current_status, self.predicted_status):
+            digest.update(column.tobytes())
+        self.version = digest.hexdigest()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, row):
+        return Congestion(int(self.ids[row]), int(self.data[row]),
+                          int(self.current_status[row]), int(self.predicted_status[row]))
+
+    def __iter__(self):
+        for row in range(len(self.ids)):
+            yield self[row]
+
+    def status(self, way_id, predicted=False):
+        """ Returns the current (or predicted) status of a highway, 0 if there is no information.
+
+                    Time complexity: O(1) """
+
+        row = self.index.get(way_id)
+        if row is None:
+            return 0
+        column = self.predicted_status if predicted else self.current_status
+        return int(column[row])
+
+    def statuses(self, way_ids, predicted=False):
+        """ Returns an array with the current (or predicted) status of each of the given
+            highways, 0 for the ones with no information.
+
+                    Time complexity: O(way_ids*log(congestions)) """
+
+        way_ids = np.asarray(way_ids, dtype=np.int64)
+        column = self.predicted_status if predicted else self.current_status
+        result = np.zeros(len(way_ids), dtype=np.int8)
+        if len(self.sorted_ids) == 0:
+            return result
+        positions = np.searchsorted(self.sorted_ids, way_ids)
+        positions[positions == len(self.sorted_ids)] = 0
+        found = self.sorted_ids[positions] == way_ids
+        result[found] = column[self.sorted_rows[positions[found]]]
+        return result
+
+
+def as_snapshot(congestions):
+    """ This function returns the congestions as a CongestionSnapshot. If they already
+        are one it returns them as they are, so it can be called on both lists and snapshots.
+
+                    Time complexity: O(1) for a snapshot, O(congestions*log(congestions)) for a list. """
+
+    if isinstance(congestions, CongestionSnapshot):
+        return congestions
+    return CongestionSnapshot(congestions)
 
 
-def exists_graph(GRAPH_FILENAME):
+def exists_graph(GRAPH_FILENAME, SOURCE_FILENAME=None):
     """ This boolean function returns if the graph is already downloaded
-        with a certain filename. It tries to open it.
+        with a certain filename. If it is a graph in the binary format (a directory,
+        see save_graph_binary) it must have the current format version and, if a
+        source file is given, it must have been converted from its current version.
+        A pickled graph must be newer than the source file, if there is one.
 
                     Time complexity: O(1). """
 
+    if os.path.isdir(GRAPH_FILENAME):
+        return storage.is_current(GRAPH_FILENAME, SOURCE_FILENAME)
     try:
-        file = open(GRAPH_FILENAME, 'rb')
-        return True
-    except:
+        with open(GRAPH_FILENAME, 'rb') as file:
+            pass
+    except OSError:
         return False
+    if SOURCE_FILENAME is not None and os.path.exists(SOURCE_FILENAME):
+        return os.path.getmtime(GRAPH_FILENAME) >= os.path.getmtime(SOURCE_FILENAME)
+    return True
 
 
 def download_graph(PLACE):
@@ -47,17 +169,110 @@ def save_graph(graph, GRAPH_FILENAME):
         pickle.dump(graph, file)
 
 
+def save_graph_binary(graph, GRAPH_FILENAME, SOURCE_FILENAME=None):
+    """ This function saves the graph in the binary format: a directory with the node
+        coordinates and the edges in arrays that can be memory-mapped, and the string
+        attributes we need (highway, maxspeed, name) interned in tables.
+
+                    Time complexity: O(nodes + edges). """
+
+    storage.save_compact_graph(graph, GRAPH_FILENAME, SOURCE_FILENAME)
+
+
+def convert_graph(PICKLE_FILENAME, GRAPH_FILENAME):
+    """ This function converts a graph saved with save_graph to the binary format.
+
+        Precondition:
+            1- There must be a graph saved with pickle in PICKLE_FILENAME.
+
+                    Time complexity: O(nodes + edges). """
+
+    storage.convert_graph(PICKLE_FILENAME, GRAPH_FILENAME)
+
+
 def load_graph(GRAPH_FILENAME):
-    """ This function returns the graph we previously stored.
+    """ This function returns the graph we previously stored, either with pickle or in
+        the binary format. The topology of its contraction hierarchy (see
+        load_cch_topology) is stored in graph.graph['cch_topology'] and its spatial
+        index (see load_spatial_index) in graph.graph['spatial_index'].
+        A graph in the binary format is returned as a storage.LazyGraph: the indexes,
+        the lean topology and the geocoder are built from its arrays, and its networkx
+        graph (with the geometries) is only built if it is needed (see storage.as_networkx).
 
         Precondition:
             1- There must be a graph saved with this file name.
 
                     Time complexity: O(1). """
 
-    with open(GRAPH_FILENAME, 'rb') as file:
-        graph = pickle.load(file)
-        return graph
+    if os.path.isdir(GRAPH_FILENAME):
+        graph = storage.LazyGraph(storage.load_compact_graph(GRAPH_FILENAME))
+    else:
+        with open(GRAPH_FILENAME, 'rb') as file:
+            graph = pickle.load(file)
+    graph.graph['cch_topology'] = load_cch_topology(graph, GRAPH_FILENAME)
+    graph.graph['spatial_index'] = load_spatial_index(graph, GRAPH_FILENAME)
+    return graph
+
+
+def load_spatial_index(graph, GRAPH_FILENAME):
+    """ This function returns the spatial index of the graph nodes and edges, used to
+        snap coordinates. It is stored on disk next to the graph file and only built
+        again when the graph file changes.
+
+        Precondition:
+            1- graph must be the graph saved in GRAPH_FILENAME.
+
+        Time complexity: O(file size) if it is already stored, else O(edges*log(edges)). """
+
+    filename = GRAPH_FILENAME + '.index'
+    fingerprint = file_fingerprint(GRAPH_FILENAME)
+    index = load_cached(filename, fingerprint)
+    if index is None:
+        if isinstance(graph, storage.LazyGraph):
+            index = spatial.compact_spatial_index(graph.compact)
+        else:
+            index = spatial.build_spatial_index(graph)
+        save_cached(filename, fingerprint, index)
+    return index
+
+
+@metrics.timed('snap')
+def nearest_nodes(graph, x, y):
+    """ This function returns a list with the nearest node of each point, given their
+        longitudes x and latitudes y (lists). It uses the spatial index of the graph
+        if it has one, otherwise osmnx.
+
+        Precondition:
+            1- x and y must have the same size.
+
+        Time complexity: O(points*log(nodes)) with the spatial index. """
+
+    if 'spatial_index' in graph.graph:
+        return graph.graph['spatial_index'].nearest_nodes(x, y).tolist()
+    return list(ox.distance.nearest_nodes(storage.as_networkx(graph), x, y))
+
+
+def load_cch_topology(graph, GRAPH_FILENAME):
+    """ This function returns the metric independent part of the contraction hierarchy
+        of the graph (node order and shortcuts). It is stored on disk next to the graph
+        file and only computed again when the graph file changes.
+
+        Precondition:
+            1- graph must be the graph saved in GRAPH_FILENAME.
+
+        Time complexity: O(file size) if it is already stored, else the one
+                    of cch.build_topology. """
+
+    filename = GRAPH_FILENAME + '.cch'
+    fingerprint = file_fingerprint(GRAPH_FILENAME)
+    topology = load_cached(filename, fingerprint)
+    if topology is None:
+        if isinstance(graph, storage.LazyGraph):
+            topology = cch.compact_topology(graph.compact)
+        else:
+            topology = cch.build_topology(graph)
+        save_cached(filename, fingerprint, topology)
+    return topology
 
 
 def plot_graph(graph):
@@ -70,12 +285,65 @@ def plot_graph(graph):
 
                     Time complexity: O(1). """
 
-    ox.plot_graph(graph, show=False, save=True, filepath='barcelona.png')
+    ox.plot_graph(storage.as_networkx(graph), show=False, save=True, filepath='barcelona.png')
+
+
+def stream_highways(lines):
+    """ This function returns a generator of the highways (Highway) of the lines of the
+        highways file, each one parsed as soon as its line arrives.
 
+        Precondition:
+            1- The lines must be the ones of the highways .csv file.
+
+                    Time complexity: O(lines). """
 
-def download_highways(HIGHWAYS_URL):
+    reader = csv.reader(lines, delimiter=',', quotechar='"')
+    next(reader)  # ignore first line with description
+    for line in reader:
+        way_id, description, coordinates = line
+        coordinates = coordinates.split(',')
+        yield Highway(int(way_id), description, [float(coord) for coord in coordinates])
+
+
+def download_feed(source, parse, previous=None):
+    """ This function downloads a feed (a url, or a feeds.Feed to make conditional
+        requests and keep a local copy) and returns parse of its lines, streaming
+        them while they arrive. If previous (the result of the last download) is given
+        and the feed has not changed, it returns previous without parsing anything;
+        if it has not changed and the feed has a local copy, the parsed result stored
+        next to it is returned.
+
+                    Time complexity: O(lines), O(1) if it has not changed. """
+
+    feed = feeds.as_feed(source)
+    begin = time.perf_counter()
+    chunks = feed.open(conditional=previous is not None or feed.filename is not None)
+    if chunks is None:  # not modified
+        metrics.count('feed_not_modified')
+        if previous is not None:
+            return previous
+        parsed = load_cached(feed.filename + '.parsed', feed.digest)
+        if parsed is not None:
+            return parsed
+        chunks = feed.local()
+    # the lines are parsed while they arrive: the time waiting for the chunks is the
+    # download stage and the rest the parse one
+    chunks = metrics.TimedIterator('download', chunks, time.perf_counter() - begin)
+    begin = time.perf_counter()
+    result = parse(feeds.lines(chunks))
+    metrics.observe('parse', time.perf_counter() - begin - (chunks.elapsed - chunks.initial))
+    if previous is not None and not feed.changed:  # downloaded again, but the same content
+        return previous
+    if feed.filename is not None:
+        save_cached(feed.filename + '.parsed', feed.digest, result)
+    return result
+
+
+def download_highways(HIGHWAYS_URL, previous=None):
     """ Using the urllib library, this function downloads the highways data. It returns
-        a list containing information of each of Barcelona's highways.
+        a list containing information of each of Barcelona's highways. HIGHWAYS_URL can
+        be a url (also file://) or a feeds.Feed, and previous is returned if the feed
+        has not changed (see download_feed).
 
         Precondition:
             1- The file must contain data regarding highways in the city.
@@ -83,17 +351,7 @@ def download_highways(HIGHWAYS_URL):
 
                     Time complexity: O(lines). """
 
-    with urllib.request.urlopen(HIGHWAYS_URL) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter=',', quotechar='"')
-        next(reader)  # ignore first line with description
-        highways = list()
-        for line in reader:
-            way_id, description, coordinates = line
-            coordinates = coordinates.split(',')
-            highways.append(Highway(int(way_id), description,
-                                    [float(coord) for coord in coordinates]))
-        return highways
+    return download_feed(HIGHWAYS_URL, lambda lines: list(stream_highways(lines)), previous)
 
 
 def plot_highways(highways, highways_file, SIZE):
@@ -106,20 +364,44 @@ def plot_highways(highways, highways_file, SIZE):
 
                     Time complexity: O(highways.size*max(highways.coordinates.size)). """
 
-    map = StaticMap(SIZE, SIZE)
+    map = tiles.CachedStaticMap(SIZE, SIZE)
     for highway in highways:
-        it = 0
-        while(it < len(highway.coordinates) - 3):
-            map.add_line(Line(((highway.coordinates[it], highway.coordinates[it+1]),
-                               (highway.coordinates[it+2], highway.coordinates[it+3])), 'blue', 3))
-            it += 2
+        coordinates = highway_coordinates(highway)
+        if len(coordinates) > 1:
+            map.add_line(Line(coordinates, 'blue', 3))
     image = map.render()
     image.save(highways_file)
 
 
-def download_congestions(CONGESTIONS_URL):
+def highway_coordinates(highway):
+    """ Returns the list of (longitude, latitude) of a highway, to draw it as a single line.
+
+                    Time complexity: O(highway.coordinates.size) """
+
+    return list(zip(highway.coordinates[0::2], highway.coordinates[1::2]))
+
+
+def stream_congestions(lines):
+    """ This function returns a generator of the congestions (Congestion) of the lines
+        of the congestions file, each one parsed as soon as its line arrives.
+
+        Precondition:
+            1- The lines must be the ones of the congestions .csv file.
+
+                    Time complexity: O(lines). """
+
+    reader = csv.reader(lines, delimiter='#', quotechar='"')
+    next(reader)  # ignore first line with description
+    for line in reader:
+        congestion_id, data, current_status, predicted_status = line
+        yield Congestion(int(congestion_id), int(data), int(current_status), int(predicted_status))
+
+
+def download_congestions(CONGESTIONS_URL, previous=None):
     """ Using the urllib library it downloads the congestions data. This function returns a
-        list containing information of the congestions data in some highways.
+        CongestionSnapshot containing information of the congestions data in some highways.
+        CONGESTIONS_URL can be a url (also file://) or a feeds.Feed, and previous is
+        returned (the same object) if the feed has not changed (see download_feed).
 
         Precondition:
             1- The file must contain data regarding congestions in the city.
@@ -127,16 +409,8 @@ def download_congestions(CONGESTIONS_URL):
 
             Time complexity: O(lines). """
 
-    with urllib.request.urlopen(CONGESTIONS_URL) as response:
-        lines = [l.decode('utf-8') for l in response.readlines()]
-        reader = csv.reader(lines, delimiter='#', quotechar='"')
-        next(reader)  # ignore first line with description
-        congestions = list()
-        for line in reader:
-            congestion_id, data, current_status, predicted_status = line
-            congestions.append(Congestion(int(congestion_id), int(
-                data), int(current_status), int(predicted_status)))
-        return congestions
+    return download_feed(CONGESTIONS_URL, lambda lines: CongestionSnapshot(stream_congestions(lines)),
+                         previous)
 
 
 def plot_congestions(highways, congestions, congestions_file, SIZE):
@@ -144,20 +418,17 @@ def plot_congestions(highways, congestions, congestions_file, SIZE):
         with just the highways colored depending on their congestion status.
 
         Preconditions:
-            1- A list of highways and a list of congestions(with their corresponding information) are given.
+            1- A list of highways and a list (or snapshot) of congestions(with their corresponding information) are given.
             2- congestions_file must be in a correct format
 
-                    Time complexity: O(highways.size*congestions.size) """
+                    Time complexity: O(highways.size*max(highways.coordinates.size)) """
 
-    map = StaticMap(SIZE, SIZE)
-    for highway in highways:
-        highway_status = search_congestion_status(highway.way_id, congestions)
-        color = conversion(highway_status)
-        it = 0
-        while(it < len(highway.coordinates) - 3):
-            map.add_line(Line(((highway.coordinates[it], highway.coordinates[it+1]),
-                               (highway.coordinates[it+2], highway.coordinates[it+3])), color, 3))
-            it += 2
+    map = tiles.CachedStaticMap(SIZE, SIZE)
+    statuses = as_snapshot(congestions).statuses([highway.way_id for highway in highways])
+    for highway, highway_status in zip(highways, statuses):
+        coordinates = highway_coordinates(highway)
+        if len(coordinates) > 1:
+            map.add_line(Line(coordinates, conversion(highway_status), 3))
     image = map.render()
     image.save(congestions_file)
 
@@ -192,10 +463,12 @@ def search_congestion_status(way_id, congestions):
         information has been found).
 
         Preconditions:
-            1- congestions must be a proper list with the congestions information.
+            1- congestions must be a proper list (or snapshot) with the congestions information.
 
-                    Time complexity: O(congestions.size). """
+                    Time complexity: O(congestions.size), O(1) for a CongestionSnapshot. """
 
+    if isinstance(congestions, CongestionSnapshot):
+        return congestions.status(way_id)
     for congestion in congestions:
         if congestion.congestion_id == way_id:
             return congestion.current_status
@@ -233,25 +506,12 @@ def calculate_max_speed(type_of_street):
 
 
 def speed_limit(street):
-    """ Function that returns the speed limit of an edge depending on its type of street.
-
-        Preconditions:
-            1- The parameter given must contain a proper types of street
+    """ Function that returns the speed limit of an edge depending on its type of street
+        (DEFAULT_SPEED_LIMIT for the types not in SPEED_LIMITS).
 
                 Time complexity: O(1)"""
 
-    if street == 'residential' or 'residential_link':
-        return 30
-    if street == 'living_sreet' or 'living_sreet_link':
-        return 20
-    if street == 'primary' or 'primary_link':
-        return 50
-    if street == 'secondary' or 'secondary_link':
-        return 40
-    if street == 'tertiary' or 'tertiary_link':
-        return 30
-    if street == 'trunk' or 'trunk_link':
-        return 90
+    return SPEED_LIMITS.get(street, DEFAULT_SPEED_LIMIT)
 
 
 def max_of_list(list_of_velocities_str):
@@ -269,25 +529,99 @@ def max_of_list(list_of_velocities_str):
     return max(list_of_velocities_int)
 
 
+def parse_maxspeed(maxspeed):
+    """ This function returns the speed limit (km/h) of a maxspeed tag: a number in
+        string format, or a list of them (the maximum is taken). It returns None if
+        the tag has no number (for example 'ES:urban').
+
+                    Time complexity: O(1) """
+
+    if type(maxspeed) == list:
+        speeds = [parse_maxspeed(velocity) for velocity in maxspeed]
+        speeds = [speed for speed in speeds if speed is not None]
+        return max(speeds) if speeds else None
+    try:
+        return int(maxspeed)
+    except (TypeError, ValueError):
+        digits = ''.join(c for c in str(maxspeed).split(';')[0] if c.isdigit())
+        return int(digits) if digits else None
+
+
+def resolve_maxspeed(maxspeed, highway):
+    """ This function returns the speed limit of an edge: its maxspeed tag if it has
+        one with a number, otherwise the limit of its type of street.
+
+                    Time complexity: O(1) """
+
+    speed = parse_maxspeed(maxspeed) if maxspeed is not None else None
+    if speed is None:
+        speed = calculate_max_speed(highway) if highway is not None else DEFAULT_SPEED_LIMIT
+    return speed
+
+
+def hashable(value):
+    return tuple(value) if type(value) == list else value
+
+
+def edge_table(graph):
+    """ This function extracts the highway, speed limit, length and congestion of
+        all the edges of a graph into an EdgeTable, in a single pass. The speed limits
+        are resolved once per different (maxspeed, highway) pair and looked up for the
+        rest of the edges.
+
+        Precondition:
+            1- graph must be a directed graph with the length and highway edge attributes.
+
+                    Time complexity: O(edges) """
+
+    edges, data = list(), list()
+    highway_types, highway_codes, highway = dict(), list(), list()
+    resolved, maxspeed, length, congestion = dict(), list(), list(), list()
+    for node1, node2, edge in graph.edges(data=True):
+        edges.append((node1, node2))
+        data.append(edge)
+        highway_type = hashable(edge.get('highway'))
+        if highway_type not in highway_types:
+            highway_types[highway_type] = len(highway_codes)
+            highway_codes.append(edge.get('highway'))
+        highway.append(highway_types[highway_type])
+        key = (hashable(edge.get('maxspeed')), highway_type)
+        if key not in resolved:
+            resolved[key] = resolve_maxspeed(edge.get('maxspeed'), edge.get('highway'))
+        maxspeed.append(resolved[key])
+        length.append(edge.get('length', 0))
+        congestion.append(edge.get('congestion', 0))
+    return EdgeTable(edges, {edge: i for i, edge in enumerate(edges)}, data,
+                     np.array(highway, dtype=np.int32), highway_codes,
+                     np.array(maxspeed, dtype=np.float64), np.array(length, dtype=np.float64),
+                     np.array(congestion, dtype=np.int8))
+
+
+def write_edge_attributes(table, **columns):
+    """ This function writes columns (arrays with a value per edge of the table) back
+        to the edges of the graph, as attributes with the names of the arguments, in a
+        single pass over the edges.
+
+                    Time complexity: O(edges*columns) """
+
+    names = list(columns)
+    for edge, values in zip(table.data, zip(*[column.tolist() for column in columns.values()])):
+        edge.update(zip(names, values))
+
+
 def fill_all_maxspeeds(graph):
-    """ This function assigns a maxspeed to all edges. We have three cases,
-        if the edge has no maxspeed, if there is a list of maxspeeds
-        and if there is only one maxspeed. It's important to notice that this
-        attribute is initially of string class(so we have to convert it).
+    """ This function assigns a maxspeed (an integer in km/h) to all edges: the one of
+        its maxspeed tag (the maximum if there is a list), or the speed limit of its
+        type of street if it has none (see edge_table).
 
         Precondition:
             1- The parameter given must be in the correct format and have the correct attributes.
 
                     Time Complexity: O(edges)"""
 
-    for node1, info1 in graph.nodes.items():
-        for node2, edge in graph.adj[node1].items():
-            if not has_maxspeed(edge):  # if the edge has no maxspeed
-                edge['maxspeed'] = calculate_max_speed(edge['highway'])
-            elif type(edge['maxspeed']) == list:
-                edge['maxspeed'] = max_of_list(edge['maxspeed'])
-            else:
-                edge['maxspeed'] = int(edge['maxspeed'])
+    table = edge_table(graph)
+    write_edge_attributes(table, maxspeed=table.maxspeed.astype(np.int64))
+    return table
 
 
 def propagate_congestion(graph, shortest_path, status):
@@ -307,36 +641,257 @@ def propagate_congestion(graph, shortest_path, status):
             it += 1
 
 
-def propagate_congestion_for_all_edges(graph, highways, congestions):
+def highway_path(graph, highway):
+    """ This function returns the shortest path(list of nodes) between the nearest node
+        of the beginning of the highway and the nearest node of the end of the highway.
+        It returns None if there is no such path.
+
+        Precondition:
+            1- The graph given must be a directed graph with the length attribute.
+
+        Time complexity: O(nodes + edges*log(nodes)) """
+
+    node_org, node_dst = nearest_nodes(
+        graph, [highway.coordinates[0], highway.coordinates[len(highway.coordinates)-2]],
+        [highway.coordinates[1], highway.coordinates[len(highway.coordinates) - 1]])
+    return ox.shortest_path(storage.as_networkx(graph), node_org, node_dst)
+
+
+def build_highway_edges(graph, highways):
+    """ This function resolves each highway to the list of graph edges (pairs of nodes)
+        it covers, which is the shortest path between its nearest extreme nodes. It
+        returns a dictionary from way_id to its list of edges (empty if there is no path).
+        As the highways geometry is static this only has to be done once per graph.
+        All the extreme points are snapped at once. The paths of a graph in the binary
+        format are found on the routing graph of its lean topology, by length, without
+        building its networkx graph.
+
+        Preconditions:
+            1- The graph given must be a directed graph with the length attribute.
+            2- highways must be in correct format.
+
+        Time complexity: O(highways*edges*log(nodes)) """
+
+    x, y = list(), list()
+    for highway in highways:
+        x += [highway.coordinates[0], highway.coordinates[len(highway.coordinates)-2]]
+        y += [highway.coordinates[1], highway.coordinates[len(highway.coordinates)-1]]
+    nodes = nearest_nodes(graph, x, y)
+
+    if isinstance(graph, storage.LazyGraph):
+        routing_graph = lean_topology(graph).routing
+        path = lambda node1, node2: routing.shortest_path(routing_graph, node1, node2, weight='length')
+    else:
+        path = lambda node1, node2: ox.shortest_path(graph, node1, node2)
+
+    highway_edges = dict()
+    for it, highway in enumerate(highways):
+        shortest_path = path(nodes[2*it], nodes[2*it+1])
+        edges = highway_edges.setdefault(highway.way_id, list())
+        if type(shortest_path) == list:
+            edges.extend(zip(shortest_path[:-1], shortest_path[1:]))
+    return highway_edges
+
+
+def invert_highway_edges(highways, highway_edges):
+    """ This function returns a dictionary from each covered edge to the list of way_ids
+        of the highways that cover it, in the same order as in the highways list.
+
+        Preconditions:
+            1- highway_edges must have been built from the same highways list.
+
+        Time complexity: O(highways + covered edges) """
+
+    edge_highways = dict()
+    for highway in highways:
+        for edge in highway_edges.get(highway.way_id, []):
+            way_ids = edge_highways.setdefault(edge, list())
+            if highway.way_id not in way_ids:
+                way_ids.append(highway.way_id)
+    return edge_highways
+
+
+def file_fingerprint(filename):
+    """ This function returns a value that changes whenever the file changes
+        (its size and modification time). For a graph in the binary format it is
+        the one of its meta file, which is written last.
+
+        Precondition:
+            1- The file must exist.
+
+                    Time complexity: O(1) """
+
+    if os.path.isdir(filename):
+        filename = os.path.join(filename, storage.META_FILENAME)
+    stat = os.stat(filename)
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+def highways_fingerprint(highways):
+    """ This function returns a hash of the highways content, so we can know if
+        the highways file has changed since a mapping was computed.
+
+                    Time complexity: O(highways.size*max(highways.coordinates.size)) """
+
+    digest = hashlib.sha1()
+    for highway in highways:
+        digest.update(repr(tuple(highway)).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def load_cached(filename, fingerprint):
+    """ This function returns the data stored with save_cached in the file, or None
+        if there is no such file or it was saved for another fingerprint (stale).
+
+                    Time complexity: O(file size) """
+
+    try:
+        with open(filename, 'rb') as file:
+            stored_fingerprint, data = pickle.load(file)
+    except (OSError, EOFError, pickle.UnpicklingError, ValueError):
+        return None
+    if stored_fingerprint != fingerprint:
+        return None
+    return data
+
+
+def replace_file(filename, write):
+    """ This function writes a file atomically: write(file) fills a temporary file of
+        the same directory, which then replaces filename. Each writer gets a temporary
+        file with its own name, so concurrent writers of the same file never mix.
+
+                    Time complexity: the one of write """
+
+    descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(filename) or '.')
+    try:
+        with os.fdopen(descriptor, 'wb') as file:
+            write(file)
+        os.replace(temporary, filename)
+    except BaseException:
+        os.remove(temporary)
+        raise
+
+
+def save_cached(filename, fingerprint, data):
+    """ This function stores some data together with the fingerprint of the sources
+        it was computed from. The file is replaced atomically so a reader never sees
+        it half written.
+
+                    Time complexity: O(data size) """
+
+    replace_file(filename, lambda file: pickle.dump((fingerprint, data), file))
+
+
+def load_highway_edges(graph, highways, GRAPH_FILENAME):
+    """ This function returns the highway to edges mapping of build_highway_edges.
+        It is stored on disk next to the graph file and it is only computed again
+        when the graph file or the highways have changed.
+
+        Preconditions:
+            1- graph must be the graph saved in GRAPH_FILENAME.
+            2- highways must be in correct format.
+
+        Time complexity: O(file size) if it is already stored, else the one
+                    of build_highway_edges. """
+
+    filename = GRAPH_FILENAME + '.highways'
+    fingerprint = (file_fingerprint(GRAPH_FILENAME), highways_fingerprint(highways))
+    highway_edges = load_cached(filename, fingerprint)
+    if highway_edges is None:
+        highway_edges = build_highway_edges(graph, highways)
+        save_cached(filename, fingerprint, highway_edges)
+    return highway_edges
+
+
+def save_igraph(igraph, highways, congestions, graph, GRAPH_FILENAME, IGRAPH_FILENAME):
+    """ This function checkpoints a built iGraph, together with the highways and
+        congestions it reflects, so a restarted bot can serve from it right away.
+        The indexes shared with the graph (contraction hierarchy topology, spatial
+        index and lean topology) are not stored again, load_igraph takes them from
+        the graph.
+        The file is replaced atomically.
+
+        Preconditions:
+            1- igraph must have been built from graph, saved in GRAPH_FILENAME.
+
+                    Time complexity: O(nodes + edges) """
+
+    shared = {id(graph.graph[key]): key for key in ('cch_topology', 'spatial_index', 'lean_topology')
+              if key in graph.graph}
+    if 'lean_topology' in graph.graph:  # the arrays the lean iGraphs share with it
+        for name, value in vars(graph.graph['lean_topology'].routing).items():
+            if name not in ('itime', 'profile'):
+                shared[id(value)] = 'lean_topology.routing.' + name
+
+    class Pickler(pickle.Pickler):
+        def persistent_id(self, obj):
+            return shared.get(id(obj))
+
+    replace_file(IGRAPH_FILENAME,
+                 lambda file: Pickler(file).dump((file_fingerprint(GRAPH_FILENAME), igraph, highways, congestions)))
+
+
+def load_igraph(graph, GRAPH_FILENAME, IGRAPH_FILENAME):
+    """ This function returns the checkpoint saved with save_igraph as a tuple
+        (igraph, highways, congestions), or None if there is no checkpoint or it was
+        built from another version of the graph file.
+
+        Preconditions:
+            1- graph must be the graph saved in GRAPH_FILENAME (see load_graph).
+
+                    Time complexity: O(nodes + edges) """
+
+    class Unpickler(pickle.Unpickler):
+        def persistent_load(self, key):
+            if key == 'lean_topology':
+                return lean_topology(graph)
+            if key.startswith('lean_topology.routing.'):
+                return getattr(lean_topology(graph).routing, key.split('.')[-1])
+            return graph.graph[key]
+
+    try:
+        with open(IGRAPH_FILENAME, 'rb') as file:
+            fingerprint, igraph, highways, congestions = Unpickler(file).load()
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError, ValueError):
+        return None
+    if fingerprint != file_fingerprint(GRAPH_FILENAME):
+        return None
+    return igraph, highways, congestions
+
+
+@metrics.timed('propagate')
+def propagate_congestion_for_all_edges(graph, highways, congestions, highway_edges=None):
     """ This function assigns to each edge their congestion status. To do so,
         this function propagates the congestion status of each highway through
         the shortest path between the nearest node of beginning of the highway
-        the nearest node of the end of the highway.
+        the nearest node of the end of the highway. If the highway_edges mapping
+        is given, the paths are not searched but looked up.
 
        Preconditions:
             1 - The graph given must be a directed graph with appropiate edges attributes
             2 - highways and congestions must be in correct format
 
-        Time complexity: O(highways*(congestions + nodes + edges*log(nodes))) =
-                    = O(highways*edges*log(nodes))"""
+        Time complexity: O(highways*(nodes + edges*log(nodes))) =
+                    = O(highways*edges*log(nodes)), or O(highways + covered edges)
+                    with the highway_edges mapping. """
 
-    for highway in highways:
-        status = search_congestion_status(highway.way_id, congestions)
+    statuses = as_snapshot(congestions).statuses([highway.way_id for highway in highways])
+    for highway, status in zip(highways, statuses.tolist()):
         if status != 0:  # we already set all edges congestion to 0
-            node_org = ox.distance.nearest_nodes(
-                graph, highway.coordinates[0], highway.coordinates[1])
-            node_dst = ox.distance.nearest_nodes(graph, highway.coordinates[len(
-                highway.coordinates)-2], highway.coordinates[len(highway.coordinates) - 1])
-            shortest_path = ox.shortest_path(graph, node_org, node_dst)
-            propagate_congestion(graph, shortest_path, status)
+            if highway_edges is None:
+                propagate_congestion(graph, highway_path(graph, highway), status)
+            else:
+                for node1, node2 in highway_edges.get(highway.way_id, []):
+                    graph.adj[node1][node2]['congestion'] = int(status)
 
 
 def calculate_itime(congestion, length, max_speed):
-    """ This function calculates the itime of a given edge. The idea is that
+    """ This function calculates the itime (in seconds) of a given edge. The idea is that
         the max speed will be scaled in proportion to the level of congestion in
         that edge. However if we don't know the congestion, we will suppose there is
         intermidiate congestion and if the street is closed the itime will be set
-        to infinite(for dijkstra properties).
+        to infinite(for dijkstra properties). The length is in meters and the max
+        speed in km/h, so the speed is never above max_speed.
 
         Preconditions:
             1- congestions is bounded between [0, 6].
@@ -345,54 +900,369 @@ def calculate_itime(congestion, length, max_speed):
                     Time complexity: 0(1) """
 
     if congestion != 0 and congestion != 6:
-        return max_speed - ((max_speed/5) * (congestion-1))
+        speed = max_speed - ((max_speed/5) * (congestion-1))
     elif congestion == 0:
-        return max_speed/2
+        speed = max_speed/2
     else:
         return float('inf')
+    if speed <= 0:
+        return float('inf')
+    return length / (speed/3.6)
 
 
-def calculate_i_time_for_all_edges(graph):
+def calculate_itimes(congestion, length, max_speed):
+    """ This function is calculate_itime for arrays: it returns the array with the
+        itime of each edge, computed at once.
+
+                    Time complexity: O(edges) """
+
+    congestion = np.asarray(congestion)
+    max_speed = np.asarray(max_speed, dtype=np.float64)
+    speed = np.where(congestion == 0, max_speed/2, max_speed - (max_speed/5) * (congestion-1))
+    blocked = (congestion == 6) | (speed <= 0)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        itime = np.asarray(length, dtype=np.float64) / (speed/3.6)
+    itime[blocked] = np.inf
+    return itime
+
+
+@metrics.timed('itime')
+def calculate_i_time_for_all_edges(graph, table=None):
     """ This function propagates the time to travel through an edge through
-        all of them.
+        all of them, computing all of them at once from the edge table (extracted
+        from the graph if it is not given).
 
         Precondition:
             1- graph must be a defined graph with proper edge attributes.
 
         Time complexity: O(edges) """
 
-    for node1, info1 in graph.nodes.items():
-        for node2, edge in graph.adj[node1].items():
-            new_time = calculate_itime(edge['congestion'], edge['length'], edge['maxspeed'])
-            edge['itime'] = new_time
+    if table is None:
+        table = edge_table(graph)
+    itime = calculate_itimes(table.congestion, table.length, table.maxspeed)
+    write_edge_attributes(table, itime=itime)
+    return itime
 
 
-def build_igraph(graph, highways, congestions):
+def edge_congestions(table, highways, congestions, highway_edges):
+    """ This function returns the array with the congestion status of each edge of
+        the table: the status of the last highway (with information) that covers it,
+        0 for the edges with no information.
+
+        Preconditions:
+            1- highway_edges must be the mapping of build_highway_edges for the graph
+               of the table and the highways.
+
+        Time complexity: O(edges + highways*log(congestions) + covered edges) """
+
+    congestion = np.zeros(len(table.edges), dtype=np.int8)
+    statuses = as_snapshot(congestions).statuses([highway.way_id for highway in highways])
+    for highway, status in zip(highways, statuses.tolist()):
+        if status != 0:
+            rows = [table.index[edge] for edge in highway_edges.get(highway.way_id, [])]
+            congestion[rows] = status
+    return congestion
+
+
+def lean_topology(graph, keep_geometry=True):
+    """ This function returns the overlay.LeanTopology of a graph, with the speed limits
+        of its edges resolved (see fill_all_maxspeeds) and its routing graph. It is built
+        the first time and kept in graph.graph['lean_topology'], so all the lean iGraphs
+        of the graph share it. The one of a graph in the binary format is built on its
+        arrays (see compact_lean_topology).
+
+                    Time complexity: O(nodes*log(nodes) + edges) the first time. """
+
+    if 'lean_topology' in graph.graph:
+        return graph.graph['lean_topology']
+    if isinstance(graph, storage.LazyGraph):
+        graph.graph['lean_topology'] = compact_lean_topology(graph.compact, keep_geometry)
+    else:
+        topology = overlay.LeanTopology(graph, keep_geometry)
+        table = fill_all_maxspeeds(topology.digraph)
+        write_edge_attributes(table, itime=np.zeros(len(table.edges)))
+        topology.set_routing(routing.build_routing_graph(topology.digraph))
+        for edge in table.data:
+            del edge['itime']  # it belongs to the overlays
+        graph.graph['lean_topology'] = topology
+    return graph.graph['lean_topology']
+
+
+def compact_lean_topology(compact, keep_geometry=True):
+    """ This function returns the lean topology of lean_topology for a graph in the binary
+        format (a storage.CompactGraph), an overlay.CompactTopology built on its arrays:
+        the speed limits are resolved once per different (maxspeed, highway) pair.
+
+                    Time complexity: O(edges*log(edges)) """
+
+    pairs = np.column_stack((compact.maxspeed, compact.highway))
+    values, inverse = np.unique(pairs, axis=0, return_inverse=True)
+    resolved = [resolve_maxspeed(compact.tables['maxspeed'][maxspeed] if maxspeed != -1 else None,
+                                 compact.tables['highway'][highway] if highway != -1 else None)
+                for maxspeed, highway in values.tolist()]
+    speeds = np.array(resolved, dtype=np.int64)[inverse.ravel()]
+
+    node_ids, numbers = compact.sorted_nodes()
+    kept = compact.digraph_edges()
+    kept = kept[np.argsort(numbers[compact.edge_u[kept]], kind='stable')]  # routing order
+    order = np.argsort(numbers)
+    routing_graph = routing.routing_graph_from_arrays(
+        node_ids, compact.x[order], compact.y[order], numbers[compact.edge_u[kept]],
+        numbers[compact.edge_v[kept]], compact.length[kept], speeds[kept], np.zeros(len(kept)))
+    return overlay.CompactTopology(compact, kept, speeds, routing_graph, keep_geometry)
+
+
+@metrics.timed('build_igraph')
+def build_lean_igraph(graph, highways, congestions, highway_edges=None, history=None):
+    """ This function returns the iGraph of build_igraph as an overlay.WeightOverlay:
+        only the congestion and itime arrays are new, over the lean topology shared by
+        all the iGraphs of the graph (see lean_topology), instead of a copy of the graph
+        with all its attributes. The itimes are float32, as in the routing graph.
+
+        Preconditions:
+            The ones of build_igraph.
+
+        Time complexity: O(edges + highways*log(congestions) + covered edges) after the
+                    first time, with the highway_edges mapping. """
+
+    topology = lean_topology(graph)
+    if highway_edges is None:
+        highway_edges = build_highway_edges(graph, highways)
+    edges = len(topology.edges)
+    igraph = overlay.WeightOverlay(topology, np.zeros(edges, dtype=np.int8),
+                                   np.zeros(edges, dtype=np.float32), graph.graph)
+    igraph.graph['highway_edges'] = highway_edges
+    igraph.graph['edge_highways'] = invert_highway_edges(highways, highway_edges)
+    positions, way_ids = profile_pairs(igraph)
+    with metrics.timer('propagate'):
+        statuses = as_snapshot(congestions).statuses(way_ids).astype(np.float64)
+        igraph.congestion[:] = last_known(positions, statuses, igraph.congestion)
+    with metrics.timer('itime'):
+        igraph.routing.itime[:] = calculate_itimes(igraph.congestion, topology.length, topology.maxspeed)
+    set_time_profile(igraph, highways, congestions, history)
+    if 'cch_topology' in igraph.graph:
+        with metrics.timer('customize'):
+            igraph.graph['cch'] = cch.customize(igraph.graph['cch_topology'], igraph.graph['routing'])
+    return igraph
+
+
+@metrics.timed('build_igraph')
+def build_igraph(graph, highways, congestions, highway_edges=None, history=None):
     """ This function returns the iGraph, an advanced graph that takes into account
         the highway congestions. The edges of this graph will have two new attributes,
         the congestion status(congestion) and the time(itime) to travel through the edge.
+        The compact routing graph used for the queries is stored in igraph.graph['routing'],
+        and if the graph has a contraction hierarchy topology (see load_graph) it is
+        customized with the itimes and stored in igraph.graph['cch']. The routing graph
+        gets the time profile of set_time_profile (with the history, if given).
 
         Preconditions:
             1- We must get a defined graph.
             2- We must get a proper list of highways.
-            3- We must get a proper list of congestions.
+            3- We must get a proper list (or snapshot) of congestions.
+            4- highway_edges, if given, must be the mapping of build_highway_edges
+               (or load_highway_edges) for this graph and highways.
+
+        Time complexity: O(edges) + O(highways*(nodes + edges*log(nodes)))
+                    = O(highways*edges*log(nodes)) as it's a sparse graph, or
+                    O(edges + highways*congestions) with the highway_edges mapping."""
+
+    graph = ox.utils_graph.get_digraph(storage.as_networkx(graph), weight='length')
+    if highway_edges is None:
+        highway_edges = build_highway_edges(graph, highways)
+    graph.graph['highway_edges'] = highway_edges
+    graph.graph['edge_highways'] = invert_highway_edges(highways, highway_edges)
+    table = edge_table(graph)
+    with metrics.timer('propagate'):
+        table = table._replace(congestion=edge_congestions(table, highways, congestions, highway_edges))
+    with metrics.timer('itime'):
+        itime = calculate_itimes(table.congestion, table.length, table.maxspeed)
+    write_edge_attributes(table, maxspeed=table.maxspeed.astype(np.int64),
+                          congestion=table.congestion, itime=itime)
+    graph.graph['routing'] = routing.build_routing_graph(graph)
+    set_time_profile(graph, highways, congestions, history)
+    if 'cch_topology' in graph.graph:
+        with metrics.timer('customize'):
+            graph.graph['cch'] = cch.customize(graph.graph['cch_topology'], graph.graph['routing'])
+    return graph
 
-        Time complexity: O(edges) + O(highways*(congestions + nodes + edges*log(nodes)))
-                    = O(highways*edges*log(nodes)) as it's a sparse graph"""
 
-    graph = ox.utils_graph.get_digraph(graph, weight='length')
-    fill_all_maxspeeds(graph)
-    nx.set_edge_attributes(graph, 0, "congestion")
-    nx.set_edge_attributes(graph, None, "itime")
-    propagate_congestion_for_all_edges(graph, highways, congestions)
-    calculate_i_time_for_all_edges(graph)
-    return graph
+def changed_congestions(old_congestions, new_congestions):
+    """ This function returns the set of congestion ids whose current status is
+        different between two lists of congestions. A congestion that only appears
+        in one of the lists is compared with status 0 (no information).
+
+        Preconditions:
+            1- Both parameters must be proper lists (or snapshots) of congestions.
+
+                    Time complexity: O(congestions*log(congestions)) """
 
+    old_congestions = as_snapshot(old_congestions)
+    new_congestions = as_snapshot(new_congestions)
+    if old_congestions.version == new_congestions.version:
+        return set()
+    ids = np.union1d(old_congestions.sorted_ids, new_congestions.sorted_ids)
+    different = old_congestions.statuses(ids) != new_congestions.statuses(ids)
+    return set(ids[different].tolist())
 
-def get_shortest_path_with_ispeeds(igraph, orig, dst):
+
+@metrics.timed('update_igraph')
+def update_igraph(igraph, highways, old_congestions, new_congestions, history=None):
+    """ This function updates an iGraph built with build_igraph (and the old congestions)
+        so that it takes into account the new congestions. Only the edges covered by
+        the highways whose status changed get their congestion and itime recomputed.
+        When several highways cover the same edge, the last one in the highways list
+        with some information wins, as in build_igraph. The time profile is computed
+        again (see set_time_profile). It returns the updated iGraph.
+
+        Preconditions:
+            1- igraph must have been built with the same highways list.
+            2- old_congestions must be the congestions the iGraph reflects right now.
+
+        Time complexity: O(congestions + affected edges) """
+
+    changed = changed_congestions(old_congestions, new_congestions)
+    new_congestions = as_snapshot(new_congestions)
+    if not changed:  # the predicted statuses may have changed anyway
+        set_time_profile(igraph, highways, new_congestions, history)
+        return igraph
+    highway_edges = igraph.graph['highway_edges']
+    edge_highways = igraph.graph['edge_highways']
+
+    affected = set()
+    for way_id in changed:
+        affected.update(highway_edges.get(way_id, []))
+
+    with metrics.timer('propagate'):  # the itimes of the affected edges too
+        for node1, node2 in affected:
+            congestion = 0
+            for way_id in edge_highways[(node1, node2)]:
+                status = new_congestions.status(way_id)
+                if status != 0:
+                    congestion = status
+            edge = igraph.adj[node1][node2]
+            edge['congestion'] = congestion
+            edge['itime'] = calculate_itime(congestion, edge['length'], edge['maxspeed'])
+            if 'routing' in igraph.graph:
+                igraph.graph['routing'].set_itime(node1, node2, edge['itime'])
+    if 'cch' in igraph.graph:
+        with metrics.timer('customize'):
+            igraph.graph['cch'] = cch.customize(igraph.graph['cch_topology'], igraph.graph['routing'])
+    set_time_profile(igraph, highways, new_congestions, history)
+    return igraph
+
+
+def profile_pairs(igraph):
+    """ This function returns two arrays, the positions of the edges in the routing graph
+        and the way_id of a highway that covers them, with a pair for each highway that
+        covers each edge (in the order of the highways list). They are computed once
+        per iGraph.
+
+                Time complexity: O(edges) the first time, O(1) afterwards. """
+
+    if 'profile_pairs' not in igraph.graph:
+        routing_graph = igraph.graph['routing']
+        edge_highways = igraph.graph['edge_highways']
+        sources = np.repeat(routing_graph.node_ids, np.diff(routing_graph.offsets)).tolist()
+        targets = routing_graph.node_ids[routing_graph.targets].tolist()
+        positions, way_ids = list(), list()
+        for position, edge in enumerate(zip(sources, targets)):
+            for way_id in edge_highways.get(edge, ()):
+                positions.append(position)
+                way_ids.append(way_id)
+        igraph.graph['profile_pairs'] = (np.array(positions, dtype=np.int64),
+                                         np.array(way_ids, dtype=np.int64))
+    return igraph.graph['profile_pairs']
+
+
+def last_known(positions, values, default):
+    """ This function returns a copy of default where the value of each position is the
+        last value (of the pairs of positions and values) that is known (not 0 or NaN).
+
+                Time complexity: O(pairs*log(pairs)) """
+
+    result = np.array(default, dtype=np.float64)
+    known = (values != 0) & ~np.isnan(values)
+    reversed_positions, reversed_values = positions[known][::-1], values[known][::-1]
+    unique, first = np.unique(reversed_positions, return_index=True)
+    result[unique] = reversed_values[first]
+    return result
+
+
+@metrics.timed('profile')
+def set_time_profile(igraph, highways, congestions, history=None, days=28):
+    """ This function sets the routing.TimeProfile of the routing graph of the iGraph, for
+        the time-dependent queries: the current itimes, the itimes with the predicted
+        statuses (the current one where there is no prediction) and, for every hour of the
+        day, the itimes with the average status of the highways at that hour in the last
+        days of the history (a history.HistoryStore), the predicted ones where there is
+        no history.
+
+        Preconditions:
+            1- igraph must have been built with build_igraph for the highways.
+
+        Time complexity: O(edges + highways covering edges + history rows of those days) """
+
+    routing_graph = igraph.graph['routing']
+    positions, way_ids = profile_pairs(igraph)
+    snapshot = as_snapshot(congestions)
+    length, maxspeed = routing_graph.length, routing_graph.maxspeed
+    current = last_known(positions, snapshot.statuses(way_ids).astype(np.float64),
+                         np.zeros(routing_graph.number_of_edges()))
+    predicted = last_known(positions, snapshot.statuses(way_ids, predicted=True).astype(np.float64), current)
+    predicted = calculate_itimes(predicted, length, maxspeed).astype(np.float32)
+    hourly = np.tile(predicted, (24, 1))
+    if history is not None and len(way_ids):
+        ways = np.unique(way_ids)
+        begin = datetime.datetime.now() - datetime.timedelta(days=days)
+        averages = history.hour_averages(ways, begin)[np.searchsorted(ways, way_ids)]
+        for hour in range(24):
+            average = last_known(positions, averages[:, hour], np.full(len(predicted), np.nan))
+            known = ~np.isnan(average)
+            hourly[hour, known] = calculate_itimes(average[known], length[known], maxspeed[known])
+    routing_graph.profile = routing.TimeProfile(routing_graph.itime, predicted, hourly)
+
+
+def build_geocoder(graph, ADDRESSES_FILENAME=None):
+    """ This function returns a local geocoder (geocoding.Geocoder) of the street names
+        of the graph and, if given, of the addresses of a csv file (name, lat, lon).
+
+        Precondition:
+            1- graph must be an osmnx graph with the name edge attribute.
+
+                Time complexity: O(edges + addresses*log(addresses)) """
+
+    if isinstance(graph, storage.LazyGraph):
+        geocoder = geocoding.Geocoder(geocoding.compact_street_places(graph.compact))
+    else:
+        geocoder = geocoding.Geocoder(geocoding.street_places(graph))
+    if ADDRESSES_FILENAME is not None:
+        geocoder.add(geocoding.read_addresses(ADDRESSES_FILENAME))
+    return geocoder
+
+
+@metrics.timed('geocode')
+def geocode(place, geocoder=None, CITY='Barcelona'):
+    """ This function returns the (latitude, longitude) of a place. It is looked up in
+        the local geocoder first, and only if it is not found there it is asked to the
+        remote geocoder of osmnx (which raises an exception if it does not find it).
+
+        Precondition:
+            1- place must be a string.
+
+                Time complexity: O(place.size) for a local exact match. """
+
+    if geocoder is not None:
+        coordinates = geocoder.geocode(place)
+        if coordinates is not None:
+            return coordinates
+    return ox.geocoder.geocode(place + ', ' + CITY)
+
+
+def get_shortest_path_with_ispeeds(igraph, orig, dst, geocoder=None):
     """ This function returns the sortest path(list of nodes) between two places
         (orig and dst). This path will be calculated in relation to the attribute
-        itime.
+        itime. The places are found with the local geocoder if one is given.
 
         Preconditions:
             1- origin and destination must be valid places.
@@ -401,44 +1271,328 @@ def get_shortest_path_with_ispeeds(igraph, orig, dst):
                 Time complexity: O(nodes) + O(edges*log(nodes))=
                             = O(edges*log(nodes)).  """
 
-    orig_long, orig_lat = ox.geocoder.geocode(orig + ', Barcelona')
-    dst_long, dst_lat = ox.geocoder.geocode(dst + ', Barcelona')
+    orig_long, orig_lat = geocode(orig, geocoder)
+    dst_long, dst_lat = geocode(dst, geocoder)
     return get_shortest_path_between_coords(igraph, orig_long, orig_lat, dst_long, dst_lat)
 
 
-def get_shortest_path_between_coords(igraph, orig_long, orig_lat, dst_long, dst_lat):
+def get_shortest_path_between_coords(igraph, orig_long, orig_lat, dst_long, dst_lat,
+                                     method='dijkstra', stats=None, snap='node'):
     """ This function is basically implemented for bot issues, it returns the shortest path
-        between two coordinates.
+        between two coordinates. The query runs on the compact routing graph of the iGraph
+        when it has one, with the given method ('dijkstra', 'astar', 'bidirectional',
+        'time_dependent', leaving now, or 'cch', the contraction hierarchy). If stats is a dictionary, the number of settled
+        nodes is stored in stats['settled'].
+        With snap='node' the coordinates are snapped to their nearest intersection, and
+        with snap='edge' to their nearest street: the path then starts with the whole
+        street of the origin and ends with the whole street of the destination.
 
         Preconditions: 1- igraph must be defined and directed
-                       2- the second group of parameters(coords) must be valid """
+                       2- the second group of parameters(coords) must be valid
+                       3- snap='edge' needs the spatial index of load_graph """
+
+    if snap == 'edge':
+        index = igraph.graph['spatial_index']
+        edges, _, _ = index.nearest_edges([orig_lat, dst_lat], [orig_long, dst_long])
+        (orig_u, orig_v), (dst_u, dst_v) = edges.tolist()
+        if (orig_u, orig_v) == (dst_u, dst_v):
+            return [orig_u, orig_v]
+        path = find_shortest_path(igraph, orig_v, dst_u, method, stats)
+        if type(path) != list:
+            return path
+        return [orig_u] + path + [dst_v]
+
+    node_orig, node_dst = nearest_nodes(igraph, [orig_lat, dst_lat], [orig_long, dst_long])
+    return find_shortest_path(igraph, node_orig, node_dst, method, stats)
+
+
+@metrics.timed('route')
+def find_shortest_path(igraph, node_orig, node_dst, method='dijkstra', stats=None, departure=None):
+    """ This function returns the shortest path(list of nodes) between two nodes of the
+        iGraph with the given method (see get_shortest_path_between_coords). With the
+        'time_dependent' method, departure is the time of the day (seconds since
+        midnight) of the trip, now by default. The 'cch' method falls back to Dijkstra
+        when the iGraph has no customized contraction hierarchy.
 
-    node_orig = ox.distance.nearest_nodes(igraph, orig_lat, orig_long)
-    node_dst = ox.distance.nearest_nodes(igraph, dst_lat, dst_long)
+        Precondition:
+            1- igraph must be defined(and with the proper edge attributes).
+
+                Time complexity: O(edges*log(nodes)) """
+
+    if method == 'cch':
+        if 'cch' in igraph.graph:
+            return cch.shortest_path(igraph.graph['cch'], node_orig, node_dst, stats=stats)
+        # the graph has no contraction hierarchy topology, or it is not customized yet
+        metrics.count('cch_fallbacks')
+        method = 'dijkstra'
+    if 'routing' in igraph.graph:
+        return routing.shortest_path(igraph.graph['routing'], node_orig, node_dst,
+                                     method=method, stats=stats, departure=departure)
     return ox.shortest_path(igraph, node_orig, node_dst, weight='itime')
 
 
-def plot_path(igraph, ipath, SIZE):
-    """ This funtion saves an image of the shortest path(with colored highways
+# the engine of the processes forked by travel_time_matrix, set only while they run,
+# so they inherit the graph instead of copying it
+matrix_engine = None
+matrix_lock = threading.Lock()
+
+
+def engine_rows(engine, sources, targets, paths):
+    """ Returns the rows of the travel time matrix (and their paths, if asked) of some
+        sources with an engine: ('cch', hierarchy) or ('routing', routing graph). """
+
+    kind, graph = engine
+    if kind == 'cch':
+        return cch.many_to_many(graph, sources, targets, paths)
+    return routing.many_to_many(graph, sources, targets, paths=paths)
+
+
+def matrix_rows(task):
+    """ Returns the rows of some sources in a process forked by travel_time_matrix,
+        with the engine it inherits in matrix_engine. """
+
+    sources, targets, paths = task
+    return engine_rows(matrix_engine, sources, targets, paths)
+
+
+def travel_time_matrix(igraph, origins, destinations, paths=False, processes=None):
+    """ This function returns the matrix (a NumPy array origins x destinations) of the
+        travel times (itime, in seconds) between some points, inf where there is no path,
+        and if paths is True also the list of lists of paths (lists of nodes, None where
+        there is no path). The points (lists of (latitude, longitude), as geocode returns
+        them) are snapped all at once, and each origin is a single search to all the
+        destinations (with the contraction hierarchy if the iGraph has it, otherwise a
+        one-to-many Dijkstra). With processes, the origins are split among that many
+        forked processes, which share the graph read-only: the engine is passed to them
+        in matrix_engine, so only one call at a time forks (matrix_lock), while the
+        calls without processes run in their own thread at once.
+        A forked process only has the thread that forked it, and the locks other threads
+        held at that moment (the ones of the Telegram updater, the job queue, the metrics
+        server or the logging module in the bot) stay held in it forever, so matrix_rows
+        must not take any lock (log or record metrics). Use processes only from scripts,
+        not from the handlers of the bot.
+
+        Preconditions:
+            1- igraph must have been built with build_igraph.
+            2- processes needs the fork start method (Linux).
+
+                Time complexity: O((origins + destinations)*log(nodes) +
+                                   origins*edges*log(nodes)) """
+
+    global matrix_engine
+    points = list(origins) + list(destinations)
+    nodes = nearest_nodes(igraph, [point[1] for point in points], [point[0] for point in points])
+    if 'cch' in igraph.graph:
+        hierarchy = igraph.graph['cch']
+        numbers = np.searchsorted(hierarchy.topology.node_ids, nodes).tolist()
+        engine = ('cch', hierarchy)
+        node_ids = hierarchy.topology.node_ids
+    else:
+        routing_graph = igraph.graph['routing']
+        numbers = [routing_graph.index[node] for node in nodes]
+        engine = ('routing', routing_graph)
+        node_ids = routing_graph.node_ids
+    sources, targets = numbers[:len(origins)], numbers[len(origins):]
+
+    if processes is not None and processes > 1 and len(sources) > 1:
+        chunks = [chunk.tolist() for chunk in np.array_split(sources, min(processes, len(sources)))]
+        with matrix_lock:
+            matrix_engine = engine
+            try:
+                with multiprocessing.get_context('fork').Pool(len(chunks)) as pool:
+                    results = pool.map(matrix_rows, [(chunk, targets, paths) for chunk in chunks])
+            finally:
+                matrix_engine = None
+    else:
+        results = [engine_rows(engine, sources, targets, paths)]
+    if not paths:
+        return np.vstack(results) if results else np.zeros((0, len(targets)))
+    matrix = np.vstack([result[0] for result in results])
+    ipaths = [[None if path is None else node_ids[path].tolist() for path in row]
+              for result in results for row in result[1]]
+    return matrix, ipaths
+
+
+@metrics.timed('isochrone')
+def isochrone(igraph, origin, minutes, buffer=0.0004):
+    """ This function returns the nodes that can be reached from origin (latitude,
+        longitude; snapped to its nearest node) in at most minutes with the current
+        congestions (itime), as a dictionary from node to its travel time in seconds,
+        and the area they cover: a shapely polygon (or multipolygon) made of the reached
+        streets widened by buffer degrees.
+
+        Preconditions:
+            1- igraph must have been built with build_igraph.
+
+                Time complexity: O(reached edges*log(reached nodes)) """
+
+    node = nearest_nodes(igraph, [origin[1]], [origin[0]])[0]
+    routing_graph = igraph.graph['routing']
+    reached = routing.bounded_dijkstra(routing_graph, routing_graph.index[node], minutes * 60)
+    reached = {int(routing_graph.node_ids[i]): cost for i, cost in reached.items()}
+    lines = list()
+    for node1 in reached:
+        for node2, data in igraph.adj[node1].items():
+            if node2 in reached:
+                if 'geometry' in data:
+                    lines.append(data['geometry'])
+                else:
+                    lines.append(LineString([(igraph.nodes[node1]['x'], igraph.nodes[node1]['y']),
+                                             (igraph.nodes[node2]['x'], igraph.nodes[node2]['y'])]))
+    if not lines:
+        lines.append(Point(igraph.nodes[node]['x'], igraph.nodes[node]['y']))
+    area = unary_union(lines).buffer(buffer, 2).simplify(buffer / 4)
+    return reached, area
+
+
+def plot_isochrone(area, origin, SIZE, base_layer=None):
+    """ This function returns an image (PNG in a BytesIO) of the area of an isochrone
+        (see isochrone) around origin (latitude, longitude), drawn on the base_layer if
+        it is given.
+
+                Time complexity: O(area points) """
+
+    map = tiles.CachedStaticMap(SIZE, SIZE, base_layer=base_layer)
+    polygons = list(area.geoms) if hasattr(area, 'geoms') else [area]
+    for polygon in polygons:
+        map.add_polygon(Polygon(list(polygon.exterior.coords), '#0050ff40', '#0050ff', False))
+    map.add_marker(CircleMarker((origin[1], origin[0]), 'red', 8))
+    return render_png(map)
+
+
+def get_isochrone(igraph, version, isochrone_cache, origin, minutes, SIZE, base_layer=None):
+    """ This function returns the isochrone of origin and minutes (see isochrone) and
+        the PNG image of plot_isochrone, using isochrone_cache (an lru.LRUCache) keyed
+        by the snapped origin, the minutes and the congestion version of the iGraph.
+        A new version empties the cache.
+
+        Preconditions:
+            1- version must identify the congestions the iGraph reflects.
+
+                Time complexity: O(log(nodes)) on a hit. """
+
+    isochrone_cache.set_version(version)
+    node = nearest_nodes(igraph, [origin[1]], [origin[0]])[0]
+    key = (node, minutes, version, SIZE)
+    result = isochrone_cache.get(key)
+    metrics.count('isochrone_cache_misses' if result is None else 'isochrone_cache_hits')
+    if result is None:
+        reached, area = isochrone(igraph, origin, minutes)
+        image = plot_isochrone(area, origin, SIZE, base_layer).getvalue()
+        result = (reached, area, image)
+        isochrone_cache.put(key, result)
+    return result
+
+
+@metrics.timed('plot')
+def plot_path(igraph, ipath, SIZE, base_layer=None):
+    """ This funtion returns an image (PNG in a BytesIO) of the shortest path(with colored highways
         depending on the congestion) between origin and destination in a representation
-        of the city.
+        of the city. It returns None if there is no path. Nothing is written to disk,
+        so it can be called from several threads at once. If a base_layer (see
+        build_base_layer) is given, the path is drawn on top of it.
 
         Preconditions:
             1 - igraph must be defined(and with the proper attributes)
 
                     Time complexity: O(ipath.size) """
 
-    map = StaticMap(SIZE, SIZE)
-    it = 0
+    map = tiles.CachedStaticMap(SIZE, SIZE, base_layer=base_layer)
     if type(ipath) == list:
-        while it < len(ipath) - 1:
-            node1 = ipath[it]
-            node2 = ipath[it+1]
-            map.add_line(Line(((igraph.nodes[node1]['x'], igraph.nodes[node1]['y']),
-                               (igraph.nodes[node2]['x'], igraph.nodes[node2]['y'])),
-                              conversion(igraph.adj[node1][node2]['congestion']), 5))
-            it += 1
-        image = map.render()
-        image.save('shortest_path.png')
+        for coordinates, color in path_lines(igraph, ipath):
+            map.add_line(Line(coordinates, color, 5))
+        return render_png(map)
     else:
         print("No path found")
+        return None
+
+
+def path_lines(igraph, ipath):
+    """ This function returns the lines to draw a path: a list of (coordinates, color)
+        with a line for each run of consecutive edges with the same congestion color,
+        following the geometry of the edges when they have one.
+
+                    Time complexity: O(ipath.size + points of its edges) """
+
+    lines = list()
+    for node1, node2 in zip(ipath, ipath[1:]):
+        data = igraph.adj[node1][node2]
+        color = conversion(data['congestion'])
+        if 'geometry' in data:
+            coordinates = list(data['geometry'].coords)
+        else:
+            coordinates = [(igraph.nodes[node1]['x'], igraph.nodes[node1]['y']),
+                           (igraph.nodes[node2]['x'], igraph.nodes[node2]['y'])]
+        if lines and lines[-1][1] == color:
+            lines[-1][0].extend(coordinates[1:])
+        else:
+            lines.append((coordinates, color))
+    return lines
+
+
+@metrics.timed('render')
+def render_png(map):
+    """ This function renders a StaticMap and returns the PNG image in a BytesIO,
+        ready to be read (or sent) by the caller.
+
+                    Time complexity: O(map size) """
+
+    image = io.BytesIO()
+    map.render().save(image, format='PNG')
+    image.seek(0)
+    return image
+
+
+def build_base_layer(highways, congestions, tile_cache=None):
+    """ This function returns the congestion base layer (a tiles.CongestionLayer) of
+        a snapshot: the map tiles with the highways colored depending on their
+        congestion, rendered once per tile and reused by every route drawn on it.
+
+        Preconditions:
+            1- A list of highways and a list (or snapshot) of congestions are given.
+
+                    Time complexity: O(highways.size*max(highways.coordinates.size)) """
+
+    statuses = as_snapshot(congestions).statuses([highway.way_id for highway in highways])
+    lines = list()
+    for highway, highway_status in zip(highways, statuses):
+        coordinates = highway_coordinates(highway)
+        if len(coordinates) > 1:
+            lines.append((coordinates, conversion(highway_status)))
+    return tiles.CongestionLayer(lines, tile_cache=tile_cache)
+
+
+def get_route(igraph, version, route_cache, orig_long, orig_lat, dst_long, dst_lat, SIZE,
+              method='dijkstra', base_layer=None, departure=None):
+    """ This function returns the shortest path between two coordinates (as
+        get_shortest_path_between_coords, leaving at departure with the 'time_dependent'
+        method, see find_shortest_path) and the PNG image of plot_path (None if
+        there is no path, drawn on base_layer if it is given), using route_cache
+        (an lru.LRUCache) keyed by the snapped nodes, the method (and the hour of the
+        departure for the 'time_dependent' one) and the congestion version of the
+        iGraph. A new version empties the cache.
+
+        Preconditions:
+            1- version must identify the congestions the iGraph reflects.
+
+                Time complexity: O(log(nodes)) on a hit. """
+
+    route_cache.set_version(version)
+    node_orig, node_dst = nearest_nodes(igraph, [orig_lat, dst_lat], [orig_long, dst_long])
+    hour = None
+    if method == 'time_dependent':
+        if departure is None:
+            now = datetime.datetime.now()
+            departure = now.hour * 3600 + now.minute * 60 + now.second
+        hour = departure // 3600
+    key = (node_orig, node_dst, method, hour, version, SIZE)
+    route = route_cache.get(key)
+    metrics.count('route_cache_misses' if route is None else 'route_cache_hits')
+    if route is None:
+        ipath = find_shortest_path(igraph, node_orig, node_dst, method, departure=departure)
+        image = plot_path(igraph, ipath, SIZE, base_layer)
+        if image is not None:
+            image = image.getvalue()
+        route = (ipath, image)
+        route_cache.put(key, route)
+    return route
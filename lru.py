@@ -0,0 +1,67 @@
+import collections
+import threading
+
+
+class LRUCache:
+    """ This class is a bounded cache that evicts the least recently used entry when
+        it is full. It can be tied to a version (for example the congestion snapshot
+        version): changing the version empties it, so it never returns values computed
+        for older data. It is safe to use from several threads.
+
+        Attributes:
+            maxsize: the maximum number of entries.
+            version: the version of the data the entries were computed for.
+            stats: dictionary with the number of hits, misses, evictions and invalidations. """
+
+    def __init__(self, maxsize=1000):
+        self.maxsize = maxsize
+        self.version = None
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'invalidations': 0}
+
+    def __len__(self):
+        return len(self.entries)
+
+    def set_version(self, version):
+        """ Empties the cache if the version is not the one of its entries.
+
+                    Time complexity: O(1) amortized """
+
+        with self.lock:
+            if version != self.version:
+                if self.entries:
+                    self.stats['invalidations'] += 1
+                self.entries.clear()
+                self.version = version
+
+    def get(self, key, default=None):
+        """ Returns the value of the key (and marks it as the most recently used one),
+            default if it is not in the cache.
+
+                    Time complexity: O(1) """
+
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.stats['hits'] += 1
+                return self.entries[key]
+            self.stats['misses'] += 1
+            return default
+
+    def put(self, key, value):
+        """ Stores the value of the key, evicting the least recently used entry if
+            the cache is full.
+
+                    Time complexity: O(1) """
+
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+                self.stats['evictions'] += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
@@ -0,0 +1,266 @@
+import bisect
+import functools
+import threading
+import time
+import http.server
+
+# upper bounds (seconds) of the buckets of the latency histograms
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, float('inf'))
+
+enabled = True
+lock = threading.Lock()
+histograms = dict()  # stage -> Histogram
+counters = dict()  # event -> count
+
+
+class Histogram:
+    """ This class is a latency histogram with fixed buckets (BUCKETS), as the ones of
+        Prometheus: observing a value is a binary search and an increment, so it can be
+        done on every request.
+
+        Attributes:
+            counts: the number of values of each bucket (not cumulative).
+            sum, count: the sum and the number of all the values. """
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """ Returns an estimation of the quantile q (0 to 1) of the values, interpolating
+            inside its bucket as Prometheus histogram_quantile does (the bound of the
+            last finite bucket if it is in the infinite one). None if there are no values.
+
+                    Time complexity: O(buckets) """
+
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count > 0:
+                if BUCKETS[i] == float('inf'):
+                    return BUCKETS[i - 1]
+                lower = BUCKETS[i - 1] if i > 0 else 0.0
+                return lower + (BUCKETS[i] - lower) * (rank - cumulative) / count
+            cumulative += count
+        return BUCKETS[-2]
+
+
+def enable(flag=True):
+    """ Switches the instrumentation on or off. When it is off, the hooks do nothing
+        (timer returns a context manager that does not even read the clock). """
+
+    global enabled
+    enabled = flag
+
+
+def observe(stage, seconds):
+    """ Records a latency (seconds) of a stage. """
+
+    if not enabled:
+        return
+    with lock:
+        histogram = histograms.get(stage)
+        if histogram is None:
+            histogram = histograms[stage] = Histogram()
+        histogram.observe(seconds)
+
+
+def count(event, n=1):
+    """ Adds n to the counter of an event. """
+
+    if not enabled:
+        return
+    with lock:
+        counters[event] = counters.get(event, 0) + n
+
+
+class Timer:
+    """ Context manager that records the time spent inside it in the histogram of a stage. """
+
+    __slots__ = ('stage', 'begin')
+
+    def __init__(self, stage):
+        self.stage = stage
+
+    def __enter__(self):
+        self.begin = time.perf_counter()
+        return self
+
+    def __exit__(self, *exception):
+        observe(self.stage, time.perf_counter() - self.begin)
+        return False
+
+
+class NullTimer:
+    """ The context manager of timer when the instrumentation is off. """
+
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exception):
+        return False
+
+
+null_timer = NullTimer()
+
+
+def timer(stage):
+    """ Returns a context manager that records the time spent inside it in a stage:
+            with metrics.timer('route'):
+                ... """
+
+    return Timer(stage) if enabled else null_timer
+
+
+def timed(stage):
+    """ Decorator that records the time of every call of a function in a stage. """
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            begin = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                observe(stage, time.perf_counter() - begin)
+        return wrapper
+    return decorator
+
+
+class TimedIterator:
+    """ This class iterates an iterable recording the time spent getting its items (not
+        the time of the code that uses them) in a stage, when it is exhausted. It is
+        used to tell apart the time of a download from the time of parsing it while
+        it arrives.
+
+        Attributes:
+            initial: the seconds already spent before iterating (opening the download).
+            elapsed: the seconds spent getting the items so far, initial included. """
+
+    def __init__(self, stage, iterable, initial=0.0):
+        self.stage = stage
+        self.iterator = iter(iterable)
+        self.initial = initial
+        self.elapsed = initial
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        begin = time.perf_counter()
+        try:
+            item = next(self.iterator)
+        except StopIteration:
+            self.elapsed += time.perf_counter() - begin
+            observe(self.stage, self.elapsed)
+            raise
+        self.elapsed += time.perf_counter() - begin
+        return item
+
+
+def reset():
+    """ Removes all the recorded values. """
+
+    with lock:
+        histograms.clear()
+        counters.clear()
+
+
+def snapshot():
+    """ Returns a copy of the metrics: a dictionary with the histograms (stage ->
+        (counts, sum, count)) and the counters. """
+
+    with lock:
+        return {'histograms': {stage: (list(histogram.counts), histogram.sum, histogram.count)
+                               for stage, histogram in histograms.items()},
+                'counters': dict(counters)}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def exposition(prefix='igo'):
+    """ This function returns the metrics in the Prometheus text format: the histogram
+        <prefix>_stage_seconds with a stage label and the counter <prefix>_events_total
+        with an event label.
+
+                    Time complexity: O(stages*buckets + events) """
+
+    metrics = snapshot()
+    lines = ['# HELP {}_stage_seconds Latency of each stage.'.format(prefix),
+             '# TYPE {}_stage_seconds histogram'.format(prefix)]
+    for stage, (counts, total, number) in sorted(metrics['histograms'].items()):
+        cumulative = 0
+        for bound, bucket in zip(BUCKETS, counts):
+            cumulative += bucket
+            le = '+Inf' if bound == float('inf') else repr(bound)
+            lines.append('{}_stage_seconds_bucket{{stage="{}",le="{}"}} {}'.format(prefix, escape(stage), le, cumulative))
+        lines.append('{}_stage_seconds_sum{{stage="{}"}} {!r}'.format(prefix, escape(stage), total))
+        lines.append('{}_stage_seconds_count{{stage="{}"}} {}'.format(prefix, escape(stage), number))
+    lines += ['# HELP {}_events_total Number of times each event happened.'.format(prefix),
+              '# TYPE {}_events_total counter'.format(prefix)]
+    for event, number in sorted(metrics['counters'].items()):
+        lines.append('{}_events_total{{event="{}"}} {}'.format(prefix, escape(event), number))
+    return '\n'.join(lines) + '\n'
+
+
+def report():
+    """ This function returns a short text with the metrics, for a person: the number
+        of calls, the mean and the estimated p50 and p90 (milliseconds) of each stage,
+        and the counters.
+
+                    Time complexity: O(stages*buckets + events) """
+
+    with lock:
+        stages = sorted(histograms.items())
+        lines = list()
+        for stage, histogram in stages:
+            lines.append('{}: {} · mitjana {:.1f} ms · p50 {:.1f} ms · p90 {:.1f} ms'.format(
+                stage, histogram.count, 1000 * histogram.sum / histogram.count,
+                1000 * histogram.quantile(0.5), 1000 * histogram.quantile(0.9)))
+        for event, number in sorted(counters.items()):
+            lines.append('{}: {}'.format(event, number))
+    return '\n'.join(lines) if lines else 'Encara no hi ha mètriques.'
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        content = exposition().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass  # a request every scrape interval, not worth logging
+
+
+def serve(port=9100, address='127.0.0.1'):
+    """ Serves the metrics (see exposition) at http://address:port/metrics from a
+        daemon thread, and returns the server. By default it only listens locally.
+
+                    Time complexity: O(1) """
+
+    server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,282 @@
+import copy
+import collections.abc
+import networkx as nx
+import numpy as np
+
+# the edge attributes the routing and the rendering read
+LEAN_ATTRIBUTES = ('length', 'highway', 'maxspeed')
+
+
+class LeanTopology:
+    """ This class is the part of an iGraph that does not change between refreshes: a
+        DiGraph with only the coordinates of the nodes and the LEAN_ATTRIBUTES of the
+        edges (of the shortest of each group of parallel edges, as osmnx get_digraph),
+        the geometry of the edges out of line (in a dictionary, only if it is kept),
+        and the routing graph without congestions. It is built once per graph and
+        shared, read-only, by all the WeightOverlay.
+
+        Attributes:
+            digraph: the lean DiGraph.
+            geometries: dictionary from an edge (node1, node2) to its geometry.
+            routing: the routing.RoutingGraph, whose itime column is not used.
+            edges: the list of edges (node1, node2) in the order of the routing columns.
+            position: dictionary from an edge to its position in the routing columns.
+            length, maxspeed: float64 arrays with the length and the speed limit of each
+                edge (routing order), as the edge attributes the itimes are computed from. """
+
+    def __init__(self, graph, keep_geometry=True):
+        self.digraph = nx.DiGraph(crs=graph.graph.get('crs'))
+        for node, data in graph.nodes(data=True):
+            self.digraph.add_node(node, x=data['x'], y=data['y'])
+        self.geometries = dict()
+        for node1, node2, data in graph.edges(data=True):
+            if self.digraph.has_edge(node1, node2) and \
+                    self.digraph.adj[node1][node2]['length'] <= data.get('length', 0):
+                continue
+            self.digraph.add_edge(node1, node2, **{attribute: data[attribute]
+                                                   for attribute in LEAN_ATTRIBUTES if attribute in data})
+            if keep_geometry and 'geometry' in data:
+                self.geometries[(node1, node2)] = data['geometry']
+            else:
+                self.geometries.pop((node1, node2), None)
+        self.routing = None
+        self.edges = list()
+        self.position = dict()
+        self.length = self.maxspeed = None
+
+    def set_routing(self, routing_graph):
+        """ Sets the routing graph of the lean DiGraph, and the order of its edges. """
+
+        self.routing = routing_graph
+        sources = np.repeat(self.routing.node_ids, np.diff(self.routing.offsets)).tolist()
+        targets = self.routing.node_ids[self.routing.targets].tolist()
+        self.edges = list(zip(sources, targets))
+        self.position = {edge: position for position, edge in enumerate(self.edges)}
+        adj = self.digraph.adj
+        self.length = np.array([adj[node1][node2].get('length', 0) for node1, node2 in self.edges], dtype=np.float64)
+        self.maxspeed = np.array([adj[node1][node2]['maxspeed'] for node1, node2 in self.edges], dtype=np.float64)
+
+
+class CompactTopology(LeanTopology):
+    """ This class is the LeanTopology of a graph in the binary format (a
+        storage.CompactGraph), built on its arrays: the routing graph, the edges and the
+        length and maxspeed arrays are ready at once, and the DiGraph and the geometries
+        are only built when they are read (rendering, resolving the highways).
+
+        Attributes:
+            The ones of LeanTopology, and
+            compact: the CompactGraph.
+            kept: the position in the arrays of the compact graph of each edge (routing order).
+            speeds: the speed limit (integer km/h) of each edge of the compact graph. """
+
+    def __init__(self, compact, kept, speeds, routing_graph, keep_geometry=True):
+        self.compact = compact
+        self.kept = kept
+        self.speeds = speeds
+        self.keep_geometry = keep_geometry
+        self.lazy_digraph = None
+        self.geometries = CompactGeometries(self) if keep_geometry else dict()
+        self.routing = routing_graph
+        sources = np.repeat(routing_graph.node_ids, np.diff(routing_graph.offsets)).tolist()
+        targets = routing_graph.node_ids[routing_graph.targets].tolist()
+        self.edges = list(zip(sources, targets))
+        self.position = {edge: position for position, edge in enumerate(self.edges)}
+        self.length = np.asarray(compact.length, dtype=np.float64)[kept]
+        self.maxspeed = np.asarray(speeds, dtype=np.float64)[kept]
+
+    @property
+    def digraph(self):
+        """ The lean DiGraph, built the first time it is read. Two threads can build it
+            at once, then one of the two equal graphs is kept.
+
+                    Time complexity: O(nodes + edges) the first time. """
+
+        if self.lazy_digraph is None:
+            compact = self.compact
+            digraph = nx.DiGraph(crs=compact.meta['crs'])
+            for node, x, y in zip(compact.node_ids.tolist(), compact.x.tolist(), compact.y.tolist()):
+                digraph.add_node(node, x=x, y=y)
+            highways = compact.tables['highway']
+            columns = zip(self.edges, self.length.tolist(), np.asarray(compact.highway)[self.kept].tolist(),
+                          np.asarray(self.speeds)[self.kept].tolist())
+            for (node1, node2), length, highway, maxspeed in columns:
+                if highway == -1:
+                    digraph.add_edge(node1, node2, length=length, maxspeed=maxspeed)
+                else:
+                    digraph.add_edge(node1, node2, length=length, highway=highways[highway], maxspeed=maxspeed)
+            self.lazy_digraph = digraph
+        return self.lazy_digraph
+
+
+class CompactGeometries(collections.abc.Mapping):
+    """ The geometries of a CompactTopology, as the dictionary of a LeanTopology: the
+        geometry of an edge is built from the arrays every time it is read. """
+
+    __slots__ = ('topology',)
+
+    def __init__(self, topology):
+        self.topology = topology
+
+    def __getitem__(self, edge):
+        geometry = self.topology.compact.geometry(self.topology.kept[self.topology.position[edge]])
+        if geometry is None:
+            raise KeyError(edge)
+        return geometry
+
+    def __contains__(self, edge):
+        position = self.topology.position.get(edge)
+        if position is None:
+            return False
+        i = self.topology.kept[position]
+        return self.topology.compact.geometry_offsets[i+1] > self.topology.compact.geometry_offsets[i]
+
+    def __iter__(self):
+        offsets = np.asarray(self.topology.compact.geometry_offsets)
+        has_geometry = (offsets[self.topology.kept + 1] > offsets[self.topology.kept]).tolist()
+        return iter([edge for edge, flag in zip(self.topology.edges, has_geometry) if flag])
+
+    def __len__(self):
+        offsets = np.asarray(self.topology.compact.geometry_offsets)
+        return int((offsets[self.topology.kept + 1] > offsets[self.topology.kept]).sum())
+
+
+class EdgeAttributes(collections.abc.MutableMapping):
+    """ The attributes of an edge of a WeightOverlay, as the dictionary of an edge of a
+        networkx graph: the static ones come from the topology, and the congestion and
+        itime from the arrays of the overlay. """
+
+    __slots__ = ('overlay', 'edge', 'position')
+
+    def __init__(self, overlay, edge):
+        self.overlay = overlay
+        self.edge = edge
+        self.position = overlay.topology.position[edge]
+
+    def __getitem__(self, key):
+        if key == 'congestion':
+            return int(self.overlay.congestion[self.position])
+        if key == 'itime':
+            return float(self.overlay.routing.itime[self.position])
+        if key == 'geometry':
+            return self.overlay.topology.geometries[self.edge]
+        return self.overlay.topology.digraph.adj[self.edge[0]][self.edge[1]][key]
+
+    def __setitem__(self, key, value):
+        if key == 'congestion':
+            self.overlay.congestion[self.position] = value
+        elif key == 'itime':
+            self.overlay.routing.itime[self.position] = value
+        else:
+            raise KeyError('Only the congestion and itime of an overlay can change: ' + key)
+
+    def __delitem__(self, key):
+        raise KeyError('The attributes of an overlay can not be deleted: ' + key)
+
+    def keys(self):
+        keys = list(self.overlay.topology.digraph.adj[self.edge[0]][self.edge[1]])
+        if self.edge in self.overlay.topology.geometries:
+            keys.append('geometry')
+        return keys + ['congestion', 'itime']
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        return key in self.keys()
+
+
+class Neighbours(collections.abc.Mapping):
+    """ The neighbours of a node of a WeightOverlay, as graph.adj[node]. """
+
+    __slots__ = ('overlay', 'node')
+
+    def __init__(self, overlay, node):
+        self.overlay = overlay
+        self.node = node
+
+    def __getitem__(self, neighbour):
+        if neighbour not in self.overlay.topology.digraph.adj[self.node]:
+            raise KeyError(neighbour)
+        return EdgeAttributes(self.overlay, (self.node, neighbour))
+
+    def __iter__(self):
+        return iter(self.overlay.topology.digraph.adj[self.node])
+
+    def __len__(self):
+        return len(self.overlay.topology.digraph.adj[self.node])
+
+
+class Adjacency(collections.abc.Mapping):
+    """ The adjacency of a WeightOverlay, as graph.adj. """
+
+    __slots__ = ('overlay',)
+
+    def __init__(self, overlay):
+        self.overlay = overlay
+
+    def __getitem__(self, node):
+        if node not in self.overlay.topology.digraph.adj:
+            raise KeyError(node)
+        return Neighbours(self.overlay, node)
+
+    def __iter__(self):
+        return iter(self.overlay.topology.digraph.adj)
+
+    def __len__(self):
+        return len(self.overlay.topology.digraph.adj)
+
+
+class WeightOverlay:
+    """ This class is a lean iGraph: the congestions and itimes of a snapshot over a
+        shared LeanTopology. A refresh only allocates the congestion and itime arrays
+        (the itime column of its own shallow copy of the routing graph, which shares
+        all the other arrays), not a new graph. It can be read as the networkx iGraph
+        it replaces (graph, nodes, adj and edges, with the edge attributes of
+        EdgeAttributes), and only the congestion and itime of its edges can change.
+
+        Attributes:
+            topology: the shared LeanTopology.
+            congestion: int8 array with the congestion of each edge (routing order).
+            routing: the routing graph with the itimes of the snapshot.
+            graph: the dictionary of the iGraph (routing, cch, highway_edges...). """
+
+    def __init__(self, topology, congestion, itime, graph=None):
+        self.topology = topology
+        self.congestion = congestion
+        self.routing = copy.copy(topology.routing)
+        self.routing.itime = itime
+        self.routing.profile = None
+        self.graph = dict(graph) if graph is not None else dict()
+        self.graph['routing'] = self.routing
+
+    @property
+    def nodes(self):
+        return self.topology.digraph.nodes
+
+    @property
+    def adj(self):
+        return Adjacency(self)
+
+    def __iter__(self):
+        return iter(self.topology.digraph)
+
+    def __contains__(self, node):
+        return node in self.topology.digraph
+
+    def __len__(self):
+        return len(self.topology.digraph)
+
+    def number_of_nodes(self):
+        return self.topology.digraph.number_of_nodes()
+
+    def number_of_edges(self):
+        return len(self.topology.edges)
+
+    def edges(self, data=False):
+        """ Returns a generator of the edges (node1, node2), with their attributes if data. """
+
+        for edge in self.topology.edges:
+            yield (edge[0], edge[1], EdgeAttributes(self, edge)) if data else edge
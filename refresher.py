@@ -0,0 +1,157 @@
+import collections
+import datetime
+import threading
+import time
+import traceback
+import igo
+import metrics
+import feeds
+
+# What the requests read: an iGraph and the data it reflects. It is not modified while
+# it is the current one, a refresh publishes a new one.
+Snapshot = collections.namedtuple('Snapshot', 'igraph highways congestions version updated')
+
+
+class Refresher:
+    """ This class keeps the iGraph up to date with the congestions, off the request path.
+        It is double-buffered: a refresh brings the spare iGraph (the one published two
+        refreshes ago) up to date with update_igraph and then publishes it as the
+        current Snapshot, swapping a single reference, so the requests always read a
+        consistent snapshot and never wait for a rebuild. The feeds are downloaded with
+        conditional requests (and kept in HIGHWAYS_FILENAME and CONGESTIONS_FILENAME if
+        given), and when neither of them has changed the iGraph is not rebuilt. Every
+        new snapshot is appended to the history, if one is given. The duration and the
+        errors of every refresh are recorded in stats.
+
+        Attributes:
+            snapshot: the current Snapshot (None until the first refresh).
+            stats: dictionary with the refreshes, the unchanged ones (skipped), failures,
+                last_duration (seconds), last_error and the recent durations. """
+
+    def __init__(self, graph, GRAPH_FILENAME, HIGHWAYS_URL, CONGESTIONS_URL,
+                 IGRAPH_FILENAME=None, interval=300, HIGHWAYS_FILENAME=None, CONGESTIONS_FILENAME=None,
+                 history=None, lean=False):
+        self.graph = graph
+        self.GRAPH_FILENAME = GRAPH_FILENAME
+        self.HIGHWAYS_URL = HIGHWAYS_URL
+        self.CONGESTIONS_URL = CONGESTIONS_URL
+        self.IGRAPH_FILENAME = IGRAPH_FILENAME
+        self.interval = interval
+        self.history = history  # the history.HistoryStore every new snapshot is appended to
+        self.lean = lean  # build the iGraphs as weight overlays (see igo.build_lean_igraph)
+        self.highways_feed = feeds.Feed(HIGHWAYS_URL, HIGHWAYS_FILENAME)
+        self.congestions_feed = feeds.Feed(CONGESTIONS_URL, CONGESTIONS_FILENAME)
+        self.downloaded = (None, None)  # the highways and congestions of the last download
+        self.snapshot = None
+        self.spare = None  # the Snapshot not being served, updated by the next refresh
+        self.lock = threading.Lock()  # only one refresh at a time
+        self.job = None  # the job of the job queue, if it refreshes in one
+        self.stopped = threading.Event()
+        self.stats = {'refreshes': 0, 'skipped': 0, 'failures': 0, 'last_duration': None,
+                      'last_error': None, 'durations': collections.deque(maxlen=100)}
+
+    def current(self):
+        """ Returns the current Snapshot. """
+
+        return self.snapshot
+
+    def restore(self):
+        """ Publishes the last checkpoint (see igo.save_igraph), if there is one.
+            It returns if a checkpoint was restored. """
+
+        if self.IGRAPH_FILENAME is None:
+            return False
+        checkpoint = igo.load_igraph(self.graph, self.GRAPH_FILENAME, self.IGRAPH_FILENAME)
+        if checkpoint is None:
+            return False
+        igraph, highways, congestions = checkpoint
+        congestions = igo.as_snapshot(congestions)
+        self.snapshot = Snapshot(igraph, highways, congestions, congestions.version,
+                                 datetime.datetime.now())
+        return True
+
+    def next_igraph(self, highways, congestions):
+        """ Returns the iGraph for the new highways and congestions: the spare one updated,
+            or a new one if there is no spare with the same highways. """
+
+        spare = self.spare
+        self.spare = None
+        if spare is not None and spare.highways == highways:
+            return igo.update_igraph(spare.igraph, highways, spare.congestions, congestions, self.history)
+        highway_edges = igo.load_highway_edges(self.graph, highways, self.GRAPH_FILENAME)
+        build = igo.build_lean_igraph if self.lean else igo.build_igraph
+        return build(self.graph, highways, congestions, highway_edges, self.history)
+
+    def refresh(self):
+        """ Downloads the highways and the congestions, builds the next iGraph and
+            publishes it. The previous snapshot becomes the spare one. If the data has
+            not changed the current iGraph is published again, only with a new time. """
+
+        with self.lock:
+            begin = time.perf_counter()
+            highways = igo.download_highways(self.highways_feed, self.downloaded[0])
+            congestions = igo.download_congestions(self.congestions_feed, self.downloaded[1])
+            self.downloaded = (highways, congestions)
+            current = self.snapshot
+            if current is not None and current.version == congestions.version and current.highways == highways:
+                self.snapshot = current._replace(updated=datetime.datetime.now())
+                self.stats['skipped'] += 1
+                metrics.count('refresh_skipped')
+                return self.snapshot
+            igraph = self.next_igraph(highways, congestions)
+            previous = self.snapshot
+            self.snapshot = Snapshot(igraph, highways, congestions, congestions.version,
+                                     datetime.datetime.now())
+            self.spare = previous
+            if self.history is not None:
+                with metrics.timer('history'):
+                    self.history.append(congestions)
+            if self.IGRAPH_FILENAME is not None:
+                with metrics.timer('checkpoint'):
+                    igo.save_igraph(igraph, highways, congestions, self.graph,
+                                    self.GRAPH_FILENAME, self.IGRAPH_FILENAME)
+            duration = time.perf_counter() - begin
+            metrics.observe('refresh', duration)
+            metrics.count('refreshes')
+            self.stats['refreshes'] += 1
+            self.stats['last_duration'] = duration
+            self.stats['durations'].append(duration)
+            return self.snapshot
+
+    def safe_refresh(self, context=None):
+        """ Refreshes recording the error instead of raising it, so a failed download
+            keeps the current snapshot. It can be used as a job queue callback. """
+
+        try:
+            self.refresh()
+        except Exception as e:
+            self.stats['failures'] += 1
+            metrics.count('refresh_failures')
+            self.stats['last_error'] = (datetime.datetime.now(), repr(e))
+            traceback.print_exc()
+
+    def start(self, job_queue=None, first=0):
+        """ Refreshes every interval seconds, the first time in first seconds, in the
+            job queue of the bot if one is given, otherwise in a daemon thread. """
+
+        if job_queue is not None:
+            self.job = job_queue.run_repeating(self.safe_refresh, interval=self.interval, first=first)
+            return
+
+        def loop():
+            if self.stopped.wait(first):
+                return
+            while True:
+                self.safe_refresh()
+                if self.stopped.wait(self.interval):
+                    return
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def stop(self):
+        """ Stops the refreshes started with start (a refresh that is running ends first). """
+
+        self.stopped.set()
+        if self.job is not None:
+            self.job.schedule_removal()
+            self.job = None
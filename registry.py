@@ -0,0 +1,217 @@
+import os
+import re
+import hashlib
+import datetime
+import threading
+import collections
+import igo
+import lru
+import history
+import metrics
+import refresher
+
+# A city the bot can serve: the place osmnx downloads its graph of, and the feeds of its
+# highways and congestions (None if it has none, then its iGraph has no congestions).
+City = collections.namedtuple('City', 'name place highways_url congestions_url')
+
+# estimated memory of a loaded city per edge of its graph (the graph, its indexes and the
+# two iGraphs of its refresher), measured with tracemalloc on synthetic cities
+BYTES_PER_EDGE = 5000
+ROUTE_CACHE_SIZE = 1000
+ISOCHRONE_CACHE_SIZE = 200
+
+
+def slug(name):
+    """ Returns a name that can be used as a file name. """
+
+    return re.sub(r'[^a-z0-9]+', '-', name.lower()).strip('-')
+
+
+class LoadedCity:
+    """ This class is a city loaded by the CityRegistry: its graph, geocoder, refresher
+        (None if the city has no feeds, then snapshot is fixed) and the caches of its
+        requests.
+
+        Attributes:
+            city: the City.
+            memory: the estimated bytes it takes (see BYTES_PER_EDGE).
+            route_cache, isochrone_cache: the lru.LRUCache of its routes and isochrones.
+            base_layers: lru.LRUCache with the congestion base layer of its snapshot. """
+
+    def __init__(self, city, graph, geocoder, city_refresher, snapshot=None):
+        self.city = city
+        self.graph = graph
+        self.geocoder = geocoder
+        self.refresher = city_refresher
+        self.snapshot = snapshot
+        self.memory = BYTES_PER_EDGE * graph.number_of_edges()
+        self.route_cache = lru.LRUCache(ROUTE_CACHE_SIZE)
+        self.isochrone_cache = lru.LRUCache(ISOCHRONE_CACHE_SIZE)
+        self.base_layers = lru.LRUCache(1)
+
+    def current(self):
+        """ Returns the current refresher.Snapshot of the city. """
+
+        return self.refresher.current() if self.refresher is not None else self.snapshot
+
+    def base_layer(self, snapshot):
+        """ Returns the congestion base layer of a snapshot of the city, built the first
+            time it is needed. """
+
+        self.base_layers.set_version(snapshot.version)
+        layer = self.base_layers.get(snapshot.version)
+        if layer is None:
+            layer = igo.build_base_layer(snapshot.highways, snapshot.congestions)
+            self.base_layers.put(snapshot.version, layer)
+        return layer
+
+
+class CityRegistry:
+    """ This class serves several cities from one process. A city is loaded the first
+        time it is requested (get): its graph is downloaded only if it is not in the
+        directory, where the graphs are kept by place so every city (and process) of
+        the same place shares the download and its indexes, and its refresher starts
+        keeping its congestions up to date. When the estimated memory of the loaded
+        cities exceeds memory_budget, the least recently used ones are unloaded (their
+        refreshers stop), always keeping the one just requested. It is safe to use
+        from several threads: a city is loaded once even if it is requested by many
+        requests at once, and different cities load in parallel.
+
+        Attributes:
+            cities: dictionary from name to City.
+            directory: the directory with a 'graphs' subdirectory (by place) and one
+                for the files of each city (checkpoint, feeds, history, addresses.csv).
+            memory_budget: the maximum estimated bytes of the loaded cities.
+            loaded: dictionary from name to LoadedCity, from the least to the most
+                recently used. """
+
+    def __init__(self, cities, directory='cities', memory_budget=4 * 1024 ** 3, job_queue=None,
+                 interval=300):
+        self.cities = collections.OrderedDict((city.name, city) for city in cities)
+        self.directory = directory
+        self.memory_budget = memory_budget
+        self.job_queue = job_queue
+        self.interval = interval
+        self.loaded = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.loading = collections.defaultdict(threading.Lock)  # a lock per city name
+        self.downloading = collections.defaultdict(threading.Lock)  # a lock per place
+        self.stats = {'loads': 0, 'evictions': 0}
+        os.makedirs(os.path.join(directory, 'graphs'), exist_ok=True)
+
+    def names(self):
+        """ Returns the list of the names of the cities. """
+
+        return list(self.cities)
+
+    def get(self, name):
+        """ Returns the LoadedCity of a city, loading it if it is not loaded.
+
+            Precondition:
+                1- name must be the name of one of the cities (KeyError otherwise).
+
+                    Time complexity: O(1) if it is loaded. """
+
+        city = self.cities[name]
+        with self.lock:
+            loaded = self.loaded.get(name)
+            if loaded is not None:
+                self.loaded.move_to_end(name)
+                return loaded
+            loading = self.loading[name]
+        with loading:
+            with self.lock:  # loaded by another request while this one waited
+                loaded = self.loaded.get(name)
+            if loaded is None:
+                with metrics.timer('load_city'):
+                    loaded = self.load(city)
+                with self.lock:
+                    self.loaded[name] = loaded
+                    self.stats['loads'] += 1
+                metrics.count('city_loads')
+        self.evict(keep=name)
+        return loaded
+
+    def graph_filenames(self, place):
+        """ Returns the file of the downloaded graph of a place and the one of its
+            binary format, shared by all the cities of the place. """
+
+        key = slug(place)[:40] + '-' + hashlib.sha1(place.encode('utf-8')).hexdigest()[:8]
+        filename = os.path.join(self.directory, 'graphs', key + '.graph')
+        return filename, filename + '.bin'
+
+    def load_graph(self, place):
+        """ Returns the graph of a place (see igo.load_graph), downloading it only if it
+            is not in the directory, and once even if several cities ask for it. The
+            download, the conversion and the load (which writes the index files next
+            to the graph) of a place run one at a time. """
+
+        GRAPH_FILENAME, GRAPH_BINARY = self.graph_filenames(place)
+        with self.downloading[place]:
+            if not igo.exists_graph(GRAPH_BINARY, GRAPH_FILENAME):
+                if not igo.exists_graph(GRAPH_FILENAME):
+                    # written to a temporary file first so another process never
+                    # reads half of it
+                    igo.save_graph(igo.download_graph(place), GRAPH_FILENAME + '.tmp')
+                    os.replace(GRAPH_FILENAME + '.tmp', GRAPH_FILENAME)
+                igo.convert_graph(GRAPH_FILENAME, GRAPH_BINARY)
+            return igo.load_graph(GRAPH_BINARY), GRAPH_BINARY
+
+    def load(self, city):
+        """ Loads a city: its graph, its geocoder (with the addresses.csv of its
+            directory, if there is one) and its iGraph, restored from its checkpoint or
+            refreshed, with its refresher started.
+
+                    Time complexity: the one of igo.load_graph plus a refresh. """
+
+        graph, GRAPH_BINARY = self.load_graph(city.place)
+        directory = os.path.join(self.directory, slug(city.name))
+        os.makedirs(directory, exist_ok=True)
+        addresses = os.path.join(directory, 'addresses.csv')
+        geocoder = igo.build_geocoder(graph, addresses if os.path.exists(addresses) else None)
+        if city.highways_url is None or city.congestions_url is None:
+            congestions = igo.CongestionSnapshot([])
+            snapshot = refresher.Snapshot(igo.build_lean_igraph(graph, [], congestions, dict()), [], congestions,
+                                          congestions.version, datetime.datetime.now())
+            return LoadedCity(city, graph, geocoder, None, snapshot)
+        city_refresher = refresher.Refresher(
+            graph, GRAPH_BINARY, city.highways_url, city.congestions_url,
+            os.path.join(directory, 'city.igraph'), self.interval,
+            HIGHWAYS_FILENAME=os.path.join(directory, 'highways.csv'),
+            CONGESTIONS_FILENAME=os.path.join(directory, 'congestions.csv'),
+            history=history.HistoryStore(os.path.join(directory, 'history')), lean=True)
+        restored = city_refresher.restore()
+        if not restored:
+            city_refresher.refresh()
+        city_refresher.start(self.job_queue, first=0 if restored else self.interval)
+        return LoadedCity(city, graph, geocoder, city_refresher)
+
+    def memory(self):
+        """ Returns the estimated bytes of the loaded cities. """
+
+        with self.lock:
+            return sum(loaded.memory for loaded in self.loaded.values())
+
+    def evict(self, keep=None):
+        """ Unloads the least recently used cities (but keep) while the loaded ones take
+            more than the memory budget. It returns the names of the unloaded cities.
+
+                    Time complexity: O(loaded cities) """
+
+        evicted = list()
+        with self.lock:
+            total = sum(loaded.memory for loaded in self.loaded.values())
+            for name in list(self.loaded):
+                if total <= self.memory_budget:
+                    break
+                if name == keep:
+                    continue
+                loaded = self.loaded.pop(name)
+                total -= loaded.memory
+                evicted.append(loaded)
+            self.stats['evictions'] += len(evicted)
+        for loaded in evicted:  # the requests that still use it keep it alive until they end
+            if loaded.refresher is not None:
+                loaded.refresher.stop()
+            metrics.count('city_evictions')
+        return [loaded.city.name for loaded in evicted]
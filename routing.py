@@ -0,0 +1,470 @@
+import heapq
+import datetime
+import numpy as np
+import haversine
+
+
+INF = float('inf')
+
+
+class RoutingGraph:
+    """ This class is a compact representation of the iGraph used to answer the
+        shortest path queries. The nodes are renumbered from 0 to nodes-1 and the
+        edges are stored in CSR format: the edges going out of the node i are the
+        positions offsets[i]..offsets[i+1]-1 of the targets and weight columns.
+
+        Attributes:
+            node_ids: the original id of each node (sorted).
+            index: dictionary from the original id of a node to its number.
+            x, y: the coordinates of each node.
+            offsets, targets: the CSR arrays.
+            length, maxspeed, itime: float32 columns with the attributes of each edge.
+            rev_offsets, rev_sources, rev_edges: the CSR arrays of the reversed graph,
+                rev_edges being the position of each reversed edge in the edge columns.
+            profile: the TimeProfile for the time-dependent queries (None if there is none). """
+
+    def __init__(self, node_ids, x, y, offsets, targets, length, maxspeed, itime):
+        self.node_ids = node_ids
+        self.index = {node: i for i, node in enumerate(node_ids.tolist())}
+        self.x = x
+        self.y = y
+        self.offsets = offsets
+        self.targets = targets
+        self.length = length
+        self.maxspeed = maxspeed
+        self.itime = itime
+        sources = np.repeat(np.arange(len(node_ids), dtype=np.int32), np.diff(offsets))
+        self.rev_edges = np.argsort(targets, kind='stable').astype(np.int32)
+        self.rev_sources = sources[self.rev_edges]
+        self.rev_offsets = np.zeros(len(node_ids) + 1, dtype=np.int32)
+        self.rev_offsets[1:] = np.cumsum(np.bincount(targets, minlength=len(node_ids)))
+        self.profile = None
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        del state['index']  # it is rebuilt from node_ids, much cheaper to store
+        return state
+
+    def __setstate__(self, state):
+        state.setdefault('profile', None)
+        self.__dict__.update(state)
+        self.index = {node: i for i, node in enumerate(self.node_ids.tolist())}
+
+    def number_of_nodes(self):
+        return len(self.node_ids)
+
+    def number_of_edges(self):
+        return len(self.targets)
+
+    def edge_position(self, node1, node2):
+        """ Returns the position in the edge columns of the edge between two nodes
+            (given by their original ids), or None if there is no such edge.
+
+                    Time complexity: O(degree) """
+
+        i, j = self.index[node1], self.index[node2]
+        for position in range(self.offsets[i], self.offsets[i+1]):
+            if self.targets[position] == j:
+                return position
+        return None
+
+    def set_itime(self, node1, node2, itime):
+        """ Changes the itime of the edge between two nodes (given by their original ids).
+
+                    Time complexity: O(degree) """
+
+        self.itime[self.edge_position(node1, node2)] = itime
+
+    def path_ids(self, path):
+        """ Returns the list of original ids of a list of node numbers.
+
+                    Time complexity: O(path.size) """
+
+        return [int(self.node_ids[i]) for i in path]
+
+
+class TimeProfile:
+    """ This class holds the itime of every edge (in the order of the edge columns of a
+        RoutingGraph) at the different moments of a trip: the current one for the edges
+        reached in the first current_horizon seconds, the predicted one (the congestions
+        feed predicts the status in 15 minutes) until predicted_horizon seconds, and the
+        historical average of the hour of the day for the edges reached later.
+
+        Attributes:
+            current, predicted: float32 arrays with the itime of each edge.
+            hourly: float32 array (24 x edges) with the itime of each edge at each hour,
+                the predicted one where there is no history. """
+
+    def __init__(self, current, predicted, hourly, current_horizon=600, predicted_horizon=1800):
+        self.current = current
+        self.predicted = predicted
+        self.hourly = hourly
+        self.current_horizon = current_horizon
+        self.predicted_horizon = predicted_horizon
+
+    def weights(self, elapsed, departure):
+        """ Returns the itime column for an edge entered elapsed seconds after departure
+            (seconds since midnight).
+
+                    Time complexity: O(1) """
+
+        if elapsed < self.current_horizon:
+            return self.current
+        if elapsed < self.predicted_horizon:
+            return self.predicted
+        return self.hourly[int((departure + elapsed) // 3600) % 24]
+
+
+def build_routing_graph(igraph):
+    """ This function returns the RoutingGraph of an iGraph. Only the attributes
+        routing needs (coordinates, length, maxspeed and itime) are kept.
+
+        Precondition:
+            1- igraph must be a directed graph with the maxspeed and itime edge attributes.
+
+                    Time complexity: O(nodes*log(nodes) + edges) """
+
+    node_ids = np.array(sorted(igraph.nodes), dtype=np.int64)
+    index = {node: i for i, node in enumerate(node_ids.tolist())}
+    x = np.array([igraph.nodes[node]['x'] for node in node_ids.tolist()], dtype=np.float64)
+    y = np.array([igraph.nodes[node]['y'] for node in node_ids.tolist()], dtype=np.float64)
+
+    offsets = np.zeros(len(node_ids) + 1, dtype=np.int32)
+    targets, length, maxspeed, itime = list(), list(), list(), list()
+    for i, node in enumerate(node_ids.tolist()):
+        for neighbour, edge in igraph.adj[node].items():
+            targets.append(index[neighbour])
+            length.append(edge['length'])
+            maxspeed.append(edge['maxspeed'])
+            itime.append(edge['itime'])
+        offsets[i+1] = len(targets)
+
+    return RoutingGraph(node_ids, x, y, offsets,
+                        np.array(targets, dtype=np.int32),
+                        np.array(length, dtype=np.float32),
+                        np.array(maxspeed, dtype=np.float32),
+                        np.array(itime, dtype=np.float32))
+
+
+def routing_graph_from_arrays(node_ids, x, y, sources, targets, length, maxspeed, itime):
+    """ This function returns the RoutingGraph of the nodes (sorted ids and coordinates)
+        and the edges from sources to targets (node numbers) with their length, maxspeed
+        and itime. The edges of each node keep their order in the arrays.
+
+        Precondition:
+            1- node_ids must be sorted.
+
+                    Time complexity: O(edges*log(edges)) """
+
+    order = np.argsort(sources, kind='stable')
+    offsets = np.zeros(len(node_ids) + 1, dtype=np.int32)
+    offsets[1:] = np.cumsum(np.bincount(sources, minlength=len(node_ids)))
+    return RoutingGraph(np.asarray(node_ids, dtype=np.int64),
+                        np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64), offsets,
+                        np.asarray(targets, dtype=np.int32)[order],
+                        np.asarray(length, dtype=np.float32)[order],
+                        np.asarray(maxspeed, dtype=np.float32)[order],
+                        np.asarray(itime, dtype=np.float32)[order])
+
+
+def build_path(previous, node):
+    """ Returns the path (list of node numbers) that ends at node following the
+        previous dictionary of a search.
+
+                    Time complexity: O(path.size) """
+
+    path = list()
+    while node is not None:
+        path.append(node)
+        node = previous[node]
+    return path[::-1]
+
+
+def dijkstra(routing, source, target, weight='itime'):
+    """ This function returns the shortest path (list of node numbers) between two nodes
+        (given by their numbers) of a RoutingGraph, using the given edge column as
+        weight, and the number of settled nodes. The path is None if there is no path.
+
+        Precondition:
+            1- The weights must be non negative (inf for the closed streets, never used).
+
+                    Time complexity: O(edges*log(nodes)) """
+
+    return astar(routing, source, target, weight, heuristic=None)
+
+
+def haversine_heuristic(routing, target, weight='itime'):
+    """ This function returns an array with a lower bound of the cost from each node
+        to target: the straight line distance divided by the maximum maxspeed of the
+        network. It is admissible for the itime weight (seconds, with speeds never
+        above maxspeed) and for the length weight (dividing by 1).
+
+                    Time complexity: O(nodes) """
+
+    points = np.column_stack((routing.y, routing.x))
+    goal = np.tile(points[target], (len(points), 1))
+    distance = haversine.haversine_vector(points, goal, haversine.Unit.METERS)
+    # a small margin so the float32 rounding of the lengths never makes it overestimate
+    distance = distance * 0.999
+    if weight == 'length':
+        return distance
+    return distance / (float(routing.maxspeed.max()) / 3.6)
+
+
+def astar(routing, source, target, weight='itime', heuristic=None):
+    """ This function returns the shortest path (list of node numbers) between two nodes
+        of a RoutingGraph with the A* algorithm, and the number of settled nodes. The
+        heuristic is an array with a consistent lower bound of the cost from each node
+        to target (for example haversine_heuristic); None means plain Dijkstra.
+
+        Precondition:
+            1- The weights must be non negative (inf for the closed streets, never used).
+
+                    Time complexity: O(edges*log(nodes)) """
+
+    offsets = memoryview(routing.offsets)
+    targets = memoryview(routing.targets)
+    weights = memoryview(getattr(routing, weight))
+    if heuristic is not None:
+        heuristic = heuristic.tolist()
+
+    distance = {source: 0.0}
+    previous = {source: None}
+    settled = set()
+    queue = [(0.0, 0.0, source)]
+    while queue:
+        key, dist, node = heapq.heappop(queue)
+        if node in settled:
+            continue
+        settled.add(node)
+        if node == target:
+            return build_path(previous, node), len(settled)
+        for position in range(offsets[node], offsets[node+1]):
+            if weights[position] == INF:  # closed street
+                continue
+            neighbour = targets[position]
+            new_dist = dist + weights[position]
+            if neighbour not in distance or new_dist < distance[neighbour]:
+                distance[neighbour] = new_dist
+                previous[neighbour] = node
+                new_key = new_dist if heuristic is None else new_dist + heuristic[neighbour]
+                heapq.heappush(queue, (new_key, new_dist, neighbour))
+    return None, len(settled)
+
+
+def one_to_many(routing, source, targets, weight='itime'):
+    """ This function runs a single Dijkstra search from source until all the targets
+        (node numbers) are settled. It returns an array with the cost to each target
+        (inf if it can not be reached) and the previous dictionary of the search, to
+        build the paths (see build_path).
+
+        Precondition:
+            1- The weights must be non negative (inf for the closed streets, never used).
+
+                    Time complexity: O(edges*log(nodes)) """
+
+    offsets = memoryview(routing.offsets)
+    neighbours = memoryview(routing.targets)
+    weights = memoryview(getattr(routing, weight))
+    remaining = set(targets)
+    distance = {source: 0.0}
+    previous = {source: None}
+    settled = set()
+    queue = [(0.0, source)]
+    while queue and remaining:
+        dist, node = heapq.heappop(queue)
+        if node in settled:
+            continue
+        settled.add(node)
+        remaining.discard(node)
+        for position in range(offsets[node], offsets[node+1]):
+            if weights[position] == INF:  # closed street
+                continue
+            neighbour = neighbours[position]
+            new_dist = dist + weights[position]
+            if neighbour not in distance or new_dist < distance[neighbour]:
+                distance[neighbour] = new_dist
+                previous[neighbour] = node
+                heapq.heappush(queue, (new_dist, neighbour))
+    costs = np.array([distance[target] if target in settled else np.inf for target in targets])
+    return costs, previous
+
+
+def bounded_dijkstra(routing, source, budget, weight='itime'):
+    """ This function returns a dictionary with the cost from source of every node
+        (numbers) that can be reached with a cost of at most budget. The search stops
+        as soon as the next node is over the budget.
+
+        Precondition:
+            1- The weights must be non negative (inf for the closed streets, never used).
+
+                    Time complexity: O(reached edges*log(reached nodes)) """
+
+    offsets = memoryview(routing.offsets)
+    neighbours = memoryview(routing.targets)
+    weights = memoryview(getattr(routing, weight))
+    distance = {source: 0.0}
+    settled = dict()
+    queue = [(0.0, source)]
+    while queue:
+        dist, node = heapq.heappop(queue)
+        if dist > budget:
+            break
+        if node in settled:
+            continue
+        settled[node] = dist
+        for position in range(offsets[node], offsets[node+1]):
+            if weights[position] == INF:  # closed street
+                continue
+            neighbour = neighbours[position]
+            new_dist = dist + weights[position]
+            if new_dist <= budget and (neighbour not in distance or new_dist < distance[neighbour]):
+                distance[neighbour] = new_dist
+                heapq.heappush(queue, (new_dist, neighbour))
+    return settled
+
+
+def many_to_many(routing, sources, targets, weight='itime', paths=False):
+    """ This function returns the matrix (sources x targets) of the shortest path costs
+        between some nodes (given by their numbers), inf where there is no path, with a
+        one_to_many search from each source. If paths is True it also returns the list
+        of lists of paths (None where there is no path).
+
+                    Time complexity: O(sources*edges*log(nodes)) """
+
+    matrix = np.full((len(sources), len(targets)), np.inf)
+    result = list()
+    for i, source in enumerate(sources):
+        matrix[i], previous = one_to_many(routing, source, targets, weight)
+        if paths:
+            result.append([build_path(previous, target) if matrix[i, j] < np.inf else None
+                           for j, target in enumerate(targets)])
+    if not paths:
+        return matrix
+    return matrix, result
+
+
+def bidirectional_dijkstra(routing, source, target, weight='itime'):
+    """ This function returns the shortest path (list of node numbers) between two nodes
+        of a RoutingGraph and the number of settled nodes. It runs a search forward from
+        source and a search backward from target at the same time and stops when the
+        best path found can not be improved.
+
+        Precondition:
+            1- The weights must be non negative (inf for the closed streets, never used).
+
+                    Time complexity: O(edges*log(nodes)) """
+
+    weights = memoryview(getattr(routing, weight))
+    graphs = ((memoryview(routing.offsets), memoryview(routing.targets), None),
+              (memoryview(routing.rev_offsets), memoryview(routing.rev_sources),
+               memoryview(routing.rev_edges)))
+    distance = ({source: 0.0}, {target: 0.0})
+    previous = ({source: None}, {target: None})
+    settled = (set(), set())
+    queues = ([(0.0, source)], [(0.0, target)])
+    best, meeting = float('inf'), None
+    if source == target:
+        return [source], 1
+
+    while queues[0] and queues[1]:
+        if queues[0][0][0] + queues[1][0][0] >= best:
+            break
+        side = 0 if queues[0][0][0] <= queues[1][0][0] else 1
+        dist, node = heapq.heappop(queues[side])
+        if node in settled[side]:
+            continue
+        settled[side].add(node)
+        offsets, neighbours, edges = graphs[side]
+        for position in range(offsets[node], offsets[node+1]):
+            neighbour = neighbours[position]
+            edge = position if edges is None else edges[position]
+            if weights[edge] == INF:  # closed street
+                continue
+            new_dist = dist + weights[edge]
+            if neighbour not in distance[side] or new_dist < distance[side][neighbour]:
+                distance[side][neighbour] = new_dist
+                previous[side][neighbour] = node
+                heapq.heappush(queues[side], (new_dist, neighbour))
+            if neighbour in distance[1-side]:
+                total = distance[side][neighbour] + distance[1-side][neighbour]
+                if total < best or meeting is None:
+                    best, meeting = total, neighbour
+
+    number_settled = len(settled[0]) + len(settled[1])
+    if meeting is None:
+        return None, number_settled
+    return build_path(previous[0], meeting) + build_path(previous[1], meeting)[::-1][1:], number_settled
+
+
+def time_dependent_dijkstra(routing, source, target, profile, departure):
+    """ This function returns the fastest path (list of node numbers) between two nodes
+        of a RoutingGraph leaving at departure (seconds since midnight), and the number of
+        settled nodes. The itime of each edge is the one of the TimeProfile at the moment
+        it is reached, so the edges reached later in a long trip use the predicted and
+        historical congestions.
+
+        Precondition:
+            1- The itimes must be non negative (inf for the closed streets, never used).
+
+                    Time complexity: O(edges*log(nodes)) """
+
+    offsets = memoryview(routing.offsets)
+    targets = memoryview(routing.targets)
+    distance = {source: 0.0}
+    previous = {source: None}
+    settled = set()
+    queue = [(0.0, source)]
+    while queue:
+        dist, node = heapq.heappop(queue)
+        if node in settled:
+            continue
+        settled.add(node)
+        if node == target:
+            return build_path(previous, node), len(settled)
+        weights = profile.weights(dist, departure)
+        for position in range(offsets[node], offsets[node+1]):
+            if weights[position] == INF:  # closed street
+                continue
+            neighbour = targets[position]
+            new_dist = dist + float(weights[position])
+            if neighbour not in distance or new_dist < distance[neighbour]:
+                distance[neighbour] = new_dist
+                previous[neighbour] = node
+                heapq.heappush(queue, (new_dist, neighbour))
+    return None, len(settled)
+
+
+def shortest_path(routing, node_orig, node_dst, weight='itime', method='dijkstra', stats=None,
+                  departure=None):
+    """ This function returns the shortest path (list of original node ids) between two
+        nodes (given by their original ids) of a RoutingGraph, None if there is no path.
+        The method can be 'dijkstra', 'astar', 'bidirectional' or 'time_dependent' (with
+        the profile of the RoutingGraph, leaving at departure, in seconds since midnight,
+        now by default). If stats is a dictionary, the number of settled nodes is stored
+        in stats['settled'].
+
+                    Time complexity: O(edges*log(nodes)) """
+
+    source, target = routing.index[node_orig], routing.index[node_dst]
+    if method == 'dijkstra':
+        path, settled = dijkstra(routing, source, target, weight)
+    elif method == 'astar':
+        path, settled = astar(routing, source, target, weight,
+                              haversine_heuristic(routing, target, weight))
+    elif method == 'bidirectional':
+        path, settled = bidirectional_dijkstra(routing, source, target, weight)
+    elif method == 'time_dependent':
+        if routing.profile is None:
+            raise ValueError('The routing graph has no time profile')
+        if departure is None:
+            now = datetime.datetime.now()
+            departure = now.hour * 3600 + now.minute * 60 + now.second
+        path, settled = time_dependent_dijkstra(routing, source, target, routing.profile, departure)
+    else:
+        raise ValueError('Unknown shortest path method: ' + str(method))
+    if stats is not None:
+        stats['settled'] = settled
+    if path is None:
+        return None
+    return routing.path_ids(path)
@@ -0,0 +1,182 @@
+import numpy as np
+from sklearn.neighbors import KDTree
+
+EARTH_RADIUS = 6371009  # meters, the one osmnx uses for the edge lengths
+
+
+class SpatialIndex:
+    """ This class is a spatial index over the nodes and edges of a graph, to snap
+        coordinates to the nearest node (intersection) or to the nearest edge (street).
+        The coordinates are projected to meters around the center of the graph, which
+        is precise enough for a city.
+
+        Attributes:
+            node_ids: the original id of each node.
+            node_tree: KDTree over the projected node coordinates.
+            segments: array with a row (x1, y1, x2, y2) per straight piece of each edge.
+            segment_edges: array with the (u, v) original node ids of the edge of each segment.
+            sample_tree: KDTree over points sampled along the segments.
+            sample_segments: the segment of each sampled point. """
+
+    def __init__(self, node_ids, x, y, segments, segment_edges, step=25):
+        """ Builds the index of the nodes (ids and coordinates) and of the straight pieces
+            of the edges (segments, with the (u, v) ids of the edge of each one). The
+            edges are sampled every step meters. See build_spatial_index and
+            compact_spatial_index.
+
+                    Time complexity: O(nodes*log(nodes) + samples*log(samples)) """
+
+        self.node_ids = np.asarray(node_ids, dtype=np.int64)
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        self.origin = (float(x.mean()), float(y.mean()))
+        self.node_tree = KDTree(self.project(x, y))
+        self.segments = np.asarray(segments, dtype=np.float64).reshape(-1, 4)
+        self.segment_edges = np.asarray(segment_edges, dtype=np.int64).reshape(-1, 2)
+
+        start = self.project(self.segments[:, 0], self.segments[:, 1])
+        end = self.project(self.segments[:, 2], self.segments[:, 3])
+        pieces = np.maximum(1, np.ceil(np.hypot(*(end - start).T) / step)).astype(np.int64)
+        self.sample_segments = np.repeat(np.arange(len(self.segments)), pieces + 1)
+        offsets = np.concatenate(([0], np.cumsum(pieces + 1)[:-1]))
+        fraction = (np.arange(len(self.sample_segments)) - np.repeat(offsets, pieces + 1)) \
+            / np.repeat(pieces, pieces + 1)
+        samples = start[self.sample_segments] + \
+            fraction[:, None] * (end - start)[self.sample_segments]
+        self.sample_tree = KDTree(samples)
+
+    def project(self, x, y):
+        """ Returns an array with a row (meters east, meters north) of the origin
+            for each longitude x and latitude y.
+
+                    Time complexity: O(points) """
+
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        scale = np.pi / 180 * EARTH_RADIUS
+        return np.column_stack(((x - self.origin[0]) * scale * np.cos(np.radians(self.origin[1])),
+                                (y - self.origin[1]) * scale))
+
+    def unproject(self, points):
+        """ Returns the longitudes and latitudes of an array of projected points.
+
+                    Time complexity: O(points) """
+
+        scale = np.pi / 180 * EARTH_RADIUS
+        x = points[:, 0] / (scale * np.cos(np.radians(self.origin[1]))) + self.origin[0]
+        y = points[:, 1] / scale + self.origin[1]
+        return x, y
+
+    def nearest_nodes(self, x, y):
+        """ Returns an array with the id of the nearest node of each point, given
+            their longitudes x and latitudes y (arrays).
+
+                    Time complexity: O(points*log(nodes)) """
+
+        positions = self.node_tree.query(self.project(x, y), k=1, return_distance=False)
+        return self.node_ids[positions[:, 0]]
+
+    def nearest_node(self, x, y):
+        """ Returns the id of the nearest node of a point.
+
+                    Time complexity: O(log(nodes)) """
+
+        return int(self.nearest_nodes([x], [y])[0])
+
+    def nearest_edges(self, x, y, candidates=8):
+        """ Returns the nearest edge of each point, given their longitudes x and latitudes y
+            (arrays): an array with a row (u, v) per point and the longitudes and latitudes
+            of the projection of each point on its edge. The candidate segments are the ones
+            of the nearest sampled points.
+
+                    Time complexity: O(points*(log(samples) + candidates)) """
+
+        points = self.project(x, y)
+        samples = self.sample_tree.query(points, k=min(candidates, self.sample_tree.data.shape[0]),
+                                         return_distance=False)
+        segments = self.sample_segments[samples]
+        start = self.project(self.segments[segments, 0].ravel(), self.segments[segments, 1].ravel())
+        end = self.project(self.segments[segments, 2].ravel(), self.segments[segments, 3].ravel())
+        start, end = start.reshape(segments.shape + (2,)), end.reshape(segments.shape + (2,))
+
+        direction = end - start
+        squared = (direction ** 2).sum(axis=2)
+        squared[squared == 0] = 1
+        t = np.clip(((points[:, None, :] - start) * direction).sum(axis=2) / squared, 0, 1)
+        projection = start + t[:, :, None] * direction
+        distance = ((projection - points[:, None, :]) ** 2).sum(axis=2)
+        best = np.argmin(distance, axis=1)
+        rows = np.arange(len(points))
+        projection_x, projection_y = self.unproject(projection[rows, best])
+        return self.segment_edges[segments[rows, best]], projection_x, projection_y
+
+    def nearest_edge(self, x, y):
+        """ Returns the nearest edge (u, v) of a point and the longitude and latitude
+            of the projection of the point on it.
+
+                    Time complexity: O(log(samples)) """
+
+        edges, projection_x, projection_y = self.nearest_edges([x], [y])
+        return (int(edges[0, 0]), int(edges[0, 1])), float(projection_x[0]), float(projection_y[0])
+
+
+def build_spatial_index(graph, step=25):
+    """ This function returns the SpatialIndex of a networkx graph, with the geometry of
+        the edges that have one (the first of each group of parallel edges).
+
+        Precondition:
+            1- graph must be a networkx graph with the x and y node attributes.
+
+                    Time complexity: O(nodes*log(nodes) + samples*log(samples)) """
+
+    node_ids = list(graph.nodes)
+    x = [graph.nodes[node]['x'] for node in node_ids]
+    y = [graph.nodes[node]['y'] for node in node_ids]
+    segments, segment_edges = list(), list()
+    seen = set()
+    for node1, node2, data in graph.edges(data=True):
+        if (node1, node2) in seen:
+            continue
+        seen.add((node1, node2))
+        if 'geometry' in data:
+            points = list(data['geometry'].coords)
+        else:
+            points = [(graph.nodes[node1]['x'], graph.nodes[node1]['y']),
+                      (graph.nodes[node2]['x'], graph.nodes[node2]['y'])]
+        for (x1, y1), (x2, y2) in zip(points[:-1], points[1:]):
+            segments.append((x1, y1, x2, y2))
+            segment_edges.append((node1, node2))
+    return SpatialIndex(node_ids, x, y, segments, segment_edges, step)
+
+
+def compact_spatial_index(compact, step=25):
+    """ This function returns the SpatialIndex of a storage.CompactGraph, the same one
+        build_spatial_index returns for its MultiDiGraph, computed on its arrays.
+
+                    Time complexity: O(nodes*log(nodes) + samples*log(samples)) """
+
+    edge_u, edge_v = np.asarray(compact.edge_u, dtype=np.int64), np.asarray(compact.edge_v, dtype=np.int64)
+    keys = edge_u * len(compact.node_ids) + edge_v
+    _, first = np.unique(keys, return_index=True)
+    first.sort()  # the first edge of each group of parallel edges, in order
+    u, v = edge_u[first], edge_v[first]
+    offsets = np.asarray(compact.geometry_offsets)
+    begin, sizes = offsets[first], offsets[first + 1] - offsets[first]
+
+    # the points of each edge: its geometry, or its two nodes if it has none
+    has_geometry = sizes > 0
+    counts = np.where(has_geometry, sizes, 2)
+    edge_of_point = np.repeat(np.arange(len(first)), counts)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    within = np.arange(len(edge_of_point)) - starts[edge_of_point]
+    geometry_x = np.append(np.asarray(compact.geometry_x), 0.0)  # the extra one for the edges without geometry
+    geometry_y = np.append(np.asarray(compact.geometry_y), 0.0)
+    point_geometry = np.where(has_geometry[edge_of_point], begin[edge_of_point] + within, len(geometry_x) - 1)
+    point_node = np.where(within == 0, u[edge_of_point], v[edge_of_point])
+    x, y = np.asarray(compact.x), np.asarray(compact.y)
+    point_x = np.where(has_geometry[edge_of_point], geometry_x[point_geometry], x[point_node])
+    point_y = np.where(has_geometry[edge_of_point], geometry_y[point_geometry], y[point_node])
+
+    pieces = np.flatnonzero(edge_of_point[1:] == edge_of_point[:-1])
+    segments = np.column_stack((point_x[pieces], point_y[pieces], point_x[pieces + 1], point_y[pieces + 1]))
+    node_ids = np.asarray(compact.node_ids, dtype=np.int64)
+    segment_edges = np.column_stack((node_ids[u], node_ids[v]))[edge_of_point[pieces]]
+    return SpatialIndex(node_ids, x, y, segments, segment_edges, step)
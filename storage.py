@@ -0,0 +1,346 @@
+import os
+import json
+import time
+import pickle
+import shutil
+import tempfile
+import numpy as np
+import networkx as nx
+from shapely.geometry import LineString
+
+FORMAT_VERSION = 1
+META_FILENAME = 'meta.json'
+LOAD_ATTEMPTS = 5  # times load_compact_graph opens a graph that is being replaced
+ARRAYS = ['node_ids', 'x', 'y', 'edge_u', 'edge_v', 'edge_key', 'length',
+          'highway', 'maxspeed', 'name', 'geometry_offsets', 'geometry_x', 'geometry_y']
+
+
+class CompactGraph:
+    """ This class is a graph opened from the binary format: the nodes and the edges
+        are stored in arrays (memory-mapped, so opening it does not read them) and the
+        string attributes as positions in tables of interned values.
+
+        Attributes:
+            node_ids, x, y: the id and coordinates of each node.
+            edge_u, edge_v, edge_key: the position of the two nodes of each edge, and its key.
+            length: the length of each edge.
+            highway, maxspeed, name: the position of the value of each edge in the tables
+                (-1 if the edge does not have it).
+            geometry_offsets, geometry_x, geometry_y: the points of the geometry of the
+                edge i are the positions geometry_offsets[i]..geometry_offsets[i+1]-1.
+            tables: dictionary with the list of values of each string attribute.
+            meta: the rest of the information of the file (version, crs, source...). """
+
+    def __init__(self, arrays, tables, meta):
+        for name in ARRAYS:
+            setattr(self, name, arrays[name])
+        self.tables = tables
+        self.meta = meta
+
+    def number_of_nodes(self):
+        return len(self.node_ids)
+
+    def number_of_edges(self):
+        return len(self.edge_u)
+
+    def sorted_nodes(self):
+        """ Returns the node ids sorted, and the number of each node of the arrays in
+            that order (the node numbers of the routing graph and the contraction
+            hierarchy).
+
+                    Time complexity: O(nodes*log(nodes)) """
+
+        order = np.argsort(self.node_ids, kind='stable')
+        numbers = np.empty(len(order), dtype=np.int64)
+        numbers[order] = np.arange(len(order), dtype=np.int64)
+        return np.asarray(self.node_ids)[order], numbers
+
+    def digraph_edges(self):
+        """ Returns the positions of the edges a DiGraph of the graph keeps (as osmnx
+            get_digraph): the shortest of each group of parallel edges, the first one
+            if there is a tie, in the order of the first edge of each group.
+
+                    Time complexity: O(edges*log(edges)) """
+
+        edge_u, edge_v = np.asarray(self.edge_u), np.asarray(self.edge_v)
+        positions = np.arange(len(edge_u), dtype=np.int64)
+        keys = edge_u.astype(np.int64) * len(self.node_ids) + edge_v
+        by_length = np.lexsort((positions, np.asarray(self.length), keys))
+        by_position = np.lexsort((positions, keys))
+        sorted_keys = keys[by_position]
+        first = np.ones(len(keys), dtype=bool)
+        first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+        # by_length and by_position have the groups at the same positions
+        kept, first_positions = by_length[first], by_position[first]
+        return kept[np.argsort(first_positions)]
+
+    def geometry(self, i):
+        """ Returns the geometry (LineString) of the edge i, None if it has none.
+
+                    Time complexity: O(geometry points) """
+
+        begin, end = int(self.geometry_offsets[i]), int(self.geometry_offsets[i+1])
+        if begin == end:
+            return None
+        return LineString(zip(self.geometry_x[begin:end].tolist(), self.geometry_y[begin:end].tolist()))
+
+
+class LazyGraph:
+    """ This class is the graph of igo.load_graph for a graph in the binary format: the
+        CompactGraph, which is enough for the routing graph, the spatial index and the
+        contraction hierarchy, and its osmnx MultiDiGraph (see to_networkx), which is only
+        built the first time something else is read (plotting the whole graph, the
+        networkx iGraph). Any attribute it does not have is read from the MultiDiGraph.
+
+        Attributes:
+            compact: the CompactGraph.
+            graph: the dictionary of the graph, shared with the MultiDiGraph. """
+
+    def __init__(self, compact):
+        self.compact = compact
+        self.graph = {'crs': compact.meta['crs']}
+        self.multidigraph = None
+
+    def networkx(self):
+        """ Returns the osmnx MultiDiGraph, built the first time. Two threads can build
+            it at once, then one of the two equal graphs is kept.
+
+                    Time complexity: O(nodes + edges) the first time. """
+
+        if self.multidigraph is None:
+            graph = to_networkx(self.compact)
+            graph.graph = self.graph
+            self.multidigraph = graph
+        return self.multidigraph
+
+    def number_of_nodes(self):
+        return self.compact.number_of_nodes()
+
+    def number_of_edges(self):
+        return self.compact.number_of_edges()
+
+    def __getattr__(self, name):
+        if name in ('compact', 'graph', 'multidigraph'):  # not set yet (unpickling)
+            raise AttributeError(name)
+        return getattr(self.networkx(), name)
+
+    def __iter__(self):
+        return iter(self.networkx())
+
+    def __contains__(self, node):
+        return node in self.networkx()
+
+    def __len__(self):
+        return self.compact.number_of_nodes()
+
+    def __getitem__(self, node):
+        return self.networkx()[node]
+
+
+def as_networkx(graph):
+    """ Returns the networkx graph of a graph of igo.load_graph: the graph itself, or the
+        MultiDiGraph of a LazyGraph. It is needed to pass the graph to osmnx or networkx.
+
+                    Time complexity: O(1), O(nodes + edges) the first time for a LazyGraph. """
+
+    return graph.networkx() if isinstance(graph, LazyGraph) else graph
+
+
+def source_fingerprint(source):
+    """ Returns a value that changes whenever the source file changes, None if there
+        is no source.
+
+                    Time complexity: O(1) """
+
+    if source is None:
+        return None
+    stat = os.stat(source)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def save_compact_graph(graph, dirname, source=None):
+    """ This function saves an osmnx graph in the binary format, in a directory with
+        a .npy file per array and a meta.json file with the tables. The source file
+        the graph comes from (if any) is recorded so a stale file can be detected.
+        The files are written in a temporary directory next to dirname, which then
+        replaces it as a whole, so a reader never sees a mix of two versions.
+
+        Precondition:
+            1- graph must be an osmnx MultiDiGraph.
+
+                    Time complexity: O(nodes + edges) """
+
+    node_ids = list(graph.nodes)
+    index = {node: i for i, node in enumerate(node_ids)}
+    tables = {'highway': list(), 'maxspeed': list(), 'name': list()}
+    interned = {attribute: dict() for attribute in tables}
+
+    def intern(attribute, value):
+        if value is None:
+            return -1
+        key = json.dumps(value)
+        if key not in interned[attribute]:
+            interned[attribute][key] = len(tables[attribute])
+            tables[attribute].append(value)
+        return interned[attribute][key]
+
+    columns = {name: list() for name in ARRAYS}
+    columns['geometry_offsets'].append(0)
+    for node in node_ids:
+        columns['node_ids'].append(node)
+        columns['x'].append(graph.nodes[node]['x'])
+        columns['y'].append(graph.nodes[node]['y'])
+    for node1, node2, key, data in graph.edges(keys=True, data=True):
+        columns['edge_u'].append(index[node1])
+        columns['edge_v'].append(index[node2])
+        columns['edge_key'].append(key)
+        columns['length'].append(data.get('length', 0))
+        for attribute in tables:
+            columns[attribute].append(intern(attribute, data.get(attribute)))
+        if 'geometry' in data:
+            for x, y in data['geometry'].coords:
+                columns['geometry_x'].append(x)
+                columns['geometry_y'].append(y)
+        columns['geometry_offsets'].append(len(columns['geometry_x']))
+
+    types = {'node_ids': np.int64, 'x': np.float64, 'y': np.float64, 'edge_u': np.int32,
+             'edge_v': np.int32, 'edge_key': np.int32, 'length': np.float64,
+             'highway': np.int32, 'maxspeed': np.int32, 'name': np.int32,
+             'geometry_offsets': np.int64, 'geometry_x': np.float64, 'geometry_y': np.float64}
+    meta = {'format_version': FORMAT_VERSION, 'crs': str(graph.graph.get('crs', 'epsg:4326')),
+            'source': source_fingerprint(source), 'tables': tables}
+
+    dirname = os.path.normpath(dirname)
+    parent, base = os.path.split(dirname)
+    os.makedirs(parent or '.', exist_ok=True)
+    temporary = tempfile.mkdtemp(prefix=base + '.', suffix='.tmp', dir=parent or '.')
+    try:
+        for name in ARRAYS:
+            np.save(os.path.join(temporary, name + '.npy'), np.array(columns[name], dtype=types[name]))
+        # the meta file is written last, so a directory without it is not a complete graph
+        with open(os.path.join(temporary, META_FILENAME), 'w') as file:
+            json.dump(meta, file)
+        replace_directory(temporary, dirname)
+    except BaseException:
+        shutil.rmtree(temporary, ignore_errors=True)
+        raise
+
+
+def replace_directory(temporary, dirname):
+    """ This function moves the directory temporary to dirname, replacing the one that
+        is there (if any). The old one is deleted: the processes that have its arrays
+        memory-mapped keep them, as its files are only unlinked and not truncated.
+
+                    Time complexity: O(files) """
+
+    parent, base = os.path.split(dirname)
+    old = tempfile.mkdtemp(prefix=base + '.', suffix='.old', dir=parent or '.')
+    try:
+        os.replace(dirname, old)
+    except FileNotFoundError:
+        pass
+    os.replace(temporary, dirname)
+    shutil.rmtree(old, ignore_errors=True)
+
+
+def read_meta(dirname):
+    """ Returns the meta information of a graph in the binary format, None if there is
+        no complete graph in the directory.
+
+                    Time complexity: O(tables size) """
+
+    try:
+        with open(os.path.join(dirname, META_FILENAME)) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def is_current(dirname, source=None):
+    """ This boolean function returns if there is a graph in the binary format in the
+        directory, written with the current format version and, if a source file is given,
+        from the current version of that file. A source file that no longer exists does
+        not make the graph stale: it is all that is left.
+
+                    Time complexity: O(tables size) """
+
+    meta = read_meta(dirname)
+    if meta is None or meta.get('format_version') != FORMAT_VERSION:
+        return False
+    if source is not None:
+        try:
+            fingerprint = source_fingerprint(source)
+        except OSError:
+            return True
+        if meta.get('source') != fingerprint:
+            return False
+    return True
+
+
+def load_compact_graph(dirname):
+    """ This function opens a graph saved with save_compact_graph. The arrays are
+        memory-mapped, so only the parts that are used are read from disk.
+
+        Precondition:
+            1- There must be a current graph in the directory (see is_current).
+
+                    Time complexity: O(tables size) """
+
+    # save_compact_graph replaces the whole directory: if it is replaced while the files
+    # are opened they can come from two versions, so they are opened again
+    for attempt in range(LOAD_ATTEMPTS):
+        if attempt > 0:
+            time.sleep(0.05)
+        try:
+            identity = os.stat(dirname).st_ino
+            meta = read_meta(dirname)
+            arrays = {name: np.load(os.path.join(dirname, name + '.npy'), mmap_mode='r') for name in ARRAYS}
+            if meta is not None and os.stat(dirname).st_ino == identity:
+                tables = meta.pop('tables')
+                return CompactGraph(arrays, tables, meta)
+        except OSError:
+            pass
+    raise OSError('No complete graph in the binary format in ' + str(dirname))
+
+
+def to_networkx(compact):
+    """ This function returns the osmnx MultiDiGraph of a CompactGraph, with only the
+        attributes stored in the binary format (coordinates, length, highway, maxspeed,
+        name and geometry).
+
+                    Time complexity: O(nodes + edges) """
+
+    graph = nx.MultiDiGraph(crs=compact.meta['crs'])
+    node_ids = compact.node_ids.tolist()
+    for node, x, y in zip(node_ids, compact.x.tolist(), compact.y.tolist()):
+        graph.add_node(node, x=x, y=y)
+
+    columns = {attribute: np.asarray(getattr(compact, attribute)).tolist()
+               for attribute in ('highway', 'maxspeed', 'name')}
+    offsets = compact.geometry_offsets.tolist()
+    geometry_x, geometry_y = compact.geometry_x, compact.geometry_y
+    for i, (u, v, key, length) in enumerate(zip(compact.edge_u.tolist(), compact.edge_v.tolist(),
+                                                compact.edge_key.tolist(), compact.length.tolist())):
+        data = {'length': length}
+        for attribute, column in columns.items():
+            if column[i] != -1:
+                data[attribute] = compact.tables[attribute][column[i]]
+        if offsets[i+1] > offsets[i]:
+            data['geometry'] = LineString(zip(geometry_x[offsets[i]:offsets[i+1]],
+                                              geometry_y[offsets[i]:offsets[i+1]]))
+        graph.add_edge(node_ids[u], node_ids[v], key=key, **data)
+    return graph
+
+
+def convert_graph(pickle_filename, dirname):
+    """ This function converts a graph saved with pickle (igo.save_graph) to the binary
+        format, recording the pickle file as its source.
+
+        Precondition:
+            1- There must be a graph saved with pickle in pickle_filename.
+
+                    Time complexity: O(nodes + edges) """
+
+    with open(pickle_filename, 'rb') as file:
+        graph = pickle.load(file)
+    save_compact_graph(graph, dirname, source=pickle_filename)
@@ -0,0 +1,29 @@
+import os
+import sys
+import collections
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import benchmark  # noqa: E402
+import igo  # noqa: E402
+
+City = collections.namedtuple('City', 'filename graph highways congestions new_congestions dead_end')
+
+
+@pytest.fixture(scope='session')
+def city(tmp_path_factory):
+    """ A synthetic city (see benchmark.run) saved and loaded with igo: its graph, its
+        highways, two sets of congestions and the routes (latitude, longitude of the
+        two ends) to and from a dead end whose only street is closed. """
+
+    graph = benchmark.grid_graph(12, seed=1)
+    highways = benchmark.synthetic_highways(graph, 60, seed=1)
+    closed_highways, dead_end = benchmark.dead_end(graph, len(highways) + 1)
+    highways += closed_highways
+    closed = {highway.way_id for highway in closed_highways}
+    filename = str(tmp_path_factory.mktemp('city') / 'city.graph')
+    igo.save_graph(graph, filename)
+    return City(filename, igo.load_graph(filename), highways,
+                benchmark.synthetic_congestions(highways, seed=1, closed=closed),
+                benchmark.synthetic_congestions(highways, seed=2, closed=closed), dead_end)
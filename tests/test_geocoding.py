@@ -0,0 +1,55 @@
+import pytest
+import geocoding
+from geocoding import Place
+
+PLACES = [Place('Carrer de Balmes', 41.39, 2.15), Place('Avinguda Diagonal', 41.40, 2.16),
+          Place('Passeig de Gràcia', 41.395, 2.162), Place('Carrer Gran de Gràcia', 41.40, 2.153),
+          Place('Carrer de Sant Antoni', 41.38, 2.13), Place('Carrer de Sant Pau', 41.378, 2.17),
+          Place('Carrer del Mar', 41.38, 2.19), Place('Carrer de Marina', 41.40, 2.18),
+          Place('Carrer del Rosselló', 41.40, 2.16)]
+
+
+@pytest.fixture
+def geocoder():
+    geocoder = geocoding.Geocoder(PLACES)
+    geocoder.add([Place('Balmes 150', 41.394, 2.154)])
+    return geocoder
+
+
+@pytest.mark.parametrize('text, name', [
+    ('Carrer de Balmes', 'Carrer de Balmes'),   # exact
+    ('carrer de balmes', 'Carrer de Balmes'),
+    ('Passeig de Gracia', 'Passeig de Gràcia'),  # without accents
+    ('Balmes', 'Carrer de Balmes'),             # without the street type
+    ('Sant Pau', 'Carrer de Sant Pau'),
+    ('Mar', 'Carrer del Mar'),
+    ('Diag', 'Avinguda Diagonal'),              # prefix
+    ('Marin', 'Carrer de Marina'),
+    ('rosello', 'Carrer del Rosselló'),         # fuzzy
+    ('Balmes 150', 'Balmes 150'),               # an address of the file
+])
+def test_hit(geocoder, text, name):
+    assert geocoder.lookup(text).name == name
+
+
+@pytest.mark.parametrize('text', [
+    'Sant',          # several streets start with it
+    'gracia',        # Passeig de Gràcia and Gran de Gràcia
+    'ma',            # too short for a prefix
+    'de',
+    'Carrer',
+    'xyz',
+    'Balmes 151',    # a house number that is not in the file goes to the remote geocoder
+    'Sagrera 12',
+])
+def test_miss(geocoder, text):
+    assert geocoder.lookup(text) is None
+    assert geocoder.geocode(text) is None
+
+
+def test_geocode_returns_latitude_and_longitude(geocoder):
+    assert geocoder.geocode('Diagonal') == (41.40, 2.16)
+
+
+def test_normalize_keeps_the_numbers():
+    assert geocoding.normalize("Carrer d'Aribau, 150") == 'carrer d aribau 150'
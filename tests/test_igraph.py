@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+import cch
+import igo
+
+
+def edge_values(igraph, attribute):
+    return {(node1, node2): data[attribute] for node1, node2, data in igraph.edges(data=True)}
+
+
+@pytest.mark.parametrize('build', [igo.build_igraph, igo.build_lean_igraph])
+def test_update_igraph_matches_a_full_rebuild(city, build):
+    updated = build(city.graph, city.highways, city.congestions)
+    updated = igo.update_igraph(updated, city.highways, city.congestions, city.new_congestions)
+    rebuilt = build(city.graph, city.highways, city.new_congestions)
+
+    assert edge_values(updated, 'congestion') == edge_values(rebuilt, 'congestion')
+    assert edge_values(updated, 'itime') == pytest.approx(edge_values(rebuilt, 'itime'))
+    np.testing.assert_allclose(updated.graph['routing'].itime, rebuilt.graph['routing'].itime)
+    numbers = list(range(0, updated.graph['routing'].number_of_nodes(), 5))
+    np.testing.assert_allclose(cch.many_to_many(updated.graph['cch'], numbers, numbers),
+                               cch.many_to_many(rebuilt.graph['cch'], numbers, numbers), rtol=1e-6)
+
+
+def test_update_igraph_without_changes_keeps_the_itimes(city):
+    igraph = igo.build_igraph(city.graph, city.highways, city.congestions)
+    itimes = igraph.graph['routing'].itime.copy()
+    igraph = igo.update_igraph(igraph, city.highways, city.congestions, city.congestions)
+    np.testing.assert_array_equal(igraph.graph['routing'].itime, itimes)
@@ -0,0 +1,69 @@
+import random
+import numpy as np
+import pytest
+import benchmark
+import cch
+import igo
+import routing
+
+METHODS = ('dijkstra', 'astar', 'bidirectional', 'cch')
+
+
+def line_graph(itimes):
+    """ Returns the RoutingGraph of three nodes in a line (10, 20 and 30) joined by
+        two-way streets, with the itimes of the edges 10-20, 20-10, 20-30 and 30-20. """
+
+    return routing.routing_graph_from_arrays(
+        np.array([10, 20, 30]), np.array([2.100, 2.101, 2.102]), np.array([41.4, 41.4, 41.4]),
+        np.array([0, 1, 1, 2]), np.array([1, 0, 2, 1]), np.full(4, 100.0), np.full(4, 50.0),
+        np.array(itimes, dtype=np.float64))
+
+
+def route(routing_graph, node_orig, node_dst, method):
+    if method == 'cch':
+        sources = np.repeat(np.arange(routing_graph.number_of_nodes()), np.diff(routing_graph.offsets))
+        topology = cch.contract(routing_graph.node_ids, routing_graph.x, routing_graph.y,
+                                sources, routing_graph.targets)
+        return cch.shortest_path(cch.customize(topology, routing_graph), node_orig, node_dst)
+    return routing.shortest_path(routing_graph, node_orig, node_dst, method=method)
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_closed_street_is_not_used(method):
+    routing_graph = line_graph([7.0, 7.0, np.inf, 7.0])
+    assert route(routing_graph, 10, 30, method) is None
+    assert route(routing_graph, 30, 10, method) == [30, 20, 10]
+
+
+def test_closed_street_is_not_reached():
+    routing_graph = line_graph([7.0, 7.0, np.inf, 7.0])
+    assert routing.many_to_many(routing_graph, [0], [1, 2]).tolist() == [[7.0, np.inf]]
+    assert routing.bounded_dijkstra(routing_graph, 0, 1e9) == {0: 0.0, 1: 7.0}
+
+
+def test_methods_find_paths_of_the_same_cost(city):
+    igraph = igo.build_igraph(city.graph, city.highways, city.congestions)
+    assert np.isinf(igraph.graph['routing'].itime).any()
+    nodes = list(igraph.graph['routing'].node_ids)
+    rand = random.Random(0)
+    for _ in range(100):
+        node_orig, node_dst = rand.choice(nodes), rand.choice(nodes)
+        costs = [benchmark.path_cost(igraph, igo.find_shortest_path(igraph, node_orig, node_dst, method))
+                 for method in METHODS]
+        assert costs[0] is not None
+        assert costs == pytest.approx([costs[0]] * len(METHODS), rel=1e-6)
+
+
+@pytest.mark.parametrize('method', METHODS)
+def test_dead_end_behind_a_closed_street_is_unreachable(city, method):
+    igraph = igo.build_igraph(city.graph, city.highways, city.congestions)
+    for point in city.dead_end:
+        assert igo.get_shortest_path_between_coords(igraph, *point, method=method) is None
+
+
+def test_many_to_many_methods_agree(city):
+    igraph = igo.build_igraph(city.graph, city.highways, city.congestions)
+    routing_graph, hierarchy = igraph.graph['routing'], igraph.graph['cch']
+    numbers = list(range(0, routing_graph.number_of_nodes(), 7))
+    expected = routing.many_to_many(routing_graph, numbers, numbers)
+    np.testing.assert_allclose(cch.many_to_many(hierarchy, numbers, numbers), expected, rtol=1e-6)
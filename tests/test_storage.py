@@ -0,0 +1,85 @@
+import os
+import networkx as nx
+import numpy as np
+from shapely.geometry import LineString
+import benchmark
+import igo
+import storage
+
+
+def street_graph():
+    """ Returns a small osmnx-like graph with all the attributes of the binary format:
+        list and missing values, a geometry and two parallel edges. """
+
+    graph = nx.MultiDiGraph(crs='epsg:4326')
+    graph.add_node(1, x=2.10, y=41.40)
+    graph.add_node(2, x=2.11, y=41.40)
+    graph.add_node(3, x=2.11, y=41.41)
+    graph.add_edge(1, 2, length=800.0, highway='primary', maxspeed='50', name='Carrer de Balmes',
+                   geometry=LineString([(2.10, 41.40), (2.105, 41.401), (2.11, 41.40)]))
+    graph.add_edge(2, 1, length=800.0, highway='primary', maxspeed=['30', '50'], name='Carrer de Balmes')
+    graph.add_edge(2, 3, length=1100.0, highway='residential', name=['Carrer de Mallorca', 'Carrer de Provença'])
+    graph.add_edge(2, 3, length=1200.0, highway='residential')
+    return graph
+
+
+def edges(graph):
+    return sorted((node1, node2, key, sorted((name, value.wkt if name == 'geometry' else repr(value))
+                                             for name, value in data.items()))
+                  for node1, node2, key, data in graph.edges(keys=True, data=True))
+
+
+def test_round_trip(tmp_path):
+    graph = street_graph()
+    dirname = str(tmp_path / 'city.bin')
+    storage.save_compact_graph(graph, dirname)
+    assert storage.is_current(dirname)
+    loaded = storage.to_networkx(storage.load_compact_graph(dirname))
+    assert dict(loaded.nodes(data=True)) == dict(graph.nodes(data=True))
+    assert edges(loaded) == edges(graph)
+    assert loaded.graph['crs'] == 'epsg:4326'
+
+
+def test_save_replaces_the_whole_graph(tmp_path):
+    dirname = str(tmp_path / 'city.bin')
+    storage.save_compact_graph(benchmark.grid_graph(6), dirname)
+    compact = storage.load_compact_graph(dirname)
+    x = np.array(compact.x)
+    graph = street_graph()
+    storage.save_compact_graph(graph, dirname)
+    assert edges(storage.to_networkx(storage.load_compact_graph(dirname))) == edges(graph)
+    # the arrays memory-mapped before keep the old graph, they are not overwritten
+    np.testing.assert_array_equal(compact.x, x)
+    assert os.listdir(str(tmp_path)) == ['city.bin']
+
+
+def test_source_changes_and_deletion(tmp_path):
+    source, dirname = str(tmp_path / 'city.graph'), str(tmp_path / 'city.bin')
+    igo.save_graph(street_graph(), source)
+    storage.convert_graph(source, dirname)
+    assert storage.is_current(dirname, source)
+    os.utime(source, ns=(0, 0))
+    assert not storage.is_current(dirname, source)
+    storage.convert_graph(source, dirname)
+    os.remove(source)
+    assert storage.is_current(dirname, source)
+    assert igo.exists_graph(dirname, source)
+
+
+def test_incomplete_directory_is_not_current(tmp_path):
+    dirname = str(tmp_path / 'city.bin')
+    storage.save_compact_graph(street_graph(), dirname)
+    os.remove(os.path.join(dirname, storage.META_FILENAME))
+    assert not storage.is_current(dirname)
+
+
+def test_lazy_graph_matches_the_pickled_one(city, tmp_path):
+    dirname = str(tmp_path / 'city.bin')
+    storage.convert_graph(city.filename, dirname)
+    lazy = igo.load_graph(dirname)
+    assert lazy.number_of_nodes() == city.graph.number_of_nodes()
+    assert lazy.number_of_edges() == city.graph.number_of_edges()
+    expected = igo.build_igraph(city.graph, city.highways, city.congestions).graph['routing']
+    lean = igo.build_lean_igraph(lazy, city.highways, city.congestions).graph['routing']
+    np.testing.assert_array_equal(lean.node_ids, expected.node_ids)
+    np.testing.assert_allclose(lean.itime, expected.itime, rtol=1e-6)
@@ -0,0 +1,325 @@
+import os
+import io
+import re
+import math
+import hashlib
+import tempfile
+import threading
+import collections
+import requests
+import numpy as np
+from PIL import Image, ImageDraw
+from staticmap import StaticMap
+import lru
+
+TILE_URL = 'https://a.tile.openstreetmap.org/{z}/{x}/{y}.png'
+TILE_SIZE = 256
+HEADERS = {'User-Agent': 'iGo bot'}
+LAYER_URL = 'layer://{z}/{x}/{y}'
+
+default_cache = None
+
+
+class TileCache:
+    """ This class is a disk-backed cache of map tiles, with a file per tile. When the
+        files take more than max_bytes, the least recently used ones are deleted.
+        It is safe to use from several threads.
+
+        Attributes:
+            directory: the directory of the files.
+            max_bytes: the maximum size of all the files.
+            files: dictionary from file name to size, from the least to the most recently used.
+            stats: dictionary with the number of hits, misses and evictions. """
+
+    def __init__(self, directory, max_bytes=200 * 1024 * 1024):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        os.makedirs(directory, exist_ok=True)
+        entries = list()
+        for name in os.listdir(directory):
+            if name.endswith('.png'):
+                stat = os.stat(os.path.join(directory, name))
+                entries.append((stat.st_mtime, name, stat.st_size))
+        self.files = collections.OrderedDict((name, size) for _, name, size in sorted(entries))
+        self.size = sum(self.files.values())
+
+    def filename(self, url):
+        return hashlib.sha1(url.encode('utf-8')).hexdigest() + '.png'
+
+    def __contains__(self, url):
+        return self.filename(url) in self.files
+
+    def get(self, url):
+        """ Returns the content of the tile of the url, None if it is not cached.
+
+                    Time complexity: O(tile size) """
+
+        name = self.filename(url)
+        with self.lock:
+            if name not in self.files:
+                self.stats['misses'] += 1
+                return None
+            self.files.move_to_end(name)
+            self.stats['hits'] += 1
+        path = os.path.join(self.directory, name)
+        try:
+            os.utime(path)  # so the order survives restarts
+            with open(path, 'rb') as file:
+                return file.read()
+        except OSError:
+            with self.lock:
+                self.size -= self.files.pop(name, 0)
+            return None
+
+    def put(self, url, content):
+        """ Stores the content of the tile of the url, evicting the least recently
+            used tiles if the cache gets too big.
+
+                    Time complexity: O(tile size + evicted tiles) """
+
+        name = self.filename(url)
+        path = os.path.join(self.directory, name)
+        # a temporary file of its own, as several threads can store the same tile at once
+        descriptor, temporary = tempfile.mkstemp(suffix='.tmp', dir=self.directory)
+        try:
+            with os.fdopen(descriptor, 'wb') as file:
+                file.write(content)
+            os.replace(temporary, path)
+        except BaseException:
+            os.remove(temporary)
+            raise
+        with self.lock:
+            self.size += len(content) - self.files.get(name, 0)
+            self.files[name] = len(content)
+            self.files.move_to_end(name)
+            while self.size > self.max_bytes and len(self.files) > 1:
+                evicted, size = self.files.popitem(last=False)
+                self.size -= size
+                self.stats['evictions'] += 1
+                try:
+                    os.remove(os.path.join(self.directory, evicted))
+                except OSError:
+                    pass
+
+
+def set_default_cache(tile_cache):
+    """ Sets the TileCache that the maps use when they are not given one. """
+
+    global default_cache
+    default_cache = tile_cache
+
+
+def fetch(url, tile_cache=None, **kwargs):
+    """ This function returns the status code and content of a tile, from the tile cache
+        (or the default one) if it is there, otherwise downloading it and caching it.
+
+                    Time complexity: O(tile size) """
+
+    tile_cache = tile_cache if tile_cache is not None else default_cache
+    if tile_cache is not None:
+        content = tile_cache.get(url)
+        if content is not None:
+            return 200, content
+    kwargs.setdefault('headers', HEADERS)
+    response = requests.get(url, **kwargs)
+    if response.status_code == 200 and tile_cache is not None:
+        tile_cache.put(url, response.content)
+    return response.status_code, response.content
+
+
+def lon_to_x(lon, zoom):
+    return (lon + 180) / 360 * 2 ** zoom
+
+
+def lat_to_y(lat, zoom):
+    lat = math.radians(lat)
+    return (1 - math.log(math.tan(lat) + 1 / math.cos(lat)) / math.pi) / 2 * 2 ** zoom
+
+
+def project(coordinates, zoom):
+    """ Returns the pixel coordinates (an Nx2 array) of a list of (longitude, latitude)
+        at a zoom level, in the whole world map.
+
+                    Time complexity: O(coordinates.size) """
+
+    coordinates = np.asarray(coordinates, dtype=np.float64).reshape(-1, 2)
+    x = (coordinates[:, 0] + 180) / 360 * 2 ** zoom
+    lat = np.radians(coordinates[:, 1])
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2 * 2 ** zoom
+    return np.column_stack((x, y)) * TILE_SIZE
+
+
+def simplify(points, tolerance=0.5):
+    """ This function simplifies a polyline with the Douglas-Peucker algorithm: it
+        returns a boolean mask of the points to keep so that the removed points are
+        about tolerance or less from the simplified line. With pixel coordinates and a
+        tolerance under a pixel the simplified line looks the same.
+
+                    Time complexity: O(points.size*log(points.size)) expected. """
+
+    n = len(points)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    # first the runs of points in the same cell of a tolerance-sized grid are
+    # collapsed (cheap and vectorized), which removes most of the points when the
+    # line is small in the image
+    cells = np.floor(points / (tolerance / 2))
+    candidates = np.flatnonzero(np.concatenate(([True], np.any(cells[1:] != cells[:-1], axis=1))))
+    if candidates[-1] != n - 1:
+        candidates = np.append(candidates, n - 1)
+    keep[candidates[0]] = keep[candidates[-1]] = True
+    points = points[candidates]
+    stack = [(0, len(candidates) - 1)]
+    while stack:
+        first, last = stack.pop()
+        if last - first < 2:
+            continue
+        start, end = points[first], points[last]
+        inner = points[first + 1:last]
+        dx, dy = end - start
+        norm = math.hypot(dx, dy)
+        if norm == 0:
+            distances = np.hypot(inner[:, 0] - start[0], inner[:, 1] - start[1])
+        else:
+            distances = np.abs(dx * (inner[:, 1] - start[1]) - dy * (inner[:, 0] - start[0])) / norm
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            middle = first + 1 + farthest
+            keep[candidates[middle]] = True
+            stack.append((first, middle))
+            stack.append((middle, last))
+    return keep
+
+
+def seed(bbox, zooms, tile_cache=None, url_template=None):
+    """ This function downloads into the tile cache all the tiles of a bounding box
+        (min_lon, min_lat, max_lon, max_lat) for the given zoom levels, so the maps of
+        that area can be rendered offline. It returns the number of tiles downloaded.
+
+                    Time complexity: O(tiles) """
+
+    tile_cache = tile_cache if tile_cache is not None else default_cache
+    url_template = url_template if url_template is not None else TILE_URL
+    downloaded = 0
+    for zoom in zooms:
+        x_min, x_max = int(lon_to_x(bbox[0], zoom)), int(lon_to_x(bbox[2], zoom))
+        y_min, y_max = int(lat_to_y(bbox[3], zoom)), int(lat_to_y(bbox[1], zoom))
+        for x in range(x_min, x_max + 1):
+            for y in range(y_min, y_max + 1):
+                url = url_template.format(z=zoom, x=x, y=y)
+                if url not in tile_cache:
+                    status, content = fetch(url, tile_cache)
+                    downloaded += status == 200
+    return downloaded
+
+
+class CongestionLayer:
+    """ This class is the base layer of a congestion snapshot: the map tiles with the
+        highways drawn in the colour of their congestion. The tiles are rendered when
+        they are first needed (or with prerender) and kept in memory, so the routes
+        are just drawn on top of them.
+
+        Attributes:
+            lines: list of (coordinates, color, bounding box) of the highways.
+            tiles: lru.LRUCache of the rendered tiles (PNG content) by (zoom, x, y). """
+
+    def __init__(self, lines, width=3, tile_cache=None, url_template=None, maxsize=2000):
+        self.lines = list()
+        for coordinates, color in lines:
+            lons, lats = [c[0] for c in coordinates], [c[1] for c in coordinates]
+            self.lines.append((coordinates, color, (min(lons), min(lats), max(lons), max(lats))))
+        self.width = width
+        self.projected = dict()  # zoom -> simplified pixel coordinates of the lines
+        self.tile_cache = tile_cache
+        self.url_template = url_template if url_template is not None else TILE_URL
+        self.tiles = lru.LRUCache(maxsize)
+
+    def tile(self, zoom, x, y):
+        """ Returns the PNG content of a tile of the layer.
+
+                    Time complexity: O(highways) the first time, O(1) afterwards. """
+
+        content = self.tiles.get((zoom, x, y))
+        if content is not None:
+            return content
+        status, content = fetch(self.url_template.format(z=zoom, x=x, y=y), self.tile_cache)
+        if status != 200:
+            raise RuntimeError('could not download tile {}/{}/{}'.format(zoom, x, y))
+        image = Image.open(io.BytesIO(content)).convert('RGBA')
+        draw = ImageDraw.Draw(image)
+        # bounding box of the tile, with a margin for the width of the lines
+        margin = 0.05
+        min_lon = (x - margin) / 2 ** zoom * 360 - 180
+        max_lon = (x + 1 + margin) / 2 ** zoom * 360 - 180
+        max_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y - margin) / 2 ** zoom))))
+        min_lat = math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * (y + 1 + margin) / 2 ** zoom))))
+        for (coordinates, color, box), points in zip(self.lines, self.pixels(zoom)):
+            if box[0] > max_lon or box[2] < min_lon or box[1] > max_lat or box[3] < min_lat:
+                continue
+            points = points - (x * TILE_SIZE, y * TILE_SIZE)
+            draw.line(list(map(tuple, points.tolist())), fill=color, width=self.width)
+        output = io.BytesIO()
+        image.save(output, format='PNG')
+        content = output.getvalue()
+        self.tiles.put((zoom, x, y), content)
+        return content
+
+    def pixels(self, zoom):
+        """ Returns the pixel coordinates of the lines at a zoom level, simplified to
+            half a pixel. They are computed once per zoom level.
+
+                    Time complexity: O(lines points) the first time, O(1) afterwards. """
+
+        if zoom not in self.projected:
+            projected = list()
+            for coordinates, color, box in self.lines:
+                points = project(coordinates, zoom)
+                projected.append(points[simplify(points)])
+            self.projected[zoom] = projected
+        return self.projected[zoom]
+
+    def prerender(self, bbox, zooms):
+        """ Renders all the tiles of a bounding box (min_lon, min_lat, max_lon, max_lat)
+            for the given zoom levels.
+
+                    Time complexity: O(tiles*highways) """
+
+        for zoom in zooms:
+            for x in range(int(lon_to_x(bbox[0], zoom)), int(lon_to_x(bbox[2], zoom)) + 1):
+                for y in range(int(lat_to_y(bbox[3], zoom)), int(lat_to_y(bbox[1], zoom)) + 1):
+                    self.tile(zoom, x, y)
+
+
+class CachedStaticMap(StaticMap):
+    """ This class is a StaticMap whose tiles go through the tile cache (or the default
+        one), and that can be drawn on top of a CongestionLayer instead of the plain
+        map tiles. """
+
+    def __init__(self, width, height, tile_cache=None, base_layer=None, **kwargs):
+        kwargs['url_template'] = LAYER_URL if base_layer is not None else kwargs.get('url_template', TILE_URL)
+        kwargs.setdefault('headers', HEADERS)
+        StaticMap.__init__(self, width, height, **kwargs)
+        self.tile_cache = tile_cache
+        self.base_layer = base_layer
+
+    def _draw_features(self, image):
+        # the lines are simplified for the zoom of the map (known only when rendering),
+        # so their cost depends on the size of the image and not on their points
+        originals = [line.coords for line in self.lines]
+        for line in self.lines:
+            keep = simplify(project(line.coords, self.zoom), 0.5)
+            line.coords = [coord for coord, kept in zip(line.coords, keep) if kept]
+        try:
+            StaticMap._draw_features(self, image)
+        finally:
+            for line, coords in zip(self.lines, originals):
+                line.coords = coords
+
+    def get(self, url, **kwargs):
+        if self.base_layer is not None:
+            zoom, x, y = map(int, re.match(r'layer://(\d+)/(\d+)/(\d+)', url).groups())
+            return 200, self.base_layer.tile(zoom, x, y)
+        return fetch(url, self.tile_cache, **kwargs)